@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'discordbot'))
+
+from rest_scheduler import DiscordRestScheduler
+from fake_discord import FakeDiscord, start_server
+
+CHANNEL_ID = 1000
+
+
+def updates(count, messages):
+    """Status updates as /update-message produces them: each one extends the message content."""
+    for n in range(count):
+        message_id = str(n % messages + 1)
+        yield message_id, {'content': f'message {message_id} status {n // messages}', 'components': []}
+
+
+async def run_direct(session, base_url, count, messages):
+    """The old path: fire every PATCH straight away, a 429 loses the update."""
+    async def patch(message_id, payload):
+        async with session.patch(f'{base_url}/channels/{CHANNEL_ID}/messages/{message_id}', json=payload) as response:
+            return response.status
+    return await asyncio.gather(*(patch(message_id, payload) for message_id, payload in updates(count, messages)))
+
+
+async def run_scheduled(session, base_url, count, messages):
+    rest = DiscordRestScheduler(session, 'token', base_url)
+    results = await asyncio.gather(*(
+        rest.edit_message(CHANNEL_ID, message_id, payload) for message_id, payload in updates(count, messages)
+    ))
+    return [status for status, _ in results], rest.stats
+
+
+async def measure(mode, args):
+    fake = FakeDiscord(args.bucket_limit, args.bucket_window, args.global_limit)
+    runner, base_url = await start_server(fake)
+    try:
+        async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+            if mode == 'direct':
+                statuses = await run_direct(session, base_url, args.updates, args.messages)
+                client_stats = None
+            else:
+                statuses, client_stats = await run_scheduled(session, base_url, args.updates, args.messages)
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+    # Every message must end up showing its last update
+    expected = {message_id: payload['content'] for message_id, payload in updates(args.updates, args.messages)}
+    stale = sum(1 for message_id, content in expected.items() if fake.messages.get(message_id, {}).get('content') != content)
+    result = {
+        'updates': args.updates,
+        'succeeded': sum(1 for status in statuses if status == 200),
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(args.updates / elapsed, 1),
+        'patches_sent': fake.stats['patches'],
+        'server_429s': fake.stats['rate_limited'],
+        'stale_messages': stale,
+    }
+    if client_stats:
+        result['coalesced'] = client_stats['coalesced']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive message updates against a rate-limited fake Discord API')
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=25, help='Distinct messages the updates are spread over')
+    parser.add_argument('--bucket-limit', type=int, default=5, help='Requests per bucket window')
+    parser.add_argument('--bucket-window', type=float, default=0.25, help='Bucket window in seconds')
+    parser.add_argument('--global-limit', type=int, default=50, help='Requests per second across all buckets')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = {mode: asyncio.run(measure(mode, args)) for mode in ('direct', 'scheduled')}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<10} {'ok':>5} {'stale':>6} {'PATCHes':>8} {'429s':>6} {'seconds':>8} {'upd/s':>8}")
+        for mode, result in results.items():
+            print(f"{mode:<10} {result['succeeded']:>5} {result['stale_messages']:>6} {result['patches_sent']:>8} "
+                  f"{result['server_429s']:>6} {result['seconds']:>8} {result['updates_per_second']:>8}")
+
+    scheduled = results['scheduled']
+    if scheduled['server_429s'] or scheduled['stale_messages'] or scheduled['succeeded'] != args.updates:
+        sys.exit('Scheduled run hit rate limits or lost updates')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+from fake_discord import FakeDiscord, start_server as start_discord
+from fake_openai import FakeOpenAI, start_server as start_openai
+from imap_server import DEFAULT_MIX, FakeIMAPServer, seed_mailbox
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WEBSERVICE_DIR = os.path.join(ROOT, 'webservice')
+DISCORDBOT_DIR = os.path.join(ROOT, 'discordbot')
+CHANNEL_ID = 1000
+# Discord messages the bot routes update, created in the fake API before the run
+FIRST_DISCORD_MESSAGE_ID = 10 ** 17
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed, first_events=None):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': None,
+        'p95_ms': None,
+        'p99_ms': None,
+        'max_ms': None,
+    }
+    if latencies:
+        summary.update({
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+        })
+    if first_events:
+        first_events = sorted(first_events)
+        summary['first_event_p50_ms'] = round(percentile(first_events, 0.50) * 1000, 2)
+        summary['first_event_p95_ms'] = round(percentile(first_events, 0.95) * 1000, 2)
+    if errors:
+        summary['first_error'] = errors[0]
+    return summary
+
+
+class StandIns:
+    """The fake IMAP server on its own threads, fake OpenAI and Discord on one event loop thread."""
+
+    def __init__(self, args):
+        self.args = args
+        self.imap = FakeIMAPServer(latency=args.imap_latency)
+        self.openai = FakeOpenAI(args.openai_latency, args.openai_token_delay, args.openai_tokens)
+        # Generous limits: the run measures our stack, bench_discord_rest.py measures rate limiting
+        self.discord = FakeDiscord(args.discord_bucket_limit, 1.0, args.discord_global_limit, latency=args.discord_latency)
+        self.loop = asyncio.new_event_loop()
+        self.runners = []
+        self.seeded = []
+
+    def start(self):
+        self.seeded = seed_mailbox(self.imap, self.args.messages, self.args.mix)
+        self.imap_port = self.imap.start()
+        threading.Thread(target=self.loop.run_forever, name='stand-ins', daemon=True).start()
+        openai_runner, self.openai_url = asyncio.run_coroutine_threadsafe(start_openai(self.openai), self.loop).result()
+        discord_runner, self.discord_url = asyncio.run_coroutine_threadsafe(start_discord(self.discord), self.loop).result()
+        self.runners = [openai_runner, discord_runner]
+
+        for n in range(self.args.discord_messages):
+            message_id = str(FIRST_DISCORD_MESSAGE_ID + n)
+            self.discord.messages[message_id] = {
+                'id': message_id,
+                'content': f':envelope: **Anfrage {n}**',
+                'components': [{'type': 1, 'components': [
+                    {'type': 2, 'style': 1, 'label': 'Suggest Answer', 'custom_id': f'suggest:m{n}@example.com'},
+                    {'type': 2, 'style': 2, 'label': 'Mark as Read', 'custom_id': f'read:m{n}@example.com'},
+                    {'type': 2, 'style': 4, 'label': 'Move to Trash', 'custom_id': f'trash:m{n}@example.com'},
+                ]}],
+            }
+
+    def stop(self):
+        for runner in self.runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.imap.stop()
+
+    def stats(self):
+        return {
+            'imap': dict(self.imap.stats),
+            'openai': dict(self.openai.stats),
+            'discord': dict(self.discord.stats),
+        }
+
+
+def start_services(args, stand_ins, log_dir):
+    webservice_port, bot_port = free_port(), free_port()
+    base_env = {key: value for key, value in os.environ.items() if not key.startswith(('IMAP_', 'OPENAI_', 'DISCORD_'))}
+
+    webservice_env = dict(base_env, **{
+        'IMAP_HOST': '127.0.0.1',
+        'IMAP_PORT': str(stand_ins.imap_port),
+        'IMAP_USER': stand_ins.imap.user,
+        'IMAP_PASS': stand_ins.imap.password,
+        'IMAP_SSL': '0',
+        'PORT': str(webservice_port),
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': stand_ins.openai_url,
+        'SERVER_MODE': args.server_mode,
+        'UPDATE_MESSAGE_URL': f'http://127.0.0.1:{bot_port}/update-message',
+        'MIRROR_SYNC_INTERVAL': str(args.mirror_sync_interval),
+        'WEB_WORKERS': str(args.workers),
+    })
+    if args.workers > 1:
+        # Worker processes share their caches through SQLite files
+        webservice_env['STATE_DIR'] = os.path.join(log_dir, 'state')
+    bot_env = dict(base_env, **{
+        'DISCORD_API_KEY': 'bench',
+        'DISCORD_CHANNEL_ID': str(CHANNEL_ID),
+        'DISCORD_API_URL': stand_ins.discord_url,
+        'DISCORD_GATEWAY': '0',
+        'PORT2': str(bot_port),
+        'WEBSERVICE_URL': f'http://127.0.0.1:{webservice_port}',
+        'WEBHOOK_URL': 'http://127.0.0.1:9/unused',
+        'WEBHOOK_QUEUE_PATH': os.path.join(log_dir, 'webhook_queue.db'),
+    })
+
+    processes = []
+    for name, command, cwd, env in (
+        ('webservice', [sys.executable, 'serve.py'], WEBSERVICE_DIR, webservice_env),
+        ('discord-bot', [sys.executable, 'discord_bot.py'], DISCORDBOT_DIR, bot_env),
+    ):
+        log = open(os.path.join(log_dir, f'{name}.log'), 'wb')
+        processes.append(subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT))
+    return processes, f'http://127.0.0.1:{webservice_port}', f'http://127.0.0.1:{bot_port}'
+
+
+async def wait_ready(session, urls, processes, timeout=60):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            if any(process.poll() is not None for process in processes):
+                raise RuntimeError('A service exited during startup')
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'{url} not ready after {timeout}s')
+            await asyncio.sleep(0.2)
+
+
+class Scenario:
+    """
+    One route under load.
+
+    Parameters:
+    name (str): Label in the results
+    method (str): HTTP method
+    url (callable): n -> URL of the n-th request
+    body (callable): n -> JSON body or None
+    kind (str): 'json', 'sse' (read the event stream to the end), 'job' (poll until done) or 'text'
+    """
+
+    def __init__(self, name, method, url, body=None, kind='json'):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.body = body or (lambda n: None)
+        self.kind = kind
+
+    async def call(self, session, n):
+        """Returns (error or None, seconds to the first event for streams)."""
+        async with session.request(self.method, self.url(n), json=self.body(n)) as response:
+            if response.status != 200:
+                return f'HTTP {response.status}', None
+            if self.kind == 'sse':
+                return await self._read_stream(response)
+            if self.kind == 'text':
+                await response.read()
+                return None, None
+            data = await response.json()
+        if data.get('status') not in ('success', 'partial'):
+            return str(data.get('message'))[:200], None
+        if self.kind == 'job':
+            return await self._wait_for_job(session, data['job_id']), None
+        return None, None
+
+    async def _read_stream(self, response):
+        started = time.perf_counter()
+        first = None
+        final = None
+        async for line in response.content:
+            if not line.startswith(b'data: '):
+                continue
+            if first is None:
+                first = time.perf_counter() - started
+            event = json.loads(line[6:])
+            if event.get('done'):
+                final = event
+        if final is None:
+            return 'Stream ended without a final event', first
+        return (None if final.get('status') == 'success' else str(final.get('message'))[:200]), first
+
+    async def _wait_for_job(self, session, job_id):
+        job_url = self.url(0).rsplit('/', 1)[0] + f'/jobs/{job_id}'
+        while True:
+            async with session.get(job_url) as response:
+                job = (await response.json()).get('job') or {}
+            if job.get('status') == 'success':
+                return None
+            if job.get('status') == 'error':
+                return str(job.get('message'))[:200]
+            await asyncio.sleep(0.02)
+
+
+def build_scenarios(webservice_url, bot_url, stand_ins, uids, move_uids, args):
+    message_ids = dict(stand_ins.seeded)
+    discord_ids = [str(FIRST_DISCORD_MESSAGE_ID + n) for n in range(args.discord_messages)]
+    run = time.time_ns()
+
+    def uid(n):
+        return str(uids[n % len(uids)])
+
+    moves = iter(move_uids)
+    scenarios = [
+        Scenario('webservice POST /get-uid', 'POST', lambda n: f'{webservice_url}/get-uid',
+                 lambda n: {'message_id': message_ids[uids[n % len(uids)]]}),
+        Scenario('webservice POST /find-emails', 'POST', lambda n: f'{webservice_url}/find-emails',
+                 lambda n: {'from': f'kunde{n % 50}@', 'without_flags': ['\\Seen'], 'limit': 20}),
+        Scenario('webservice POST /mark-as-read', 'POST', lambda n: f'{webservice_url}/mark-as-read',
+                 lambda n: {'uid': uid(n)}),
+        Scenario('webservice POST /mark-as-read (batch)', 'POST', lambda n: f'{webservice_url}/mark-as-read',
+                 lambda n: {'uids': [uid(n + k) for k in range(10)]}),
+        Scenario('webservice POST /set-flags', 'POST', lambda n: f'{webservice_url}/set-flags',
+                 lambda n: {'uids': [uid(n), uid(n + 1)], 'flags': ['\\Flagged'], 'action': 'add' if n % 2 else 'remove'}),
+        Scenario('webservice POST /move-email', 'POST', lambda n: f'{webservice_url}/move-email',
+                 lambda n: {'uid': str(next(moves))}),
+        Scenario('webservice POST /create-draft', 'POST', lambda n: f'{webservice_url}/create-draft',
+                 lambda n: {'uid': uid(n), 'message': 'Vielen Dank für Ihre Nachricht.'}),
+        Scenario('webservice POST /suggest-answer', 'POST', lambda n: f'{webservice_url}/suggest-answer',
+                 lambda n: {'uid': uid(n), 'context': f'Bitte Termin vorschlagen ({run}-{n})'}),
+        Scenario('webservice POST /suggest-answer (cached)', 'POST', lambda n: f'{webservice_url}/suggest-answer',
+                 lambda n: {'uid': uid(n % 10), 'context': 'Bitte freundlich absagen'}),
+        Scenario('webservice POST /suggest-answer (stream)', 'POST', lambda n: f'{webservice_url}/suggest-answer',
+                 lambda n: {'uid': uid(n), 'context': f'Bitte Angebot nachfragen ({run}-{n})', 'stream': True}, kind='sse'),
+        Scenario('webservice POST /suggest-answer (job)', 'POST', lambda n: f'{webservice_url}/suggest-answer',
+                 lambda n: {'uid': uid(n), 'context': f'Bitte Rückruf anbieten ({run}-{n})', 'job': True}, kind='job'),
+        Scenario('webservice GET /pool-stats', 'GET', lambda n: f'{webservice_url}/pool-stats'),
+        Scenario('webservice GET /cache-stats', 'GET', lambda n: f'{webservice_url}/cache-stats'),
+        Scenario('webservice GET /prompt-stats', 'GET', lambda n: f'{webservice_url}/prompt-stats'),
+        Scenario('webservice GET /job-stats', 'GET', lambda n: f'{webservice_url}/job-stats'),
+        Scenario('webservice GET /metrics', 'GET', lambda n: f'{webservice_url}/metrics', kind='text'),
+        Scenario('discord-bot POST /update-message (read)', 'POST', lambda n: f'{bot_url}/update-message',
+                 lambda n: {'action': 'read', 'status': 'success', 'message': 'Marked as read',
+                            'discordMessageId': discord_ids[n % len(discord_ids)]}),
+        Scenario('discord-bot POST /update-message (suggest)', 'POST', lambda n: f'{bot_url}/update-message',
+                 lambda n: {'action': 'suggest', 'status': 'success', 'message': 'Vielen Dank für Ihre Nachricht.',
+                            'discordMessageId': discord_ids[n % len(discord_ids)]}),
+        Scenario('discord-bot POST /new-mail', 'POST', lambda n: f'{bot_url}/new-mail',
+                 lambda n: {'uid': str(n), 'message_id': f'bench-{run}-{n}@example.com', 'subject': f'Anfrage {n}',
+                            'from': [{'name': 'Kunde', 'address': 'kunde@example.com'}], 'date': 'Mon, 14 Oct 2024 10:00:00 +0200'}),
+        Scenario('discord-bot GET /cache-stats', 'GET', lambda n: f'{bot_url}/cache-stats'),
+        Scenario('discord-bot GET /rest-stats', 'GET', lambda n: f'{bot_url}/rest-stats'),
+        Scenario('discord-bot GET /webhook-stats', 'GET', lambda n: f'{bot_url}/webhook-stats'),
+        Scenario('discord-bot GET /metrics', 'GET', lambda n: f'{bot_url}/metrics', kind='text'),
+    ]
+    if args.routes:
+        scenarios = [scenario for scenario in scenarios if any(part in scenario.name for part in args.routes.split(','))]
+    return scenarios
+
+
+async def run_level(session, scenario, offset, requests, concurrency):
+    latencies, errors, first_events = [], [], []
+    counter = iter(range(offset, offset + requests))
+
+    async def worker():
+        for n in counter:
+            started = time.perf_counter()
+            try:
+                error, first = await scenario.call(session, n)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                error, first = f'{type(e).__name__}: {e}', None
+            latencies.append(time.perf_counter() - started)
+            if first is not None:
+                first_events.append(first)
+            if error:
+                errors.append(error)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started, first_events)
+
+
+async def drive(args, stand_ins, webservice_url, bot_url, processes):
+    levels = [int(level) for level in args.concurrency.split(',')]
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    connector = aiohttp.TCPConnector(limit=max(levels) * 2)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await wait_ready(session, [f'{webservice_url}/pool-stats', f'{bot_url}/cache-stats'], processes)
+
+        # Every /move-email takes a UID of its own from the end of INBOX, the rest is shared
+        all_uids = [uid for uid, _ in stand_ins.seeded]
+        moves_needed = (args.requests * len(levels) + args.warmup) if not args.routes or 'move-email' in args.routes else 0
+        if moves_needed >= len(all_uids):
+            raise SystemExit(f'--messages must be above {moves_needed} to leave UIDs for /move-email')
+        uids, move_uids = all_uids[:len(all_uids) - moves_needed], all_uids[len(all_uids) - moves_needed:]
+
+        # Let the mailbox mirror finish its first sync so lookups measure the steady state
+        await asyncio.sleep(args.settle)
+
+        results = {}
+        offset = 0
+        for scenario in build_scenarios(webservice_url, bot_url, stand_ins, uids, move_uids, args):
+            if args.warmup:
+                await run_level(session, scenario, offset, args.warmup, 1)
+                offset += args.warmup
+            results[scenario.name] = {}
+            for level in levels:
+                results[scenario.name][str(level)] = summary = await run_level(session, scenario, offset, args.requests, level)
+                offset += args.requests
+                print(f"{scenario.name:<52} c={level:<3} p50={summary['p50_ms']:>9}ms p95={summary['p95_ms']:>9}ms "
+                      f"p99={summary['p99_ms']:>9}ms {summary['throughput_rps']:>8} req/s errors={summary['errors']}",
+                      file=sys.stderr)
+        return results
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, None
+
+
+def compare(previous, current):
+    """Print p95 and throughput of two result files side by side."""
+    print(f"{'route':<52} {'c':>3} {'p95 before':>11} {'p95 after':>10} {'change':>8} {'rps before':>11} {'rps after':>10}")
+    for name, levels in current['results'].items():
+        for level, after in levels.items():
+            before = previous.get('results', {}).get(name, {}).get(level)
+            if not before or not before.get('p95_ms') or not after.get('p95_ms'):
+                continue
+            change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            print(f"{name:<52} {level:>3} {before['p95_ms']:>11} {after['p95_ms']:>10} {change:>+7.1f}% "
+                  f"{before['throughput_rps']:>11} {after['throughput_rps']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load every route of the webservice and the Discord bot against local IMAP, OpenAI and Discord stand-ins')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per route and concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated concurrency levels')
+    parser.add_argument('--warmup', type=int, default=3, help='Unmeasured requests per route before the levels')
+    parser.add_argument('--routes', help='Only routes whose name contains one of these comma separated parts')
+    parser.add_argument('--server-mode', choices=('dev', 'asgi', 'prefork'), default='dev', help='SERVER_MODE of the webservice')
+    parser.add_argument('--workers', type=int, default=1, help='WEB_WORKERS of the webservice (prefork and asgi)')
+    parser.add_argument('--messages', type=int, default=1000, help='Emails seeded into INBOX')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Attachment profiles with weights, e.g. text:70,html:15,pdf:10,images:5')
+    parser.add_argument('--imap-latency', type=float, default=0.005, help='Seconds the IMAP server adds per command')
+    parser.add_argument('--openai-latency', type=float, default=0.5, help='Seconds to the first OpenAI token')
+    parser.add_argument('--openai-token-delay', type=float, default=0.01, help='Seconds between OpenAI tokens')
+    parser.add_argument('--openai-tokens', type=int, default=60, help='Tokens per OpenAI reply')
+    parser.add_argument('--discord-latency', type=float, default=0.02, help='Seconds the Discord API adds per request')
+    parser.add_argument('--discord-bucket-limit', type=int, default=1000, help='Requests per second and bucket')
+    parser.add_argument('--discord-global-limit', type=int, default=5000, help='Requests per second overall')
+    parser.add_argument('--discord-messages', type=int, default=200, help='Discord messages the bot routes update')
+    parser.add_argument('--mirror-sync-interval', type=int, default=5, help='MIRROR_SYNC_INTERVAL of the webservice')
+    parser.add_argument('--settle', type=float, default=3.0, help='Seconds to wait after startup before measuring')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='Earlier JSON results to compare against')
+    parser.add_argument('--logs', help='Directory for the service logs (a temporary one by default)')
+    args = parser.parse_args()
+
+    log_dir = args.logs or tempfile.mkdtemp(prefix='bench-e2e-')
+    os.makedirs(log_dir, exist_ok=True)
+    stand_ins = StandIns(args)
+    started = time.time()
+    stand_ins.start()
+    print(f'Seeded {args.messages} emails in {time.time() - started:.1f}s, service logs in {log_dir}', file=sys.stderr)
+
+    processes, webservice_url, bot_url = start_services(args, stand_ins, log_dir)
+    try:
+        results = asyncio.run(drive(args, stand_ins, webservice_url, bot_url, processes))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        stand_ins.stop()
+
+    commit, dirty = git_revision()
+    output = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'logs')},
+        },
+        'stand_ins': stand_ins.stats(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+    failed = {name: levels for name, levels in results.items() if any(level['errors'] for level in levels.values())}
+    if failed:
+        sys.exit(f"Errors on {len(failed)} routes, see first_error in the results and the logs in {log_dir}")
+
+
+if __name__ == '__main__':
+    main()
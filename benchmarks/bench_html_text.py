@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webservice'))
+
+from html_text import html_to_text_fast
+from mail_text import html_to_text_bs4
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'html')
+
+ENGINES = {
+    'parser': html_to_text_fast,
+    'bs4': html_to_text_bs4,
+}
+
+
+def load_corpus(scale):
+    corpus = {}
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+                corpus[name] = f.read()
+
+    # Newsletter-sized mail: the article rows repeated, as long digests look
+    newsletter = corpus['newsletter.html']
+    rows = re.search(r'(<tr>\s*<td style="padding:0 24px 24px 24px;">.*?</table>\s*</td>\s*</tr>)', newsletter, re.S).group(1)
+    corpus[f'newsletter_x{scale}.html'] = newsletter.replace(rows, rows * scale)
+    return corpus
+
+
+def measure(engine, html, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        text = engine(html)
+    elapsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    engine(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ms': round(elapsed * 1000, 3),
+        'mb_per_s': round(len(html.encode()) / elapsed / 1e6, 2),
+        'peak_kb': round(peak / 1024, 1),
+        'text_chars': len(text),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the HTML-to-text engines on a corpus of HTML mails')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--scale', type=int, default=40, help='Article rows in the generated newsletter')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.scale)
+    results = {}
+    for name, html in corpus.items():
+        results[name] = {'bytes': len(html.encode())}
+        for engine_name, engine in ENGINES.items():
+            results[name][engine_name] = measure(engine, html, args.iterations)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mail':<26} {'bytes':>8} | {'engine':<6} {'ms':>8} {'MB/s':>7} {'peak KB':>9} {'chars':>7}")
+    for name, result in results.items():
+        for engine_name in ENGINES:
+            r = result[engine_name]
+            label = name if engine_name == 'parser' else ''
+            size = result['bytes'] if engine_name == 'parser' else ''
+            print(f"{label:<26} {size:>8} | {engine_name:<6} {r['ms']:>8} {r['mb_per_s']:>7} {r['peak_kb']:>9} {r['text_chars']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import email
+import imaplib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webservice'))
+
+from fake_imap import build_message
+from imap_server import FakeIMAPServer
+from mail_text import extract_text, select_text
+from mime_stream import fetch_text_stream
+
+MB = 1024 * 1024
+
+
+def serve(sizes, connection):
+    """Child process: the fake IMAP server with one email per size, so its allocations do not count."""
+    server = FakeIMAPServer()
+    uids = [server.add_message('INBOX', build_message(attachments=[('scan.pdf', size, 'application/pdf')] if size else []))
+            for size in sizes]
+    connection.send((server.start(), server.user, server.password, uids))
+    connection.recv()
+    server.stop()
+
+
+def full_fetch(mail, uids):
+    """The original path: download RFC822, parse everything, walk the parts."""
+    texts = {}
+    for uid in uids:
+        result, data = mail.uid('FETCH', uid, '(RFC822)')
+        texts[uid] = extract_text(email.message_from_bytes(data[0][1]))
+    return texts
+
+
+def stream_fetch(mail, uids, args):
+    fetched = fetch_text_stream(mail, uids, args.window, args.batch_bytes, args.max_text)
+    return {uid: select_text(text_content, html_content) for uid, (_, text_content, html_content) in fetched.items()}
+
+
+def measure(fetch):
+    """Run fetch under tracemalloc, returns its result, peak bytes and seconds."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = fetch()
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory of extracting the text of large emails: whole RFC822 versus streamed windows')
+    parser.add_argument('--sizes', default='0,1,10,50', help='Attachment sizes in MB, one email each')
+    parser.add_argument('--window', type=int, default=1 * MB, help='FETCH_WINDOW_BYTES')
+    parser.add_argument('--batch-bytes', type=int, default=8 * MB, help='FETCH_BATCH_BYTES')
+    parser.add_argument('--max-text', type=int, default=1 * MB, help='FETCH_TEXT_BYTES')
+    parser.add_argument('--skip-full', action='store_true', help='Only measure the streamed path')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    sizes = [int(float(size) * MB) for size in args.sizes.split(',')]
+    # What the streamed path may hold at once: a FETCH response with its parsed copies, the kept text and the parser's own state
+    bound = 4 * max(args.window, args.batch_bytes) + 4 * args.max_text + 1 * MB
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(sizes, child), daemon=True)
+    server.start()
+    port, user, password, uids = parent.recv()
+    uids = [str(uid) for uid in uids]
+
+    results = {'bound': bound, 'emails': []}
+    failed = False
+    mail = imaplib.IMAP4('127.0.0.1', port)
+    try:
+        mail.login(user, password)
+        mail.select('INBOX')
+        runs = [(f'{size / MB:.3g} MB attachment', [uid]) for size, uid in zip(sizes, uids)]
+        runs.append((f'all {len(uids)} at once', uids))
+        for name, batch in runs:
+            streamed, stream_peak, stream_seconds = measure(lambda: stream_fetch(mail, batch, args))
+            run = {'email': name, 'stream_peak': stream_peak, 'stream_seconds': round(stream_seconds, 3)}
+            if not args.skip_full:
+                expected, full_peak, full_seconds = measure(lambda: full_fetch(mail, batch))
+                run.update(full_peak=full_peak, full_seconds=round(full_seconds, 3), same_text=streamed == expected)
+                failed |= streamed != expected
+            failed |= stream_peak > bound
+            results['emails'].append(run)
+        mail.logout()
+    finally:
+        parent.send('stop')
+        server.join(10)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"streamed peak may not exceed {bound / MB:.1f} MB (window {args.window / MB:g} MB, "
+              f"batch {args.batch_bytes / MB:g} MB, text {args.max_text / MB:g} MB)")
+        for run in results['emails']:
+            line = f"{run['email']:<20} streamed {run['stream_peak'] / MB:>7.1f} MB {run['stream_seconds']:>7}s"
+            if 'full_peak' in run:
+                line += f"   full {run['full_peak'] / MB:>7.1f} MB {run['full_seconds']:>7}s   same text: {run['same_text']}"
+            print(line)
+    if failed:
+        print('FAILED: streamed peak above the bound or text differs from the full parse', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
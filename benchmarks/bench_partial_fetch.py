@@ -0,0 +1,77 @@
+import argparse
+import email
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webservice'))
+
+from fake_imap import FakeIMAPSession, build_message
+from mail_text import extract_text, select_text
+from bodystructure import fetch_text_parts
+
+MB = 1024 * 1024
+
+SCENARIOS = {
+    'text only': [],
+    '1 MB pdf': [('angebot.pdf', 1 * MB, 'application/pdf')],
+    '10 MB pdf + 2 MB jpg': [('vertrag.pdf', 10 * MB, 'application/pdf'), ('foto.jpg', 2 * MB, 'image/jpeg')],
+}
+
+
+def full_fetch(session, uid):
+    """The original path: download RFC822, parse everything, walk the parts."""
+    result, data = session.uid('FETCH', uid, '(RFC822)')
+    return extract_text(email.message_from_bytes(data[0][1]))
+
+
+def partial_fetch(session, uid):
+    _, text_content, html_content = fetch_text_parts(session, uid)
+    return select_text(text_content, html_content)
+
+
+def run(fetch, raw, iterations, mbps):
+    session = FakeIMAPSession([raw])
+    start = time.perf_counter()
+    for _ in range(iterations):
+        text = fetch(session, '1')
+    elapsed = (time.perf_counter() - start) / iterations
+    transferred = session.bytes_sent / iterations
+    return {
+        'bytes': int(transferred),
+        'round_trips': session.commands // iterations,
+        'parse_ms': round(elapsed * 1000, 3),
+        'transfer_ms': round(transferred * 8 / (mbps * 1000 * 1000) * 1000, 3),
+        'text_length': len(text or ''),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full RFC822 fetch with BODYSTRUCTURE-driven partial fetch')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--mbps', type=float, default=100.0, help='Link speed used to estimate transfer time')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for name, attachments in SCENARIOS.items():
+        raw = build_message(attachments=attachments)
+        full = run(full_fetch, raw, args.iterations, args.mbps)
+        partial = run(partial_fetch, raw, args.iterations, args.mbps)
+        assert full['text_length'] == partial['text_length'], name
+        results[name] = {'full': full, 'partial': partial}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'scenario':<24}{'mode':<9}{'bytes':>12}{'RTs':>5}{'parse ms':>11}{'transfer ms':>13}")
+    for name, modes in results.items():
+        for mode, result in modes.items():
+            print(f"{name:<24}{mode:<9}{result['bytes']:>12}{result['round_trips']:>5}"
+                  f"{result['parse_ms']:>11}{result['transfer_ms']:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webservice'))
+
+from prompt_prep import prepare_email_text, _get_encoding
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'emails')
+
+
+def load_fixtures():
+    with open(os.path.join(FIXTURES, 'expectations.json'), encoding='utf-8') as f:
+        expectations = json.load(f)
+    for name in sorted(expectations):
+        with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+            yield name, f.read(), expectations[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prompt size of the fixture emails before and after preprocessing')
+    parser.add_argument('--budget', type=int, default=1500, help='Token budget for the email text')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for name, text, expected in load_fixtures():
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            prepared, stats = prepare_email_text(text, args.budget)
+        elapsed = (time.perf_counter() - start) / args.iterations
+
+        # A budget smaller than the message itself cuts wanted text on purpose
+        truncated = 'truncated' in stats['removed']
+        missing = [phrase for phrase in expected['keep'] if phrase not in prepared and not truncated]
+        leftover = [phrase for phrase in expected['drop'] if phrase in prepared]
+        if missing or leftover:
+            failures.append({'fixture': name, 'missing': missing, 'leftover': leftover})
+        results[name] = dict(stats, prepare_ms=round(elapsed * 1000, 3))
+
+    before = sum(result['tokens_before'] for result in results.values())
+    after = sum(result['tokens_after'] for result in results.values())
+    summary = {
+        'tokenizer': 'tiktoken cl100k_base' if _get_encoding() is not None else 'estimate (4 chars/token)',
+        'tokens_before': before,
+        'tokens_after': after,
+        'saved_percent': round(100 * (before - after) / before, 1) if before else 0,
+    }
+
+    if args.json:
+        print(json.dumps({'fixtures': results, 'summary': summary, 'failures': failures}, indent=2, ensure_ascii=False))
+    else:
+        print(f"{'fixture':<36} {'before':>7} {'after':>7} {'saved':>7} {'ms':>7}  removed")
+        for name, result in results.items():
+            print(f"{name:<36} {result['tokens_before']:>7} {result['tokens_after']:>7} {result['tokens_saved']:>7} "
+                  f"{result['prepare_ms']:>7}  {', '.join(result['removed']) or '-'}")
+        print(f"{'total':<36} {before:>7} {after:>7} {before - after:>7}  ({summary['saved_percent']}% saved, {summary['tokenizer']})")
+        for failure in failures:
+            print(f"FAIL {failure['fixture']}: missing {failure['missing']}, leftover {failure['leftover']}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+import aiohttp
+
+from bench_e2e import WEBSERVICE_DIR, free_port, wait_ready
+from fake_openai import FakeOpenAI, start_server as start_openai
+from imap_server import FakeIMAPServer
+
+# Templated requests and notifications like the ones that fill a real inbox, the fields differ from email to email
+TEMPLATES = [
+    'Guten Tag,\n\nich habe am {date} die Bestellung {number} aufgegeben und bisher keine Versandbestätigung erhalten. '
+    'Können Sie mir bitte sagen, wann das Paket verschickt wird? Die Ware wird dringend für ein Projekt benötigt, '
+    'das wir Ende des Monats bei unserem Kunden vorstellen. Falls einzelne Artikel nicht lieferbar sind, schicken Sie bitte '
+    'zuerst die vorrätigen Teile und den Rest später. Eine Teillieferung ist für uns in Ordnung, solange die Rechnung '
+    'erst nach der letzten Lieferung kommt. Bitte geben Sie mir auch die Sendungsnummer durch, damit unser Lager Bescheid weiß.\n\n'
+    'Vielen Dank im Voraus.\n\nMit freundlichen Grüßen\n{name}',
+    'Hallo,\n\nwir möchten gerne einen Termin für ein Erstgespräch zu unserer neuen Website vereinbaren. '
+    'Am besten passt uns der {date} am Vormittag. Es geht um einen Relaunch mit Shop und etwa {number} Produkten. '
+    'Die bisherige Seite ist über zehn Jahre alt, auf dem Smartphone kaum bedienbar und wird von uns selbst gepflegt. '
+    'Wichtig sind uns eine Anbindung an unsere Warenwirtschaft, ein Bereich für Händler mit eigenen Preisen und ein Blog. '
+    'Ein grobes Budget haben wir intern schon abgestimmt, das können wir im Gespräch genauer besprechen.\n\n'
+    'Beste Grüße\n{name}',
+    'Sehr geehrte Damen und Herren,\n\nzu Ihrer Rechnung {number} vom {date} habe ich eine Frage. '
+    'Die Position für das Hosting ist doppelt aufgeführt, einmal für das Paket und einmal als Einzelleistung. '
+    'Laut unserem Vertrag ist das Hosting im monatlichen Wartungspaket enthalten und wird nicht gesondert berechnet. '
+    'Außerdem fehlt auf der Rechnung unsere Bestellnummer, die unsere Buchhaltung für die Freigabe zwingend braucht. '
+    'Bitte prüfen Sie das und senden mir eine korrigierte Rechnung, dann überweisen wir den Betrag umgehend.\n\n'
+    'Freundliche Grüße\n{name}',
+    'Neue Anfrage über das Kontaktformular der Kampagnenseite\n\nName: {name}\nKundennummer: {number}\n'
+    'Gewünschter Rückruf: {date}\nPaket: Website Komplett\n\n'
+    'Ich interessiere mich für das Angebot aus Ihrer aktuellen Kampagne und möchte mehr über das Paket erfahren. '
+    'Uns ist wichtig, dass die neue Website auf allen Geräten gut aussieht und wir Texte und Bilder selbst ändern können. '
+    'Wir haben bereits ein Logo und Fotos aus einem Shooting, die Texte müssten aber neu geschrieben werden. '
+    'Außerdem brauchen wir ein Formular für Terminanfragen, eine Karte mit Anfahrt und eine Seite für Stellenangebote. '
+    'Die Domain liegt derzeit bei einem anderen Anbieter, sie soll mitsamt den E-Mail-Postfächern umziehen. '
+    'Können Sie mir sagen, wie lange so ein Projekt dauert, welche Kosten neben dem Paketpreis anfallen und was wir zuliefern müssen? '
+    'Gerne würden wir auch wissen, ob Suchmaschinenoptimierung enthalten ist oder zusätzlich gebucht werden muss. '
+    'Wir sind ein Handwerksbetrieb mit zwölf Mitarbeitern und haben bisher nur eine einfache Visitenkarten-Seite. '
+    'Ein Start in den nächsten zwei Monaten wäre ideal, weil wir im Frühjahr neue Mitarbeiter suchen.',
+    'Automatische Benachrichtigung\n\nDer Server web-{number} hat das Speicherlimit seines Tarifs zu 90 Prozent erreicht. '
+    'Wenn der Speicher voll ist, können keine neuen Dateien hochgeladen und keine E-Mails mehr empfangen werden. '
+    'Bitte löschen Sie nicht mehr benötigte Dateien und Sicherungen oder wechseln Sie in einen größeren Tarif. '
+    'Den aktuellen Verbrauch und die größten Verzeichnisse sehen Sie jederzeit im Kundenbereich unter Speicher. '
+    'Diese Nachricht wurde automatisch erstellt, Antworten auf diese E-Mail werden nicht gelesen.',
+]
+NAMES = ['Anna Schmidt', 'Jonas Weber', 'Lea Fischer', 'Paul Wagner', 'Marie Becker', 'Felix Hoffmann', 'Emma Schulz']
+WORDS = ('Angebot Anfrage Website Shop Design Hosting Server Domain Logo Kampagne Newsletter Budget Termin Rechnung '
+         'Vertrag Wartung Update Fehler Formular Bilder Texte Übersetzung Schulung Support Agentur Kunde').split()
+
+
+def seed_mailbox(imap, count, unique_share, seed=1):
+    """Fill INBOX with templated emails and a share of unique ones, returns the UIDs as strings."""
+    rng = random.Random(seed)
+    uids = []
+    for n in range(count):
+        if rng.random() < unique_share:
+            text = ' '.join(rng.choice(WORDS) for _ in range(120)) + '.'
+        else:
+            text = rng.choice(TEMPLATES).format(
+                date=f'{rng.randint(1, 28)}.{rng.randint(1, 12)}.2026',
+                number=rng.randint(10000, 99999),
+                name=rng.choice(NAMES)
+            )
+        message = EmailMessage()
+        message['From'] = f'Kunde {n} <kunde{n}@example.com>'
+        message['To'] = 'info@example.com'
+        message['Subject'] = f'Anfrage {n}'
+        message['Date'] = formatdate(localtime=True)
+        message['Message-ID'] = make_msgid(domain='example.com')
+        message.set_content(text)
+        uids.append(str(imap.add_message('INBOX', message.as_bytes())))
+    return uids
+
+
+def start_webservice(args, imap, openai_url, log_dir, name, reuse, adapt):
+    port = free_port()
+    env = {key: value for key, value in os.environ.items() if not key.startswith(('IMAP_', 'OPENAI_', 'SIMILARITY_', 'STATE_DIR'))}
+    env.update({
+        'IMAP_HOST': '127.0.0.1',
+        'IMAP_PORT': str(imap.port),
+        'IMAP_USER': imap.user,
+        'IMAP_PASS': imap.password,
+        'IMAP_SSL': '0',
+        'PORT': str(port),
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_url,
+        'SERVER_MODE': args.server_mode,
+        'SIMILARITY_REUSE_THRESHOLD': str(reuse),
+        'SIMILARITY_ADAPT_THRESHOLD': str(adapt),
+        'MIRROR_SYNC_INTERVAL': '0',
+    })
+    log = open(os.path.join(log_dir, f'webservice-{name}.log'), 'wb')
+    process = subprocess.Popen([sys.executable, 'serve.py'], cwd=WEBSERVICE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f'http://127.0.0.1:{port}'
+
+
+async def suggest_all(args, url, process, uids, openai):
+    """Ask for a suggestion for every email, one after the other like a user working through the inbox."""
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.request_timeout)) as session:
+        await wait_ready(session, [f'{url}/pool-stats'], [process])
+        requests, prompt_chars = openai.stats['requests'], openai.stats['prompt_chars']
+        started = time.perf_counter()
+        errors = 0
+        for uid in uids:
+            async with session.post(f'{url}/suggest-answer', json={'uid': uid, 'context': args.context, 'stream': args.stream}) as response:
+                if args.stream:
+                    done = {}
+                    async for line in response.content:
+                        if line.startswith(b'data: '):
+                            done = json.loads(line[6:])
+                else:
+                    done = await response.json()
+            errors += done.get('status') != 'success'
+        seconds = time.perf_counter() - started
+        async with session.get(f'{url}/similarity-stats') as response:
+            similarity = (await response.json())['similarity']
+    return {
+        'seconds': round(seconds, 3),
+        'errors': errors,
+        'openai_requests': openai.stats['requests'] - requests,
+        'prompt_chars': openai.stats['prompt_chars'] - prompt_chars,
+        'similarity': similarity,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Suggestions for an inbox of templated emails with and without reusing answers for near-identical ones')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--unique-share', type=float, default=0.2, help='Share of emails not based on a template')
+    parser.add_argument('--reuse-threshold', type=float, default=0.9)
+    parser.add_argument('--adapt-threshold', type=float, default=0.5)
+    parser.add_argument('--server-mode', choices=('dev', 'asgi'), default='dev')
+    parser.add_argument('--stream', action='store_true', help='Ask for streamed suggestions')
+    parser.add_argument('--context', default='Freundlich antworten')
+    parser.add_argument('--imap-latency', type=float, default=0.005)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-token-delay', type=float, default=0.01)
+    parser.add_argument('--openai-tokens', type=int, default=60)
+    parser.add_argument('--request-timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    imap = FakeIMAPServer(latency=args.imap_latency)
+    imap.port = imap.start()
+    uids = seed_mailbox(imap, args.messages, args.unique_share)
+
+    openai = FakeOpenAI(args.openai_latency, args.openai_token_delay, args.openai_tokens)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='fake-openai', daemon=True).start()
+    runner, openai_url = asyncio.run_coroutine_threadsafe(start_openai(openai), loop).result()
+
+    log_dir = tempfile.mkdtemp(prefix='bench-similarity-')
+    results = {}
+    try:
+        # Every run starts a fresh service, its caches live in memory
+        for name, reuse, adapt in (('baseline', 0, 0), ('similarity', args.reuse_threshold, args.adapt_threshold)):
+            process, url = start_webservice(args, imap, openai_url, log_dir, name, reuse, adapt)
+            try:
+                results[name] = asyncio.run(suggest_all(args, url, process, uids, openai))
+            finally:
+                process.terminate()
+                process.wait(10)
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        imap.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{len(uids)} emails, {args.unique_share:.0%} unique, service logs in {log_dir}")
+    for name, run in results.items():
+        similarity = run['similarity']
+        print(f"{name:<11} {run['seconds']:>8}s  {run['openai_requests']:>4} OpenAI calls  {run['prompt_chars']:>8} prompt chars  "
+              f"reused={similarity['reused']} adapted={similarity['adapted']} full={similarity['full']}  errors={run['errors']}")
+    similarity = results['similarity']['similarity']
+    print(f"hit rate {similarity['hit_rate']:.0%}, {similarity['tokens_saved']} prompt tokens and about "
+          f"{similarity['seconds_saved']}s saved by the service's own estimate, "
+          f"{results['baseline']['seconds'] / results['similarity']['seconds']:.1f}x faster end to end")
+
+
+if __name__ == '__main__':
+    main()
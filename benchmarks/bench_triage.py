@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+from bench_e2e import WEBSERVICE_DIR, free_port, wait_ready
+from fake_openai import FakeOpenAI, start_server as start_openai
+from imap_server import DEFAULT_MIX, FakeIMAPServer, seed_mailbox
+
+
+def start_webservice(args, imap, openai_url, log_dir):
+    port = free_port()
+    env = {key: value for key, value in os.environ.items() if not key.startswith(('IMAP_', 'OPENAI_'))}
+    env.update({
+        'IMAP_HOST': '127.0.0.1',
+        'IMAP_PORT': str(imap.port),
+        'IMAP_USER': imap.user,
+        'IMAP_PASS': imap.password,
+        'IMAP_SSL': '0',
+        'PORT': str(port),
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_url,
+        'OPENAI_TPM': str(args.tpm),
+        'SERVER_MODE': args.server_mode,
+        'TRIAGE_CONCURRENCY': str(args.triage_concurrency),
+        'MIRROR_SYNC_INTERVAL': '0',
+    })
+    log = open(os.path.join(log_dir, 'webservice.log'), 'wb')
+    process = subprocess.Popen([sys.executable, 'serve.py'], cwd=WEBSERVICE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f'http://127.0.0.1:{port}'
+
+
+async def one_by_one(session, url, uids, context):
+    """The old way: one /suggest-answer per email, each waiting for the previous one."""
+    started = time.perf_counter()
+    errors = 0
+    for uid in uids:
+        async with session.post(f'{url}/suggest-answer', json={'uid': uid, 'context': context}) as response:
+            data = await response.json()
+        errors += data.get('status') != 'success'
+    return {'seconds': round(time.perf_counter() - started, 3), 'errors': errors}
+
+
+async def triage(session, url, context):
+    """One /triage over all unseen emails, timing each streamed result."""
+    started = time.perf_counter()
+    arrivals = []
+    errors = 0
+    total = None
+    async with session.post(f'{url}/triage', json={'context': context}) as response:
+        async for line in response.content:
+            if not line.startswith(b'data: '):
+                continue
+            event = json.loads(line[6:])
+            if 'total' in event:
+                total = event['total']
+            elif 'uid' in event:
+                arrivals.append(time.perf_counter() - started)
+                errors += event.get('status') != 'success'
+    return {
+        'seconds': round(time.perf_counter() - started, 3),
+        'emails': total,
+        'results': len(arrivals),
+        'first_result_seconds': round(arrivals[0], 3) if arrivals else None,
+        'errors': errors,
+    }
+
+
+async def run(args, imap, uids, url, process):
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.request_timeout)) as session:
+        await wait_ready(session, [f'{url}/pool-stats'], [process])
+        # Unique contexts so neither run is answered from the response cache
+        run_id = time.time_ns()
+        commands = imap.stats['commands']
+        sequential = await one_by_one(session, url, uids, f'Einzeln {run_id}')
+        sequential['imap_commands'] = imap.stats['commands'] - commands
+        commands = imap.stats['commands']
+        triaged = await triage(session, url, f'Triage {run_id}')
+        triaged['imap_commands'] = imap.stats['commands'] - commands
+        async with session.get(f'{url}/budget-stats') as response:
+            budget = (await response.json())['budget']
+    return {'one_by_one': sequential, 'triage': triaged, 'budget': budget}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Suggestions for a backlog of unseen emails: one /suggest-answer after the other versus one /triage')
+    parser.add_argument('--messages', type=int, default=200, help='Emails seeded into INBOX, about half of them unseen')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--same-text', action='store_true', help='Seed every email with the same body text, triage then asks OpenAI once')
+    parser.add_argument('--server-mode', choices=('dev', 'asgi', 'prefork'), default='dev')
+    parser.add_argument('--triage-concurrency', type=int, default=8)
+    parser.add_argument('--tpm', type=int, default=0, help='OPENAI_TPM of the webservice, 0 for no budget')
+    parser.add_argument('--imap-latency', type=float, default=0.005)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-token-delay', type=float, default=0.01)
+    parser.add_argument('--openai-tokens', type=int, default=60)
+    parser.add_argument('--request-timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    imap = FakeIMAPServer(latency=args.imap_latency)
+    seed_mailbox(imap, args.messages, args.mix, distinct_text=not args.same_text)
+    imap.port = imap.start()
+    uids = [str(uid) for uid, message in imap.mailboxes['INBOX'].messages.items() if '\\Seen' not in message.flags]
+
+    openai = FakeOpenAI(args.openai_latency, args.openai_token_delay, args.openai_tokens)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='fake-openai', daemon=True).start()
+    runner, openai_url = asyncio.run_coroutine_threadsafe(start_openai(openai), loop).result()
+
+    log_dir = tempfile.mkdtemp(prefix='bench-triage-')
+    process, url = start_webservice(args, imap, openai_url, log_dir)
+    try:
+        results = asyncio.run(run(args, imap, uids, url, process))
+    finally:
+        process.terminate()
+        process.wait(10)
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        imap.stop()
+    results['openai_max_in_flight'] = openai.stats['max_in_flight']
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    sequential, triaged = results['one_by_one'], results['triage']
+    print(f"{len(uids)} unseen emails, service log in {log_dir}")
+    print(f"one by one  {sequential['seconds']:>8}s  {sequential['imap_commands']:>5} IMAP commands  errors={sequential['errors']}")
+    print(f"triage      {triaged['seconds']:>8}s  {triaged['imap_commands']:>5} IMAP commands  errors={triaged['errors']}  "
+          f"first result after {triaged['first_result_seconds']}s")
+    print(f"speedup     {sequential['seconds'] / triaged['seconds']:.1f}x, "
+          f"at most {results['openai_max_in_flight']} OpenAI calls in flight, budget waits {results['budget']['waits']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+
+class FakeDiscord:
+    """
+    Minimal Discord REST API: GET/PATCH/POST channel messages with a shared per-channel
+    bucket and a global limit, answering 429 with retry_after like the real API.
+    Every answer is delayed by latency seconds.
+    """
+
+    def __init__(self, bucket_limit, bucket_window, global_limit, latency=0.0):
+        self.latency = latency
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.global_limit = global_limit
+        self.messages = {}
+        self.buckets = {}  # (route, channel) -> [window_end, used]
+        self.global_window = [0.0, 0]
+        self.stats = {'requests': 0, 'patches': 0, 'rate_limited': 0}
+
+    def _take(self, route, channel_id):
+        now = time.monotonic()
+        if now >= self.global_window[0]:
+            self.global_window = [now + 1.0, 0]
+        if self.global_window[1] >= self.global_limit:
+            return {'retry_after': self.global_window[0] - now, 'global': True}, {'X-RateLimit-Global': 'true'}
+        self.global_window[1] += 1
+
+        bucket = self.buckets.get((route, channel_id))
+        if bucket is None or now >= bucket[0]:
+            bucket = self.buckets[(route, channel_id)] = [now + self.bucket_window, 0]
+        headers = {
+            'X-RateLimit-Bucket': f'{route}-hash',
+            'X-RateLimit-Limit': str(self.bucket_limit),
+            'X-RateLimit-Reset-After': f'{bucket[0] - now:.3f}',
+        }
+        if bucket[1] >= self.bucket_limit:
+            headers['X-RateLimit-Remaining'] = '0'
+            return {'retry_after': bucket[0] - now, 'global': False}, headers
+        bucket[1] += 1
+        headers['X-RateLimit-Remaining'] = str(self.bucket_limit - bucket[1])
+        return None, headers
+
+    async def handle(self, request):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        channel_id = request.match_info['channel_id']
+        route = request.method
+        limited, headers = self._take(route, channel_id)
+        if limited:
+            self.stats['rate_limited'] += 1
+            return web.json_response({'message': 'You are being rate limited.', **limited}, status=429, headers=headers)
+
+        message_id = request.match_info.get('message_id')
+        if request.method == 'GET':
+            return web.json_response(self.messages.setdefault(message_id, {'id': message_id, 'content': '', 'components': []}), headers=headers)
+        payload = await request.json()
+        if request.method == 'POST':
+            message_id = str(len(self.messages) + 1)
+        else:
+            self.stats['patches'] += 1
+        message = self.messages.setdefault(message_id, {'id': message_id, 'content': '', 'components': []})
+        message.update(payload)
+        return web.json_response(message, headers=headers)
+
+
+async def start_server(fake):
+    server = web.Application()
+    server.router.add_route('*', '/channels/{channel_id}/messages', fake.handle)
+    server.router.add_route('*', '/channels/{channel_id}/messages/{message_id}', fake.handle)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
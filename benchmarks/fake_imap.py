@@ -0,0 +1,143 @@
+import email
+import os
+import re
+from email.message import EmailMessage
+from email.utils import make_msgid, formatdate
+
+SECTION_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\]', re.IGNORECASE)
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
+def build_message(text_size=2000, attachments=(), html_only=False, subject='Anfrage', sender='kunde@example.com', text_prefix=''):
+    """
+    Build a synthetic email.
+
+    Parameters:
+    text_size (int): Characters of body text
+    attachments (iterable): (filename, size_in_bytes, mime_type) tuples
+    html_only (bool): Send the body as text/html without a text/plain alternative
+    text_prefix (str): Put in front of the body text, e.g. to tell otherwise equal emails apart
+
+    Returns:
+    bytes: The RFC822 message
+    """
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = 'info@example.com'
+    message['Subject'] = subject
+    message['Date'] = formatdate(localtime=True)
+    message['Message-ID'] = make_msgid(domain='example.com')
+
+    sentence = 'Guten Tag, wir haben eine Frage zu unserem Projekt und bitten um Rückmeldung. '
+    text = (text_prefix + sentence * (text_size // len(sentence) + 1))[:text_size]
+    if html_only:
+        message.set_content(f'<html><body><p>{text}</p></body></html>', subtype='html')
+    else:
+        message.set_content(text)
+    for filename, size, mime_type in attachments:
+        maintype, subtype = mime_type.split('/')
+        message.add_attachment(os.urandom(size), maintype=maintype, subtype=subtype, filename=filename)
+    return message.as_bytes()
+
+
+def _quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _params(part):
+    params = part.get_params()
+    if not params or len(params) < 2:
+        return 'NIL'
+    return '(' + ' '.join(f'{_quote(name.upper())} {_quote(value)}' for name, value in params[1:]) + ')'
+
+
+def _disposition(part):
+    disposition = part.get_content_disposition()
+    if not disposition:
+        return 'NIL'
+    filename = part.get_filename()
+    params = f'("FILENAME" {_quote(filename)})' if filename else 'NIL'
+    return f'({_quote(disposition.upper())} {params})'
+
+
+def bodystructure(part):
+    """Render the BODYSTRUCTURE of a parsed message the way an IMAP server would."""
+    if part.is_multipart():
+        children = ''.join(bodystructure(child) for child in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype().upper())} {_params(part)} NIL NIL NIL)'
+
+    payload = part.get_payload()
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+    encoding = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+    fields = (f'{_quote(part.get_content_maintype().upper())} {_quote(part.get_content_subtype().upper())} '
+              f'{_params(part)} NIL NIL {_quote(encoding)} {size}')
+    if part.get_content_maintype() == 'text':
+        lines = payload.count('\n') if isinstance(payload, str) else 0
+        return f'({fields} {lines} NIL {_disposition(part)} NIL NIL)'
+    return f'({fields} NIL {_disposition(part)} NIL NIL)'
+
+
+def _section(message, section):
+    """Raw bytes of a body section ('HEADER', '', '1', '1.2', ...)."""
+    if section == '':
+        return message['raw']
+    if section.upper() == 'HEADER':
+        match = HEADER_END_RE.search(message['raw'])
+        return message['raw'][:match.end()] if match else message['raw']
+    part = message['parsed']
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif number != '1':
+            return b''
+    payload = part.get_payload()
+    return payload.encode() if isinstance(payload, str) else payload
+
+
+class FakeIMAPSession:
+    """
+    In-process stand-in for an imaplib session with one selected mailbox.
+
+    Only UID FETCH is implemented, enough to compare fetch strategies. bytes_sent counts what a
+    real server would have put on the wire for literals and BODYSTRUCTURE responses.
+    """
+
+    def __init__(self, messages):
+        self.messages = {}
+        for uid, raw in enumerate(messages, start=1):
+            parsed = email.message_from_bytes(raw)
+            self.messages[uid] = {'raw': raw, 'parsed': parsed, 'bodystructure': bodystructure(parsed)}
+        self.bytes_sent = 0
+        self.commands = 0
+
+    def uid(self, command, uid, items):
+        if command.upper() != 'FETCH':
+            raise NotImplementedError(command)
+        self.commands += 1
+        message = self.messages.get(int(uid))
+        if message is None:
+            return 'OK', [None]
+
+        response = []
+        line = f'{uid} (UID {uid}'
+        names = items.strip('()')
+        if 'BODYSTRUCTURE' in names.upper():
+            line += f" BODYSTRUCTURE {message['bodystructure']}"
+        if 'RFC822' in names.upper().split():
+            literal = message['raw']
+            response.append((f'{line} RFC822 {{{len(literal)}}}'.encode(), literal))
+            self.bytes_sent += len(literal)
+            line = ''
+        for section in SECTION_RE.findall(names):
+            literal = _section(message, section)
+            response.append((f'{line} BODY[{section}] {{{len(literal)}}}'.encode(), literal))
+            self.bytes_sent += len(literal)
+            line = ''
+        if line:
+            response.append(f'{line})'.encode())
+        else:
+            response.append(b')')
+        self.bytes_sent += sum(len(item[0]) if isinstance(item, tuple) else len(item) for item in response)
+        return 'OK', response
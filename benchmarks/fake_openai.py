@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+REPLY = ('Sehr geehrte Damen und Herren, vielen Dank für Ihre Nachricht. Wir haben Ihre Anfrage erhalten '
+         'und melden uns bis Ende der Woche mit einem Angebot. Mit freundlichen Grüßen, Ihr Team')
+
+
+class FakeOpenAI:
+    """
+    Chat Completions endpoint with configurable latency, plain and streamed.
+
+    The first token arrives after first_token_latency seconds, every further one after
+    token_delay seconds, so a reply of tokens tokens takes about as long as a real one.
+
+    Parameters:
+    first_token_latency (float): Seconds before the first token
+    token_delay (float): Seconds between tokens
+    tokens (int): Tokens per reply
+    """
+
+    def __init__(self, first_token_latency=0.5, token_delay=0.02, tokens=60):
+        self.first_token_latency = first_token_latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.stats = {'requests': 0, 'streamed': 0, 'in_flight': 0, 'max_in_flight': 0, 'prompt_chars': 0}
+
+    def reply_tokens(self):
+        words = REPLY.split(' ')
+        return [(' ' if n else '') + words[n % len(words)] for n in range(self.tokens)]
+
+    def _chunk(self, completion_id, model, delta, finish_reason=None):
+        return {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+
+    def _usage(self, tokens):
+        return {'prompt_tokens': 500, 'completion_tokens': len(tokens), 'total_tokens': 500 + len(tokens)}
+
+    async def handle(self, request):
+        body = await request.json()
+        model = body.get('model', 'gpt-4')
+        completion_id = f"chatcmpl-{self.stats['requests']}"
+        self.stats['requests'] += 1
+        self.stats['prompt_chars'] += sum(len(message.get('content') or '') for message in body.get('messages', []))
+        self.stats['in_flight'] += 1
+        self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            await asyncio.sleep(self.first_token_latency)
+            tokens = self.reply_tokens()
+            if not body.get('stream'):
+                await asyncio.sleep(self.token_delay * (len(tokens) - 1))
+                return web.json_response({
+                    'id': completion_id,
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}],
+                    'usage': self._usage(tokens),
+                })
+
+            self.stats['streamed'] += 1
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            await response.write(f"data: {json.dumps(self._chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n".encode())
+            for n, token in enumerate(tokens):
+                if n:
+                    await asyncio.sleep(self.token_delay)
+                await response.write(f"data: {json.dumps(self._chunk(completion_id, model, {'content': token}))}\n\n".encode())
+            await response.write(f"data: {json.dumps(self._chunk(completion_id, model, {}, 'stop'))}\n\n".encode())
+            if (body.get('stream_options') or {}).get('include_usage'):
+                usage = dict(self._chunk(completion_id, model, {}), choices=[], usage=self._usage(tokens))
+                await response.write(f"data: {json.dumps(usage)}\n\n".encode())
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        finally:
+            self.stats['in_flight'] -= 1
+
+
+async def start_server(fake):
+    server = web.Application()
+    server.router.add_post('/v1/chat/completions', fake.handle)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/v1'
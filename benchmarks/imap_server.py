@@ -0,0 +1,727 @@
+import argparse
+import email
+import random
+import re
+import socketserver
+import threading
+import time
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+
+from fake_imap import HEADER_END_RE, _quote, _section, bodystructure, build_message
+
+CAPABILITIES = 'IMAP4rev1 LITERAL+ IDLE UIDPLUS MOVE ENABLE CONDSTORE QRESYNC SPECIAL-USE'
+
+# Attachment mix profiles -> build_message() keyword arguments
+ATTACHMENT_PROFILES = {
+    'text': {},
+    'html': {'html_only': True},
+    'pdf': {'attachments': [('angebot.pdf', 200_000, 'application/pdf')]},
+    'images': {'attachments': [('foto1.jpg', 400_000, 'image/jpeg'), ('foto2.jpg', 400_000, 'image/jpeg')]},
+}
+DEFAULT_MIX = 'text:70,html:15,pdf:10,images:5'
+
+# Special-use attributes of the mailboxes every seeded account has
+DEFAULT_MAILBOXES = {'INBOX': None, 'Drafts': '\\Drafts', 'Sent': '\\Sent', 'Trash': '\\Trash'}
+
+SECTION_ITEM_RE = re.compile(r'^BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?$', re.I)
+LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}\r\n$')
+
+
+class StoredMessage:
+    def __init__(self, uid, raw, flags, modseq):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags)
+        self.modseq = modseq
+        self.internaldate = time.time()
+        self._parsed = None
+        self._headers = None
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.raw)
+        return self._parsed
+
+    def header(self, name):
+        # SEARCH and ENVELOPE only need the header, do not parse attachments for them
+        if self._headers is None:
+            self._headers = BytesHeaderParser().parsebytes(self.raw)
+        return str(self._headers.get(name) or '')
+
+
+class Mailbox:
+    def __init__(self, name, special_use=None, uidvalidity=None):
+        self.name = name
+        self.special_use = special_use
+        self.uidvalidity = uidvalidity or int(time.time())
+        self.next_uid = 1
+        self.messages = {}  # uid -> StoredMessage, insertion order is UID order
+        self.expunged = []  # (uid, modseq) for VANISHED (EARLIER)
+        self.idlers = set()
+
+    def uids(self):
+        return list(self.messages)
+
+    def resolve(self, sequence_set, by_uid):
+        """Members of a sequence set as UIDs, in mailbox order."""
+        uids = self.uids()
+        if not uids:
+            return []
+        top = uids[-1] if by_uid else len(uids)
+        wanted = set()
+        for part in sequence_set.split(','):
+            first, _, last = part.partition(':')
+            first = top if first == '*' else int(first)
+            last = first if not last else (top if last == '*' else int(last))
+            low, high = min(first, last), max(first, last)
+            if by_uid:
+                wanted.update(uid for uid in uids if low <= uid <= high)
+            else:
+                wanted.update(uids[n - 1] for n in range(max(low, 1), min(high, len(uids)) + 1))
+        return [uid for uid in uids if uid in wanted]
+
+
+class FakeIMAPServer:
+    """
+    Threaded IMAP server on 127.0.0.1 for benchmarks, plain TCP, one account.
+
+    Implements what the webservice, the mailbox mirror and the IDLE ingest use: LOGIN, ENABLE,
+    SELECT/EXAMINE, LIST with SPECIAL-USE, STATUS, APPEND, IDLE and (UID) SEARCH, FETCH, STORE,
+    COPY, MOVE and EXPUNGE, with CONDSTORE/QRESYNC mod-sequences. Every response is delayed by
+    latency seconds to stand in for the network round trip to a real server.
+
+    Parameters:
+    user (str): Login user
+    password (str): Login password
+    latency (float): Seconds added before every tagged response
+    capabilities (str): CAPABILITY line, drop CONDSTORE/QRESYNC to exercise the fallbacks
+    """
+
+    def __init__(self, user='bench', password='bench', latency=0.0, capabilities=CAPABILITIES):
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.capabilities = capabilities
+        self.lock = threading.RLock()
+        self.modseq = 1
+        self.mailboxes = {name: Mailbox(name, special_use) for name, special_use in DEFAULT_MAILBOXES.items()}
+        self.stats = {'connections': 0, 'commands': 0, 'bytes_sent': 0}
+        self._server = None
+
+    def _next_modseq(self):
+        self.modseq += 1
+        return self.modseq
+
+    def add_message(self, mailbox, raw, flags=()):
+        """Deliver a message, waking IDLE sessions on the mailbox. Returns the new UID."""
+        with self.lock:
+            box = self.mailboxes[mailbox]
+            uid = box.next_uid
+            box.next_uid += 1
+            box.messages[uid] = StoredMessage(uid, raw, flags, self._next_modseq())
+            exists = len(box.messages)
+            idlers = list(box.idlers)
+        for handler in idlers:
+            handler.push(f'* {exists} EXISTS')
+        return uid
+
+    def expunge(self, mailbox, uids):
+        """Remove UIDs, returning their sequence numbers (highest first, as EXPUNGE responses need)."""
+        with self.lock:
+            box = self.mailboxes[mailbox]
+            order = box.uids()
+            numbers = []
+            for uid in uids:
+                if uid in box.messages:
+                    numbers.append(order.index(uid) + 1)
+                    del box.messages[uid]
+                    box.expunged.append((uid, self._next_modseq()))
+            return sorted(numbers, reverse=True)
+
+    def start(self, port=0):
+        server = self
+
+        class Handler(IMAPHandler):
+            imap = server
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-imap', daemon=True).start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def seed_mailbox(server, count, mix=DEFAULT_MIX, mailbox='INBOX', seed=1, senders=50, text_size=2000, distinct_text=False):
+    """
+    Fill a mailbox with synthetic emails.
+
+    Parameters:
+    count (int): Number of emails
+    mix (str): Attachment profiles with weights, e.g. 'text:70,html:15,pdf:10,images:5'
+    senders (int): Number of distinct sender addresses
+    distinct_text (bool): Give every email its own body text instead of the same one
+
+    Returns:
+    list: (uid, message_id) per email
+    """
+    profiles, weights = [], []
+    for entry in mix.split(','):
+        name, _, weight = entry.partition(':')
+        profiles.append(ATTACHMENT_PROFILES[name.strip()])
+        weights.append(float(weight or 1))
+    rng = random.Random(seed)
+    seeded = []
+    for n in range(count):
+        profile = rng.choices(profiles, weights)[0]
+        raw = build_message(
+            text_size=text_size,
+            subject=f'Anfrage {n} zu Projekt {n % 17}',
+            sender=f'Kunde {n % senders} <kunde{n % senders}@example.com>',
+            text_prefix=f'Anfrage {n}: ' if distinct_text else '',
+            **profile
+        )
+        flags = ['\\Seen'] if rng.random() < 0.5 else []
+        uid = server.add_message(mailbox, raw, flags)
+        seeded.append((uid, BytesHeaderParser().parsebytes(raw)['Message-ID']))
+    return seeded
+
+
+def _tokenize(data):
+    """Split a command line into atoms, quoted strings, literals (bytes) and nested lists."""
+    stack = [[]]
+    i = 0
+    while i < len(data):
+        item = data[i]
+        if isinstance(item, bytes):
+            stack[-1].append(item)
+            i += 1
+            continue
+        char = item
+        if char == ' ':
+            i += 1
+        elif char == '(':
+            stack.append([])
+            i += 1
+        elif char == ')':
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+            i += 1
+        elif char == '"':
+            i += 1
+            value = []
+            while i < len(data) and data[i] != '"':
+                if data[i] == '\\':
+                    i += 1
+                value.append(data[i])
+                i += 1
+            i += 1
+            stack[-1].append(''.join(value))
+        else:
+            start = i
+            depth = 0
+            while i < len(data) and not isinstance(data[i], bytes):
+                char = data[i]
+                if char == '[':
+                    depth += 1
+                elif char == ']':
+                    depth -= 1
+                elif depth == 0 and char in ' ()':
+                    break
+                i += 1
+            stack[-1].append(''.join(data[start:i]))
+    return stack[0]
+
+
+def _envelope_addresses(value):
+    if not value:
+        return 'NIL'
+    addresses = []
+    for name, address in getaddresses([value]):
+        mailbox, _, host = address.partition('@')
+        addresses.append(f'({_quote(name) if name else "NIL"} NIL {_quote(mailbox)} {_quote(host) if host else "NIL"})')
+    return f"({''.join(addresses)})"
+
+
+def envelope(message):
+    header = message.header
+    fields = [_quote(header('Date') or None), _quote(header('Subject') or None)]
+    sender = _envelope_addresses(header('From'))
+    fields += [sender, sender, sender]
+    fields += [_envelope_addresses(header(name)) for name in ('To', 'Cc', 'Bcc')]
+    fields += [_quote(header('In-Reply-To') or None), _quote(header('Message-ID') or None)]
+    return f"({' '.join(fields)})"
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    imap = None
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.authenticated = False
+        self.selected = None
+        self.readonly = True
+        self.qresync = False
+        with self.imap.lock:
+            self.imap.stats['connections'] += 1
+
+    def push(self, line):
+        self.send([line])
+
+    def send(self, lines):
+        data = b''.join(line if isinstance(line, bytes) else line.encode() + b'\r\n' for line in lines)
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+        with self.imap.lock:
+            self.imap.stats['bytes_sent'] += len(data)
+
+    def read_command(self):
+        """One command with its literals, as a list of characters and literal bytes."""
+        parts = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            match = LITERAL_RE.search(line)
+            if not match:
+                parts.extend(line.rstrip(b'\r\n').decode('utf-8', 'replace'))
+                return parts
+            parts.extend(line[:match.start()].decode('utf-8', 'replace'))
+            if not match.group(2):
+                self.send(['+ Ready for literal'])
+            parts.append(self.rfile.read(int(match.group(1))))
+
+    def handle(self):
+        self.send(['* OK [CAPABILITY ' + self.imap.capabilities + '] Fake IMAP ready'])
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            tokens = _tokenize(command)
+            if len(tokens) < 2:
+                self.send(['* BAD Empty command'])
+                continue
+            tag, name, args = tokens[0], str(tokens[1]).upper(), tokens[2:]
+            with self.imap.lock:
+                self.imap.stats['commands'] += 1
+            if self.imap.latency:
+                time.sleep(self.imap.latency)
+            try:
+                if name == 'UID':
+                    name, by_uid, args = 'UID ' + str(args[0]).upper(), True, args[1:]
+                else:
+                    by_uid = False
+                method = getattr(self, 'do_' + name.replace(' ', '_').lower(), None)
+                if method is None:
+                    self.send([f'{tag} BAD Unknown command {name}'])
+                    continue
+                if name not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP') and not self.authenticated:
+                    self.send([f'{tag} NO Not logged in'])
+                    continue
+                lines, status = method(args, by_uid) if name.startswith('UID ') or name in ('FETCH', 'SEARCH', 'STORE', 'COPY', 'MOVE') else method(args)
+                if status is None:
+                    return
+                self.send(lines + [f'{tag} {status}'])
+            except (IndexError, KeyError, TypeError, ValueError) as e:
+                self.send([f'{tag} BAD {type(e).__name__}: {e}'])
+
+    # Session
+
+    def do_capability(self, args):
+        return [f'* CAPABILITY {self.imap.capabilities}'], 'OK CAPABILITY completed'
+
+    def do_noop(self, args):
+        return self._pending(), 'OK NOOP completed'
+
+    def do_check(self, args):
+        return [], 'OK CHECK completed'
+
+    def do_logout(self, args):
+        self.send(['* BYE Logging out'])
+        return [], 'OK LOGOUT completed'
+
+    def do_login(self, args):
+        if len(args) < 2 or args[0] != self.imap.user or args[1] != self.imap.password:
+            return [], 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        self.authenticated = True
+        return [], f'OK [CAPABILITY {self.imap.capabilities}] Logged in'
+
+    def do_enable(self, args):
+        enabled = [str(arg).upper() for arg in args if str(arg).upper() in ('CONDSTORE', 'QRESYNC')]
+        if 'QRESYNC' in enabled:
+            self.qresync = True
+        return ([f"* ENABLED {' '.join(enabled)}"] if enabled else []), 'OK ENABLE completed'
+
+    def _pending(self):
+        return []
+
+    # Mailboxes
+
+    def _mailbox(self, name):
+        name = str(name)
+        return self.imap.mailboxes.get('INBOX' if name.upper() == 'INBOX' else name)
+
+    def do_select(self, args, readonly=False):
+        box = self._mailbox(args[0])
+        self._leave()
+        if box is None:
+            return [], 'NO Mailbox does not exist'
+        self.selected = box
+        self.readonly = readonly
+        with self.imap.lock:
+            lines = [
+                '* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)',
+                f'* {len(box.messages)} EXISTS',
+                '* 0 RECENT',
+                f'* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid',
+                f'* OK [UIDNEXT {box.next_uid}] Predicted next UID',
+            ]
+            if 'CONDSTORE' in self.imap.capabilities:
+                lines.append(f'* OK [HIGHESTMODSEQ {self.imap.modseq}] Highest')
+        return lines, f"OK [{'READ-ONLY' if readonly else 'READ-WRITE'}] Selected"
+
+    def do_examine(self, args):
+        return self.do_select(args, readonly=True)
+
+    def _leave(self):
+        if self.selected is not None:
+            with self.imap.lock:
+                self.selected.idlers.discard(self)
+        self.selected = None
+
+    def do_close(self, args):
+        if self.selected is not None and not self.readonly:
+            deleted = [uid for uid, message in self.selected.messages.items() if '\\Deleted' in message.flags]
+            self.imap.expunge(self.selected.name, deleted)
+        self._leave()
+        return [], 'OK CLOSE completed'
+
+    def do_unselect(self, args):
+        self._leave()
+        return [], 'OK UNSELECT completed'
+
+    def do_list(self, args):
+        pattern = str(args[1]) if len(args) > 1 else '*'
+        regex = re.compile('^' + re.escape(pattern).replace('\\*', '.*').replace('%', '[^/]*') + '$')
+        lines = []
+        for name, box in self.imap.mailboxes.items():
+            if regex.match(name):
+                attributes = ['\\HasNoChildren'] + ([box.special_use] if box.special_use else [])
+                lines.append(f"* LIST ({' '.join(attributes)}) \"/\" {_quote(name)}")
+        return lines, 'OK LIST completed'
+
+    def do_status(self, args):
+        box = self._mailbox(args[0])
+        if box is None:
+            return [], 'NO Mailbox does not exist'
+        with self.imap.lock:
+            values = {
+                'MESSAGES': len(box.messages),
+                'UIDNEXT': box.next_uid,
+                'UIDVALIDITY': box.uidvalidity,
+                'UNSEEN': sum(1 for message in box.messages.values() if '\\Seen' not in message.flags),
+                'RECENT': 0,
+                'HIGHESTMODSEQ': self.imap.modseq,
+            }
+        items = ' '.join(f'{item} {values[str(item).upper()]}' for item in args[1] if str(item).upper() in values)
+        return [f'* STATUS {_quote(box.name)} ({items})'], 'OK STATUS completed'
+
+    def do_create(self, args):
+        name = str(args[0])
+        with self.imap.lock:
+            if name in self.imap.mailboxes:
+                return [], 'NO [ALREADYEXISTS] Mailbox exists'
+            self.imap.mailboxes[name] = Mailbox(name)
+        return [], 'OK CREATE completed'
+
+    def do_append(self, args):
+        box = self._mailbox(args[0])
+        if box is None:
+            return [], 'NO [TRYCREATE] Mailbox does not exist'
+        flags = next((arg for arg in args[1:] if isinstance(arg, list)), [])
+        raw = next(arg for arg in args[1:] if isinstance(arg, bytes))
+        uid = self.imap.add_message(box.name, raw, flags)
+        return [], f'OK [APPENDUID {box.uidvalidity} {uid}] APPEND completed'
+
+    def do_idle(self, args):
+        box = self.selected
+        if box is not None:
+            with self.imap.lock:
+                box.idlers.add(self)
+        self.send(['+ idling'])
+        line = self.rfile.readline()
+        if box is not None:
+            with self.imap.lock:
+                box.idlers.discard(self)
+        if not line:
+            return [], None
+        return [], 'OK IDLE terminated'
+
+    # Messages of the selected mailbox
+
+    def _require_selected(self):
+        if self.selected is None:
+            raise ValueError('No mailbox selected')
+        return self.selected
+
+    def _matches(self, message, criteria):
+        i = 0
+        while i < len(criteria):
+            key = str(criteria[i]).upper()
+            i += 1
+            if key == 'ALL':
+                continue
+            if key == 'UID':
+                # Resolved to a set once per SEARCH by do_uid_search
+                if message.uid not in criteria[i]:
+                    return False
+                i += 1
+            elif key == 'HEADER':
+                name, value = str(criteria[i]), str(criteria[i + 1])
+                i += 2
+                if value.lower() not in message.header(name).lower():
+                    return False
+            elif key in ('FROM', 'SUBJECT', 'TO'):
+                if str(criteria[i]).lower() not in message.header(key.capitalize()).lower():
+                    return False
+                i += 1
+            elif key in ('SEEN', 'UNSEEN', 'FLAGGED', 'UNFLAGGED', 'DELETED', 'UNDELETED'):
+                negated = key.startswith('UN')
+                flag = '\\' + (key[2:] if negated else key).capitalize()
+                if (flag in message.flags) == negated:
+                    return False
+            elif isinstance(criteria[i - 1], list):
+                if not self._matches(message, criteria[i - 1]):
+                    return False
+            else:
+                raise ValueError(f'Unsupported search key {key}')
+        return True
+
+    def do_uid_search(self, args, by_uid=True):
+        box = self._require_selected()
+        if args and str(args[0]).upper() == 'CHARSET':
+            args = args[2:]
+        with self.imap.lock:
+            uids = box.uids()
+            args = list(args)
+            for i in range(len(args) - 1):
+                if str(args[i]).upper() == 'UID':
+                    args[i + 1] = set(box.resolve(str(args[i + 1]), True))
+            hits = [uid for uid in uids if self._matches(box.messages[uid], args)]
+            numbers = hits if by_uid else [uids.index(uid) + 1 for uid in hits]
+        return [' '.join(['* SEARCH'] + [str(number) for number in numbers])], 'OK SEARCH completed'
+
+    do_search = do_uid_search
+
+    def _fetch_item(self, message, item, peek_only):
+        """Returns (text, literal_bytes or None, sets_seen)."""
+        name = str(item).upper()
+        if name == 'UID':
+            return f'UID {message.uid}', None, False
+        if name == 'FLAGS':
+            return f"FLAGS ({' '.join(sorted(message.flags))})", None, False
+        if name == 'MODSEQ':
+            return f'MODSEQ ({message.modseq})', None, False
+        if name == 'INTERNALDATE':
+            return f'INTERNALDATE "{time.strftime("%d-%b-%Y %H:%M:%S +0000", time.gmtime(message.internaldate))}"', None, False
+        if name == 'RFC822.SIZE':
+            return f'RFC822.SIZE {len(message.raw)}', None, False
+        if name == 'ENVELOPE':
+            return f'ENVELOPE {envelope(message)}', None, False
+        if name in ('BODYSTRUCTURE', 'BODY'):
+            return f'{name} {bodystructure(message.parsed)}', None, False
+        if name == 'RFC822':
+            return 'RFC822', message.raw, not peek_only
+        if name == 'RFC822.HEADER':
+            match = HEADER_END_RE.search(message.raw)
+            return 'RFC822.HEADER', message.raw[:match.end()] if match else message.raw, False
+        match = SECTION_ITEM_RE.match(str(item))
+        if match:
+            peek, section, offset, length = match.groups()
+            upper = section.upper()
+            if upper.startswith('HEADER.FIELDS'):
+                wanted = {field.upper() for field in re.findall(r'[\w-]+', section[section.index('(') + 1:])} if '(' in section else set()
+                negate = upper.startswith('HEADER.FIELDS.NOT')
+                lines = [f'{key}: {value}\r\n' for key, value in message.parsed.items() if (key.upper() in wanted) != negate]
+                data = (''.join(lines) + '\r\n').encode('utf-8', 'replace')
+            else:
+                # BODY[] and BODY[HEADER] are cut from the raw bytes, parsing a large email for them would dominate the timings
+                data = {'raw': message.raw, 'parsed': message.parsed if section and upper != 'HEADER' else None}
+                data = _section(data, section) if section.upper() != 'TEXT' else message.raw[HEADER_END_RE.search(message.raw).end():]
+            label = f'BODY[{section}]'
+            if offset is not None:
+                data = data[int(offset):int(offset) + int(length)]
+                label += f'<{offset}>'
+            return label, data, not peek and not peek_only
+        raise ValueError(f'Unsupported FETCH item {item}')
+
+    def do_uid_fetch(self, args, by_uid=True):
+        box = self._require_selected()
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        if len(items) == 1 and str(items[0]).upper() in ('ALL', 'FAST', 'FULL'):
+            items = ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'] + (['ENVELOPE'] if str(items[0]).upper() != 'FAST' else [])
+        if by_uid and not any(str(item).upper() == 'UID' for item in items):
+            items = ['UID'] + list(items)
+        changed_since, vanished = None, False
+        if len(args) > 2 and isinstance(args[2], list):
+            modifiers = [str(value).upper() for value in args[2]]
+            if 'CHANGEDSINCE' in modifiers:
+                changed_since = int(modifiers[modifiers.index('CHANGEDSINCE') + 1])
+                if 'MODSEQ' not in [str(item).upper() for item in items]:
+                    items = list(items) + ['MODSEQ']
+            vanished = 'VANISHED' in modifiers and self.qresync
+
+        lines = []
+        with self.imap.lock:
+            order = box.uids()
+            position = {uid: number for number, uid in enumerate(order, start=1)}
+            targets = box.resolve(str(args[0]), by_uid)
+            if vanished:
+                requested = str(args[0])
+                gone = [uid for uid, modseq in box.expunged if modseq > changed_since and uid not in box.messages]
+                top = order[-1] if order else 0
+                gone = [uid for uid in gone if any(_in_range(uid, part, top) for part in requested.split(','))]
+                if gone:
+                    lines.append(f"* VANISHED (EARLIER) {','.join(str(uid) for uid in gone)}")
+            for uid in targets:
+                message = box.messages[uid]
+                if changed_since is not None and message.modseq <= changed_since:
+                    continue
+                texts, literals = [], []
+                seen = False
+                for item in items:
+                    text, literal, sets_seen = self._fetch_item(message, item, self.readonly)
+                    seen = seen or sets_seen
+                    if literal is None:
+                        texts.append(text)
+                    else:
+                        literals.append((text, literal))
+                if seen and '\\Seen' not in message.flags:
+                    message.flags.add('\\Seen')
+                    message.modseq = self.imap._next_modseq()
+                    texts = [f"FLAGS ({' '.join(sorted(message.flags))})" if text.startswith('FLAGS ') else text for text in texts]
+                prefix = f'* {position[uid]} FETCH ({" ".join(texts)}'
+                if not literals:
+                    lines.append(prefix + ')')
+                    continue
+                chunk = prefix.encode()
+                for index, (text, literal) in enumerate(literals):
+                    separator = b' ' if (texts or index) else b''
+                    chunk += separator + f'{text} {{{len(literal)}}}\r\n'.encode() + literal
+                lines.append(chunk + b')\r\n')
+        return lines, 'OK FETCH completed'
+
+    do_fetch = do_uid_fetch
+
+    def do_uid_store(self, args, by_uid=True):
+        box = self._require_selected()
+        if self.readonly:
+            return [], 'NO Mailbox is read-only'
+        args = [arg for arg in args if not (isinstance(arg, list) and arg and str(arg[0]).upper() == 'UNCHANGEDSINCE')]
+        item = str(args[1]).upper()
+        flags = args[2] if isinstance(args[2], list) else args[2:]
+        flags = {str(flag) for flag in flags}
+        lines = []
+        with self.imap.lock:
+            position = {uid: number for number, uid in enumerate(box.uids(), start=1)}
+            for uid in box.resolve(str(args[0]), by_uid):
+                message = box.messages[uid]
+                if item.startswith('+'):
+                    message.flags |= flags
+                elif item.startswith('-'):
+                    message.flags -= flags
+                else:
+                    message.flags = set(flags)
+                message.modseq = self.imap._next_modseq()
+                if not item.endswith('.SILENT'):
+                    lines.append(f"* {position[uid]} FETCH (UID {uid} FLAGS ({' '.join(sorted(message.flags))}) MODSEQ ({message.modseq}))")
+        return lines, 'OK STORE completed'
+
+    do_store = do_uid_store
+
+    def _copy(self, args, by_uid):
+        box = self._require_selected()
+        destination = self._mailbox(args[1])
+        if destination is None:
+            return None, [], 'NO [TRYCREATE] Destination does not exist'
+        with self.imap.lock:
+            uids = box.resolve(str(args[0]), by_uid)
+            copied = [self.imap.add_message(destination.name, box.messages[uid].raw, box.messages[uid].flags) for uid in uids]
+        code = f"[COPYUID {destination.uidvalidity} {','.join(map(str, uids))} {','.join(map(str, copied))}] " if uids else ''
+        return uids, [], code
+
+    def do_uid_copy(self, args, by_uid=True):
+        uids, lines, code = self._copy(args, by_uid)
+        if uids is None:
+            return lines, code
+        return lines, f'OK {code}COPY completed'
+
+    do_copy = do_uid_copy
+
+    def _expunged_lines(self, uids):
+        numbers = self.imap.expunge(self.selected.name, uids)
+        if self.qresync:
+            return [f"* VANISHED {','.join(map(str, uids))}"] if uids else []
+        return [f'* {number} EXPUNGE' for number in numbers]
+
+    def do_uid_move(self, args, by_uid=True):
+        if self.readonly:
+            return [], 'NO Mailbox is read-only'
+        uids, lines, code = self._copy(args, by_uid)
+        if uids is None:
+            return lines, code
+        return [f'* OK {code}Moved'] + self._expunged_lines(uids), 'OK MOVE completed'
+
+    do_move = do_uid_move
+
+    def do_uid_expunge(self, args, by_uid=True):
+        box = self._require_selected()
+        with self.imap.lock:
+            uids = [uid for uid in box.resolve(str(args[0]), True) if '\\Deleted' in box.messages[uid].flags]
+        return self._expunged_lines(uids), 'OK EXPUNGE completed'
+
+    def do_expunge(self, args):
+        box = self._require_selected()
+        with self.imap.lock:
+            uids = [uid for uid, message in box.messages.items() if '\\Deleted' in message.flags]
+        return self._expunged_lines(uids), 'OK EXPUNGE completed'
+
+
+def _in_range(uid, part, top):
+    first, _, last = part.partition(':')
+    first = top if first == '*' else int(first)
+    last = first if not last else (top if last == '*' else int(last))
+    return min(first, last) <= uid <= max(first, last)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the fake IMAP server on its own, e.g. against a manually started webservice')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--messages', type=int, default=500, help='Emails seeded into INBOX')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Attachment profiles with weights')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--no-condstore', action='store_true', help='Advertise neither CONDSTORE nor QRESYNC')
+    args = parser.parse_args()
+
+    capabilities = CAPABILITIES.replace(' CONDSTORE QRESYNC', '') if args.no_condstore else CAPABILITIES
+    server = FakeIMAPServer(latency=args.latency, capabilities=capabilities)
+    seed_mailbox(server, args.messages, args.mix)
+    port = server.start(args.port)
+    print(f'Fake IMAP on 127.0.0.1:{port}, user {server.user} / {server.password}, {args.messages} emails in INBOX')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,11 @@ import os
 import discord
 from discord.ext import commands
 from discord import ui
-import requests
+import aiohttp
+import json
+import time
 # from flask import Flask, request, jsonify
-from quart import Quart, request, jsonify
+from quart import Quart, Response, request, jsonify
 from dotenv import load_dotenv
 import logging
 import multiprocessing
@@ -12,6 +14,10 @@ import sys
 import signal
 from functools import partial
 import asyncio
+from message_state import MessageStateCache
+from rest_scheduler import DiscordRestScheduler
+from webhook_queue import WebhookQueue
+from metrics import CONTENT_TYPE, phase_seconds, registry, request_seconds
 
 def handle_exception(loop, context):
     logging.error(f"Caught exception: {context['message']}")
@@ -30,10 +36,39 @@ DISCORD_API_KEY = os.getenv('DISCORD_API_KEY')
 DISCORD_CHANNEL_ID = int(os.getenv('DISCORD_CHANNEL_ID'))
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT2 = int(os.getenv('PORT2', 4210))
+WEBSERVICE_URL = os.getenv('WEBSERVICE_URL') or 'http://webservice:4200'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 15))
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 500))
+
+DISCORD_API_URL = os.getenv('DISCORD_API_URL') or 'https://discord.com/api/v10'
+DISCORD_MESSAGE_LIMIT = 2000
+# 0 serves the HTTP routes without logging in to the gateway, e.g. against a local fake REST API
+DISCORD_GATEWAY = os.getenv('DISCORD_GATEWAY', '1') != '0'
+WEBHOOK_QUEUE_PATH = os.getenv('WEBHOOK_QUEUE_PATH', 'webhook_queue.db')
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 4))
+WEBHOOK_RATE = float(os.getenv('WEBHOOK_RATE', 5))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 10))
+WEBHOOK_RETRY_MAX = int(os.getenv('WEBHOOK_RETRY_MAX', 300))
 
 # Initialize Flask app
 app = Quart(__name__)
 
+# Request timing by route pattern
+@app.before_request
+async def start_request_timer():
+    request.metrics_started = time.perf_counter()
+
+@app.after_request
+async def observe_request(response):
+    started = getattr(request, 'metrics_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - started, route, request.method)
+    return response
+
 # Set up the bot with the appropriate intents
 intents = discord.Intents.default()
 intents.messages = True
@@ -41,11 +76,63 @@ intents.message_content = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+# Current content and components of channel messages, so updates can skip the REST GET
+message_states = MessageStateCache(max_size=MESSAGE_CACHE_SIZE)
+
+# One pooled HTTP client for all outbound calls, created inside the running loop by main()
+http_session = None
+# Discord REST calls go through the scheduler so they respect the rate limits, also created by main()
+discord_rest = None
+
+# Button clicks for the workflow, stored before they are acknowledged and delivered in the background
+webhook_queue = WebhookQueue(
+    WEBHOOK_URL,
+    path=WEBHOOK_QUEUE_PATH or None,
+    concurrency=WEBHOOK_CONCURRENCY,
+    rate=WEBHOOK_RATE,
+    max_attempts=WEBHOOK_MAX_ATTEMPTS,
+    retry_max=WEBHOOK_RETRY_MAX
+)
+
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+
+# Keep references to fire-and-forget tasks so they are not garbage collected mid-run
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 @bot.event
 async def on_ready():
     logging.info(f'Bot is online as {bot.user}')
     logging.info(f'Messages will be sent to {WEBHOOK_URL}')
 
+@bot.event
+async def on_message(message):
+    # Remember messages in our channel, the workflow posts the ones we later update
+    if message.channel.id == DISCORD_CHANNEL_ID:
+        message_states.put(message.id, message.content, [row.to_dict() for row in message.components])
+    await bot.process_commands(message)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    if payload.channel_id == DISCORD_CHANNEL_ID:
+        message_states.update(payload.message_id, payload.data)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if payload.channel_id == DISCORD_CHANNEL_ID:
+        message_states.discard(payload.message_id)
+
 @bot.event
 async def on_interaction(interaction):
     if interaction.type == discord.InteractionType.component:
@@ -57,9 +144,10 @@ async def on_interaction(interaction):
             logging.info(f"Channel ID: {interaction.channel_id}")
             logging.info(f"Raw interaction data: {interaction.data}")
 
-            # Extract the action and message ID from the custom_id
+            # Extract the action, message ID and, for mails of another account, its key from the custom_id
             custom_id = interaction.data['custom_id']
-            command, message_id = custom_id.split(':')
+            command, message_id, *rest = custom_id.split(':')
+            account = rest[0] if rest else None
             discord_message_id = interaction.message.id  # ID of the original message
             logging.info(f"Discord message ID: {discord_message_id}")
 
@@ -67,26 +155,29 @@ async def on_interaction(interaction):
 
             if command == 'suggest':
                 # For 'suggest' action, collect context from the user via a modal
-                await collect_context_and_send_webhook(interaction, command, message_id, discord_message_id, user_name)
+                await collect_context_and_send_webhook(interaction, command, message_id, discord_message_id, user_name, account)
             else:
-                # For other actions, send the webhook immediately
+                # For other actions, queue the webhook and acknowledge right away
+                await queue_webhook(interaction.id, command, message_id, discord_message_id, user_name, context="", account=account)
                 await interaction.response.defer(ephemeral=False)
-                await build_and_send_webhook(command, message_id, discord_message_id, user_name, context="")
         except Exception as e:
             logging.error(f'Error in on_interaction: {e}')
             await interaction.response.send_message('Error handling interaction.', ephemeral=True)
 
-async def collect_context_and_send_webhook(interaction, command, message_id, discord_message_id, user_name):
+async def collect_context_and_send_webhook(interaction, command, message_id, discord_message_id, user_name, account=None):
     try:
         logging.info(f"Collecting context for command: {command}, message_id: {message_id}, discord_message_id: {discord_message_id}, user_name: {user_name}")
 
         class ContextModal(discord.ui.Modal):
             def __init__(self, command, message_id, discord_message_id, user_name):
                 super().__init__(title="Provide Context")
+                # The delivery is keyed by the button click, not by the modal submit
+                self.interaction_id = interaction.id
                 self.command = command
                 self.message_id = message_id
                 self.discord_message_id = discord_message_id
                 self.user_name = user_name
+                self.account = account
                 self.context_input = discord.ui.TextInput(
                     label="Additional Context",
                     placeholder="Enter any additional context or instructions...",
@@ -101,12 +192,14 @@ async def collect_context_and_send_webhook(interaction, command, message_id, dis
                     context = self.context_input.value or ""
                     logging.info(f"Modal submitted with context: {context}")
                     # Verwende die Instanzvariablen
-                    await build_and_send_webhook(
+                    await queue_webhook(
+                        self.interaction_id,
                         self.command,
                         self.message_id,
                         self.discord_message_id,
                         self.user_name,
-                        context
+                        context,
+                        self.account
                     )
                     await modal_interaction.response.defer(ephemeral=False)
                 except Exception as e:
@@ -121,7 +214,8 @@ async def collect_context_and_send_webhook(interaction, command, message_id, dis
         logging.error(f"Error in collect_context_and_send_webhook: {e}")
         await interaction.response.send_message('Error collecting context.', ephemeral=True)
 
-async def build_and_send_webhook(command, message_id, discord_message_id, user_name, context):
+# Queue the webhook for a button click, delivered and retried by webhook_queue
+async def queue_webhook(interaction_id, command, message_id, discord_message_id, user_name, context, account=None):
     # Prepare the payload for the webhook
     payload = {
         'action': command,
@@ -130,14 +224,86 @@ async def build_and_send_webhook(command, message_id, discord_message_id, user_n
         'context': context,
         'author': user_name
     }
-
-    # Send the data via POST to the webhook
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(WEBHOOK_URL, json=payload, headers=headers)
-    if response.status_code != 200:
-        logging.error(f'Error sending webhook: {response.status_code}')
-    else:
-        logging.info(f'Webhook called successfully with payload {payload}')
+    # The workflow hands the account on to the webservice and back to /update-message
+    if account:
+        payload['account'] = account
+
+    # One delivery per click, even if Discord hands us the interaction twice
+    return await webhook_queue.enqueue(f'{command}:{message_id}:{interaction_id}', payload)
+
+# Stream a suggested reply from the webservice and edit the Discord reply as tokens arrive
+async def stream_suggested_reply(discord_message_id, uid, context, regenerate=False, account=None):
+    reply_id = None
+    shown = ''
+    suggested_reply = ''
+    last_edit = 0.0
+
+    async def show(text):
+        nonlocal reply_id, shown, last_edit
+        text = text[:DISCORD_MESSAGE_LIMIT]
+        if not text or text == shown:
+            return
+        if reply_id is None:
+            # First tokens: post the reply to the original message
+            payload = {
+                'content': text,
+                'message_reference': {'message_id': discord_message_id, 'channel_id': DISCORD_CHANNEL_ID}
+            }
+            status, data = await discord_rest.request('POST', f'/channels/{DISCORD_CHANNEL_ID}/messages', payload)
+            if status != 200:
+                logging.error(f'Failed to post streamed reply: {status}')
+                return
+            reply_id = data['id']
+        else:
+            status, _ = await discord_rest.edit_message(DISCORD_CHANNEL_ID, reply_id, {'content': text})
+            if status != 200:
+                logging.error(f'Failed to edit streamed reply: {status}')
+                return
+        shown = text
+        last_edit = time.monotonic()
+
+    started = time.perf_counter()
+    first_token = True
+    try:
+        payload = {'uid': uid, 'context': context, 'stream': True, 'regenerate': regenerate}
+        # Without it the webservice would look the UID up in the default account
+        if account:
+            payload['account'] = account
+        # Generation takes longer than a normal call, only the gap between tokens is limited
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+        async with http_session.post(f'{WEBSERVICE_URL}/suggest-answer', json=payload, timeout=timeout) as response:
+            if response.content_type != 'text/event-stream':
+                # The webservice answered with plain JSON, e.g. the email could not be fetched
+                data = await response.json(content_type=None)
+                logging.error(f"Streaming suggested reply failed: {data.get('message')}")
+                await show(f":x: {data.get('message')}")
+                return
+
+            async for line in response.content:
+                line = line.decode().strip()
+                if not line.startswith('data:'):
+                    continue
+                event = json.loads(line[len('data:'):])
+                if 'delta' in event:
+                    if first_token:
+                        phase_seconds.observe(time.perf_counter() - started, 'webservice_first_token')
+                        first_token = False
+                    suggested_reply += event['delta']
+                    # Discord only allows a few edits per second, so batch the tokens
+                    if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                        await show(suggested_reply)
+                elif event.get('done'):
+                    if event.get('status') == 'success':
+                        suggested_reply = event.get('message', suggested_reply)
+                    else:
+                        suggested_reply = f"{suggested_reply}\n\n:x: {event.get('message')}"
+                    break
+        phase_seconds.observe(time.perf_counter() - started, 'webservice_suggest')
+
+        await show(suggested_reply)
+        logging.info('Streamed suggested reply completed')
+    except Exception:
+        logging.exception('Error while streaming suggested reply')
 
 # Route - Update Discord message
 @app.route('/update-message', methods=['POST'])
@@ -156,7 +322,12 @@ async def update_message():
         logging.info(f"Parsed parameters - action: {action}, status: {status}, message: {message}, discord_message_id: {discord_message_id}")
 
         suggested_reply = ""
-        if action == "suggest":
+        stream = action == "suggest" and data.get('stream')
+        if stream:
+            # The reply is streamed from the webservice and edited in place as it grows
+            message = "Creating suggested answer"
+            logging.info("Suggested reply will be streamed")
+        elif action == "suggest":
             suggested_reply = message
             message = "Created suggested answer"
             logging.info(f"Suggested reply prepared")
@@ -169,27 +340,26 @@ async def update_message():
         
         logging.info(f"Status message set to: {status_message}")
 
-        # Discord API-URL für das Bearbeiten der Nachricht
-        url = f'https://discord.com/api/v10/channels/{DISCORD_CHANNEL_ID}/messages/{discord_message_id}'
-        logging.info(f"Discord API URL: {url}")
+        # Discord API-Pfad für das Bearbeiten der Nachricht
+        path = f'/channels/{DISCORD_CHANNEL_ID}/messages/{discord_message_id}'
+        logging.info(f"Discord API path: {path}")
 
-        # Authorization Header für die Discord API
-        headers = {
-            'Authorization': f'Bot {DISCORD_API_KEY}',
-            'Content-Type': 'application/json'
-        }
+        # Step 1: Get the original message content, from the gateway cache when we have seen it
+        original_data = message_states.get(discord_message_id)
+        if original_data is None:
+            logging.info("Fetching the original Discord message content")
+            get_status, original_data = await discord_rest.request('GET', path)
+            logging.info(f"GET response status code: {get_status}")
 
-        # Step 1: Fetch the original message content
-        logging.info("Fetching the original Discord message content")
-        get_response = requests.get(url, headers=headers)
-        logging.info(f"GET response status code: {get_response.status_code}")
+            if get_status != 200:
+                logging.error("Failed to retrieve the original Discord message")
+                return jsonify({'status': 'error', 'message': 'Failed to retrieve the original Discord message'})
 
-        if get_response.status_code != 200:
-            logging.error("Failed to retrieve the original Discord message")
-            return jsonify({'status': 'error', 'message': 'Failed to retrieve the original Discord message'})
+            # Get the original message with all content including components
+            message_states.put_payload(original_data)
+        else:
+            logging.info("Original Discord message served from cache")
 
-        # Get the original message with all content including components
-        original_data = get_response.json()
         original_message = original_data.get("content")
         original_components = original_data.get("components", [])
 
@@ -229,9 +399,26 @@ async def update_message():
         
         logging.info(f"PATCH payload prepared: {payload}")
 
-        # Sende PATCH-Request, um die Nachricht zu aktualisieren
-        patch_response = requests.patch(url, json=payload, headers=headers)
-        logging.info(f"PATCH response status code: {patch_response.status_code}")
+        # Record the new state before sending, so updates queued behind this one build on it
+        message_states.put(discord_message_id, updated_message, new_components)
+
+        # Sende PATCH-Request, um die Nachricht zu aktualisieren; queued edits of the same message are merged
+        patch_status, patch_data = await discord_rest.edit_message(DISCORD_CHANNEL_ID, discord_message_id, payload)
+        if patch_status == 200:
+            # The PATCH answer is the new state of the message
+            message_states.put_payload(patch_data)
+        else:
+            message_states.discard(discord_message_id)
+        logging.info(f"PATCH response status code: {patch_status}")
+
+        # Streamed suggestions are posted in the background, answer the caller right away
+        if stream:
+            run_in_background(stream_suggested_reply(
+                discord_message_id, data.get('uid'), data.get('context', ''), bool(data.get('regenerate')), data.get('account')
+            ))
+            if patch_status == 200:
+                return jsonify({'status': 'success', 'message': 'Streaming suggested reply'})
+            return jsonify({'status': 'error', 'message': 'Failed to update Discord message'})
 
         # Additional step: If action is suggest, reply with the suggested reply
         if action == "suggest" and suggested_reply:
@@ -243,20 +430,19 @@ async def update_message():
                     'channel_id': DISCORD_CHANNEL_ID
                 }
             }
-            reply_url = f'https://discord.com/api/v10/channels/{DISCORD_CHANNEL_ID}/messages'
             logging.info(f"POST reply payload: {reply_payload}")
 
-            reply_response = requests.post(reply_url, json=reply_payload, headers=headers)
-            logging.info(f"Reply POST response status code: {reply_response.status_code}")
+            reply_status, _ = await discord_rest.request('POST', f'/channels/{DISCORD_CHANNEL_ID}/messages', reply_payload)
+            logging.info(f"Reply POST response status code: {reply_status}")
 
-            if reply_response.status_code == 200:
+            if reply_status == 200:
                 logging.info("Suggested reply sent successfully")
                 return jsonify({'status': 'success', 'message': 'Replied with suggested message'})
             else:
                 logging.error("Failed to send suggested reply")
                 return jsonify({'status': 'error', 'message': 'Failed to send suggested reply'})
 
-        if patch_response.status_code == 200:
+        if patch_status == 200:
             logging.info("Discord message updated successfully")
             return jsonify({'status': 'success', 'message': 'Updated Discord message'})
         else:
@@ -268,6 +454,82 @@ async def update_message():
         logging.exception('Error while updating Discord message')
         return jsonify({'status': 'error', 'message': 'Exception occurred'})
 
+# Buttons under a new mail, the custom_id carries the action and the Message-ID like the workflow's posts,
+# followed by the account key for mails of an account other than the default one
+NEW_MAIL_BUTTONS = [
+    ('suggest', 'Suggest Answer', 1),
+    ('read', 'Mark as Read', 2),
+    ('trash', 'Move to Trash', 4),
+]
+DISCORD_CUSTOM_ID_LIMIT = 100
+
+# Route - Post a new mail pushed by the IMAP ingest
+@app.route('/new-mail', methods=['POST'])
+async def new_mail():
+    try:
+        data = await request.get_json()
+        message_id = data.get('message_id') or ''
+        account = data.get('account') or ''
+        sender = (data.get('from') or [{}])[0]
+        sender_text = f"{sender.get('name')} <{sender.get('address')}>" if sender.get('name') else sender.get('address', '')
+
+        content = f":envelope: **{data.get('subject') or '(kein Betreff)'}**\nVon: {sender_text}\nDatum: {data.get('date') or ''}"
+        payload = {'content': content[:DISCORD_MESSAGE_LIMIT]}
+
+        custom_ids = [f'{action}:{message_id}:{account}' if account else f'{action}:{message_id}' for action, _, _ in NEW_MAIL_BUTTONS]
+        # on_interaction splits the custom_id at ':', so neither the Message-ID nor the account may contain one
+        if message_id and ':' not in message_id + account and all(len(custom_id) <= DISCORD_CUSTOM_ID_LIMIT for custom_id in custom_ids):
+            payload['components'] = [{
+                'type': 1,
+                'components': [
+                    {'type': 2, 'style': style, 'label': label, 'custom_id': custom_id}
+                    for (_, label, style), custom_id in zip(NEW_MAIL_BUTTONS, custom_ids)
+                ]
+            }]
+        else:
+            logging.warning(f"No buttons for UID {data.get('uid')}, Message-ID missing, too long or containing ':'")
+
+        status, message = await discord_rest.request('POST', f'/channels/{DISCORD_CHANNEL_ID}/messages', payload)
+        if status == 429 or status >= 500:
+            # Discord is busy or down, the ingest delivers the mail again later
+            logging.error(f'Failed to post new mail, retry later: {status}')
+            return jsonify({'status': 'error', 'message': 'Discord unavailable'}), 502
+        if status != 200:
+            # Discord refused the message itself, the ingest skips it
+            logging.error(f'Failed to post new mail: {status}')
+            return jsonify({'status': 'error', 'message': 'Failed to post new mail'})
+
+        # Updates of this message will not need a GET
+        message_states.put_payload(message)
+        return jsonify({'status': 'success', 'message': 'Posted new mail', 'discordMessageId': message['id']})
+
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logging.exception('Discord unreachable while posting new mail')
+        return jsonify({'status': 'error', 'message': 'Discord unreachable'}), 503
+    except Exception:
+        logging.exception('Error while posting new mail')
+        return jsonify({'status': 'error', 'message': 'Exception occurred'})
+
+# Route - Message state cache statistics
+@app.route('/cache-stats', methods=['GET'])
+async def cache_stats():
+    return jsonify({'status': 'success', 'message_states': message_states.stats()})
+
+# Route - Discord REST scheduler statistics
+@app.route('/rest-stats', methods=['GET'])
+async def rest_stats():
+    return jsonify({'status': 'success', 'rest': discord_rest.stats})
+
+# Route - Webhook delivery queue statistics
+@app.route('/webhook-stats', methods=['GET'])
+async def webhook_stats():
+    return jsonify({'status': 'success', 'webhooks': await webhook_queue.stats()})
+
+# Route - latency histograms and counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
 async def run_bot():
     await bot.start(DISCORD_API_KEY)
 
@@ -275,6 +537,11 @@ async def run_app():
     await app.run_task(host='0.0.0.0', port=PORT2)
 
 async def main():
+    global http_session, discord_rest
+    http_session = create_http_session()
+    discord_rest = DiscordRestScheduler(http_session, DISCORD_API_KEY, DISCORD_API_URL)
+    # Deliveries left over from the last run are sent first
+    webhook_queue.start(http_session)
     try:
         # Setup signal handlers
         loop = asyncio.get_running_loop()
@@ -291,10 +558,13 @@ async def main():
         signal.signal(signal.SIGTERM, shutdown_handler)
         
         # Tasks erstellen und ausführen
-        bot_task = asyncio.create_task(run_bot())
         app_task = asyncio.create_task(run_app())
-        
-        await asyncio.gather(bot_task, app_task)
+        if DISCORD_GATEWAY:
+            bot_task = asyncio.create_task(run_bot())
+            await asyncio.gather(bot_task, app_task)
+        else:
+            logging.info("Gateway disabled, serving HTTP routes only")
+            await app_task
         
     except asyncio.CancelledError:
         logging.info("Main task was cancelled, shutting down...")
@@ -310,6 +580,9 @@ async def main():
                     await task
                 except asyncio.CancelledError:
                     pass
+        # Close pooled HTTP connections after every task that might use them is gone
+        await http_session.close()
+        webhook_queue.close()
         logging.info("Shutdown complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+
+class MessageStateCache:
+    """
+    Bounded cache of the current content and components of channel messages.
+
+    Fed by gateway events and by our own REST responses so /update-message can skip
+    the GET before its PATCH. Least recently used messages are dropped first.
+
+    Args:
+        max_size (int): Number of messages to remember
+    """
+
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._messages = OrderedDict()  # message_id -> {'content': str, 'components': list}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id):
+        """Returns a copy of the cached state or None."""
+        with self._lock:
+            state = self._messages.get(str(message_id))
+            if state is None:
+                self.misses += 1
+                return None
+            self._messages.move_to_end(str(message_id))
+            self.hits += 1
+            return {'content': state['content'], 'components': list(state['components'])}
+
+    def put(self, message_id, content, components):
+        with self._lock:
+            self._messages[str(message_id)] = {'content': content or '', 'components': components or []}
+            self._messages.move_to_end(str(message_id))
+            while len(self._messages) > self.max_size:
+                self._messages.popitem(last=False)
+
+    def put_payload(self, payload):
+        """Store a message object as returned by the Discord REST API or a raw gateway event."""
+        if payload and 'id' in payload:
+            self.put(payload['id'], payload.get('content'), payload.get('components'))
+
+    def update(self, message_id, data):
+        """Apply a partial edit (raw MESSAGE_UPDATE data) to a message we already know."""
+        with self._lock:
+            state = self._messages.get(str(message_id))
+            if state is None:
+                return
+            if 'content' in data:
+                state['content'] = data['content'] or ''
+            if 'components' in data:
+                state['components'] = data['components'] or []
+
+    def discard(self, message_id):
+        with self._lock:
+            self._messages.pop(str(message_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._messages), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
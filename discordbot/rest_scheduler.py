@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import re
+import time
+from metrics import phase_seconds, rate_limited
+
+MESSAGE_ID_RE = re.compile(r'/messages/\d+')
+MAJOR_PARAM_RE = re.compile(r'^/(channels|guilds|webhooks)/(\d+)')
+
+
+class _Bucket:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.remaining = None  # unknown until the first response
+        self.reset_at = 0.0
+
+
+class DiscordRestScheduler:
+    """
+    Dispatches Discord REST calls within the advertised rate limits.
+
+    Requests are queued per rate-limit bucket (learned from X-RateLimit-Bucket), wait for the
+    bucket or the global limit to reset instead of failing, and are retried after a 429.
+    Edits to the same message that are still queued are merged into a single PATCH.
+
+    Args:
+        session (aiohttp.ClientSession): Shared HTTP session
+        token (str): Bot token
+        api_url (str): Discord API base URL
+        max_retries (int): Attempts after a 429 before giving up
+    """
+
+    def __init__(self, session, token, api_url='https://discord.com/api/v10', max_retries=5):
+        self.session = session
+        self.api_url = api_url.rstrip('/')
+        self.headers = {'Authorization': f'Bot {token}', 'Content-Type': 'application/json'}
+        self.max_retries = max_retries
+        self._route_buckets = {}  # route -> bucket hash from Discord
+        self._buckets = {}  # bucket hash + major parameter -> _Bucket
+        self._global_reset_at = 0.0
+        self._pending_edits = {}  # path -> {'payload', 'future'}
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'coalesced': 0, 'waited_seconds': 0.0}
+
+    @staticmethod
+    def _route(method, path):
+        return f'{method} {MESSAGE_ID_RE.sub("/messages/{id}", path)}'
+
+    def _bucket(self, method, path):
+        route = self._route(method, path)
+        major = MAJOR_PARAM_RE.match(path)
+        key = f"{self._route_buckets.get(route, route)}:{major.group(2) if major else ''}"
+        return self._buckets.setdefault(key, _Bucket())
+
+    async def _wait(self, bucket):
+        while True:
+            now = time.monotonic()
+            delay = self._global_reset_at - now
+            if bucket.remaining == 0:
+                delay = max(delay, bucket.reset_at - now)
+            if delay <= 0:
+                if bucket.remaining == 0:
+                    bucket.remaining = None
+                return
+            self.stats['waited_seconds'] += delay
+            await asyncio.sleep(delay)
+
+    def _learn(self, method, path, bucket, headers):
+        now = time.monotonic()
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        route = self._route(method, path)
+        if bucket_hash and route not in self._route_buckets:
+            # Later requests on this route share the state of the bucket Discord told us about
+            self._route_buckets[route] = bucket_hash
+            major = MAJOR_PARAM_RE.match(path)
+            self._buckets.setdefault(f"{bucket_hash}:{major.group(2) if major else ''}", bucket)
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None:
+            bucket.remaining = int(remaining)
+        if reset_after is not None:
+            bucket.reset_at = now + float(reset_after)
+
+    async def _send_locked(self, bucket, method, path, payload):
+        """
+        One attempt, called while holding the bucket's lock.
+
+        Returns:
+            tuple: (status, data, retry_after) - retry_after is set when Discord answered 429
+        """
+        await self._wait(bucket)
+        if bucket.remaining:
+            bucket.remaining -= 1
+        self.stats['requests'] += 1
+        # Only the round trip, time spent waiting for the bucket is not part of the phase
+        started = time.perf_counter()
+        async with self.session.request(method, f'{self.api_url}{path}', json=payload, headers=self.headers) as response:
+            status = response.status
+            headers = response.headers
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = None
+        phase_seconds.observe(time.perf_counter() - started, f'discord_{method.lower()}')
+        self._learn(method, path, bucket, headers)
+
+        if status != 429:
+            return status, data, None
+
+        self.stats['rate_limited'] += 1
+        rate_limited.inc()
+        retry_after = float((data or {}).get('retry_after') or headers.get('Retry-After') or 1)
+        if (data or {}).get('global') or headers.get('X-RateLimit-Global'):
+            self._global_reset_at = time.monotonic() + retry_after
+        else:
+            bucket.remaining = 0
+            bucket.reset_at = time.monotonic() + retry_after
+        logging.warning(f'Discord rate limit hit on {method} {path}, retrying in {retry_after:.2f}s')
+        return status, data, retry_after
+
+    async def _send(self, method, path, payload):
+        bucket = self._bucket(method, path)
+        async with bucket.lock:
+            return await self._send_locked(bucket, method, path, payload)
+
+    async def request(self, method, path, payload=None):
+        """
+        Send a REST request, queueing it until its bucket allows it.
+
+        Returns:
+            tuple: (status, data)
+        """
+        for attempt in range(self.max_retries + 1):
+            status, data, retry_after = await self._send(method, path, payload)
+            if retry_after is None:
+                return status, data
+            self.stats['retries'] += 1
+        return status, data
+
+    async def edit_message(self, channel_id, message_id, payload):
+        """
+        PATCH a message; edits queued for the same message before it is sent are merged.
+
+        Every caller gets the result of the PATCH that carried its content.
+
+        Returns:
+            tuple: (status, data)
+        """
+        path = f'/channels/{channel_id}/messages/{message_id}'
+        pending = self._pending_edits.get(path)
+        if pending:
+            # The newest content and components win, they already include earlier changes
+            pending['payload'] = payload
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(pending['future'])
+
+        entry = {'payload': payload, 'future': asyncio.get_running_loop().create_future()}
+        self._pending_edits[path] = entry
+        asyncio.create_task(self._flush_edit(path, entry))
+        return await asyncio.shield(entry['future'])
+
+    async def _flush_edit(self, path, entry):
+        try:
+            for attempt in range(self.max_retries + 1):
+                bucket = self._bucket('PATCH', path)
+                # Wait for our turn first, so edits arriving meanwhile still merge into this one
+                async with bucket.lock:
+                    await self._wait(bucket)
+                    if self._pending_edits.get(path) is entry:
+                        del self._pending_edits[path]
+                    status, data, retry_after = await self._send_locked(bucket, 'PATCH', path, entry['payload'])
+                if retry_after is None:
+                    entry['future'].set_result((status, data))
+                    return
+
+                self.stats['retries'] += 1
+                newer = self._pending_edits.get(path)
+                if newer is not None:
+                    # A newer edit is queued and carries the final state, finish together with it
+                    newer['future'].add_done_callback(lambda future: self._chain(future, entry['future']))
+                    return
+                self._pending_edits[path] = entry
+            self._pending_edits.pop(path, None)
+            entry['future'].set_result((status, data))
+        except Exception as e:
+            if self._pending_edits.get(path) is entry:
+                del self._pending_edits[path]
+            if not entry['future'].done():
+                entry['future'].set_exception(e)
+
+    @staticmethod
+    def _chain(source, target):
+        if target.done():
+            return
+        if source.exception():
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
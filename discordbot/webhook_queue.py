@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import phase_seconds, webhook_deliveries
+
+
+class WebhookQueue:
+    """
+    Durable outbound queue for the workflow webhook.
+
+    Deliveries are written to SQLite (a file with a path, memory otherwise) before the button is
+    acknowledged and drained in the background: at most `concurrency` at a time, no faster than
+    `rate` per second, retried with exponential backoff and jitter on network errors, 408, 429
+    and 5xx. Every delivery carries an Idempotency-Key derived from the interaction, and a key
+    that is already queued or was delivered within `retention` seconds is not queued again.
+
+    SQLite is only touched from one writer thread, so a slow disk never stalls the event loop
+    (and with it the gateway heartbeat). Files use the WAL journal with synchronous=NORMAL,
+    a commit does not wait for an fsync.
+
+    Args:
+        url (str): Webhook URL
+        path (str): Optional SQLite file, pending deliveries survive restarts with it
+        concurrency (int): Deliveries in flight at once
+        rate (float): Deliveries started per second, 0 for no limit
+        max_attempts (int): Attempts before a delivery is given up
+        retry_max (float): Upper bound of the backoff in seconds
+        retention (float): Seconds delivered keys are kept to drop duplicates
+    """
+
+    def __init__(self, url, path=None, concurrency=4, rate=5.0, max_attempts=10, retry_max=300.0, retention=24 * 3600):
+        self.url = url
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.max_attempts = max_attempts
+        self.retry_max = retry_max
+        self.retention = retention
+        self.session = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='webhook-db')
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # Durable at checkpoints, a power loss can only lose the last queued clicks
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS webhook_deliveries (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS webhook_deliveries_due ON webhook_deliveries (status, next_at);
+        """)
+        self._in_flight = set()
+        self._wake = None
+        self._next_slot = 0.0
+        self._task = None
+        self._tasks = set()
+        self._stats = {'queued': 0, 'duplicates': 0, 'delivered': 0, 'retried': 0, 'failed': 0}
+
+    def start(self, session):
+        """Start draining, called inside the running loop once the HTTP session exists."""
+        self.session = session
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def _call(self, func, *args):
+        # Every query runs on the writer thread, one at a time
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def enqueue(self, key, payload):
+        """
+        Store a delivery, returns without waiting for the webhook.
+
+        Args:
+            key (str): Idempotency key, e.g. built from the interaction ID
+            payload (dict): JSON body
+
+        Returns:
+            bool: False if the key was already queued or delivered
+        """
+        if not await self._call(self._insert, key, json.dumps(payload)):
+            self._stats['duplicates'] += 1
+            logging.info(f'Webhook delivery {key} is already queued, ignoring the duplicate')
+            return False
+        self._stats['queued'] += 1
+        if self._wake is not None:
+            self._wake.set()
+        return True
+
+    def _insert(self, key, payload):
+        now = time.time()
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO webhook_deliveries (key, payload, status, next_at, created_at, updated_at) '
+                "VALUES (?, ?, 'pending', ?, ?, ?)",
+                (key, payload, now, now, now))
+        return cursor.rowcount > 0
+
+    def _due(self, now, limit, in_flight):
+        placeholders = ','.join('?' * len(in_flight))
+        exclude = f' AND key NOT IN ({placeholders})' if in_flight else ''
+        return self._db.execute(
+            f"SELECT key, payload, attempts FROM webhook_deliveries WHERE status = 'pending' AND next_at <= ?{exclude} "
+            'ORDER BY next_at LIMIT ?', (now, *in_flight, limit)).fetchall()
+
+    def _seconds_to_next(self, now):
+        row = self._db.execute("SELECT MIN(next_at) FROM webhook_deliveries WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return None
+        return max(row[0] - now, 0.05)
+
+    def _prune(self, now):
+        with self._db:
+            self._db.execute("DELETE FROM webhook_deliveries WHERE status != 'pending' AND updated_at < ?",
+                             (now - self.retention,))
+
+    async def _throttle(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._next_slot > now:
+            await asyncio.sleep(self._next_slot - now)
+        self._next_slot = max(now, self._next_slot) + self.interval
+
+    async def _run(self):
+        last_prune = 0.0
+        while True:
+            self._wake.clear()
+            now = time.time()
+            if now - last_prune > 3600:
+                await self._call(self._prune, now)
+                last_prune = now
+
+            free = self.concurrency - len(self._in_flight)
+            due = await self._call(self._due, now, free, tuple(self._in_flight)) if free > 0 else ()
+            for key, payload, attempts in due:
+                await self._throttle()
+                self._in_flight.add(key)
+                task = asyncio.create_task(self._deliver(key, json.loads(payload), attempts))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            # Sleep until something is enqueued, a slot frees up or the next retry is due
+            timeout = None if len(self._in_flight) >= self.concurrency else await self._call(self._seconds_to_next, time.time())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _backoff(self, attempts, retry_after=None):
+        # Equal jitter: half the exponential step is fixed, the other half random
+        step = min(self.retry_max, 2 ** attempts)
+        delay = step / 2 + random.uniform(0, step / 2)
+        return max(delay, retry_after or 0)
+
+    async def _deliver(self, key, payload, attempts):
+        error = None
+        retry_after = None
+        retry = True
+        try:
+            headers = {'Content-Type': 'application/json', 'Idempotency-Key': key}
+            with phase_seconds.time('webhook'):
+                async with self.session.post(self.url, json=payload, headers=headers) as response:
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+            if 200 <= status < 300:
+                await self._call(self._finish, key, 'delivered', attempts + 1)
+                webhook_deliveries.inc(1, 'delivered')
+                self._stats['delivered'] += 1
+                logging.info(f'Webhook called successfully with payload {payload}')
+                return
+            error = f'HTTP {status}'
+            # Other client errors will not succeed on a retry
+            retry = status in (408, 429) or status >= 500
+        except asyncio.CancelledError:
+            # Shutting down, the row stays pending and is sent after the restart
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        finally:
+            self._in_flight.discard(key)
+            if self._wake is not None:
+                self._wake.set()
+
+        attempts += 1
+        if not retry or attempts >= self.max_attempts:
+            await self._call(self._finish, key, 'failed', attempts, error)
+            webhook_deliveries.inc(1, 'failed')
+            self._stats['failed'] += 1
+            logging.error(f'Giving up webhook delivery {key} after {attempts} attempts: {error}')
+            return
+
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        delay = self._backoff(attempts, retry_after)
+        await self._call(self._reschedule, key, attempts, delay, error)
+        webhook_deliveries.inc(1, 'retried')
+        self._stats['retried'] += 1
+        logging.warning(f'Webhook delivery {key} failed ({error}), retry {attempts} in {delay:.1f}s')
+
+    def _reschedule(self, key, attempts, delay, error):
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                'UPDATE webhook_deliveries SET attempts = ?, next_at = ?, updated_at = ?, last_error = ? WHERE key = ?',
+                (attempts, now + delay, now, error, key))
+
+    def _finish(self, key, status, attempts, error=None):
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                'UPDATE webhook_deliveries SET status = ?, attempts = ?, updated_at = ?, last_error = ? WHERE key = ?',
+                (status, attempts, now, error, key))
+
+    def _counts(self):
+        return dict(self._db.execute('SELECT status, COUNT(*) FROM webhook_deliveries GROUP BY status').fetchall())
+
+    async def stats(self):
+        counts = await self._call(self._counts)
+        return dict(self._stats, in_flight=len(self._in_flight), stored=counts)
+
+    def close(self):
+        # Queries still queued on the writer thread finish first
+        self._executor.shutdown(wait=True)
+        self._db.close()
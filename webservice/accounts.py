@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+from imap_pool import IMAPConnectionPool
+from mailbox_mirror import MailboxMirror
+from message_cache import MessageCache
+from special_use import SpecialUseFolders
+from uid_index import MessageIdIndex
+
+
+def account_path(path, name, default_name):
+    """
+    SQLite file of an account: the configured path for the default account, '<stem>-<name><ext>' for the others.
+
+    Returns:
+    str: The path, or None to keep the store in memory
+    """
+    if not path or name == default_name:
+        return path or None
+    stem, ext = os.path.splitext(path)
+    return f'{stem}-{name}{ext}'
+
+
+class Account:
+    """
+    One mailbox: its own IMAP pool (which also caps its concurrency), Message-ID index,
+    message cache, mailbox mirror and special-use folders.
+
+    Parameters:
+    name (str): Account key used in requests
+    host, port, user, password: IMAP login
+    use_ssl (bool): IMAP over TLS
+    pool_size (int): Pooled sessions, the most IMAP work the account does at once
+    uid_index_path, mirror_path (str): Optional SQLite files
+    pool_options (dict): max_idle, keepalive_interval, acquire_timeout and socket_timeout of the pool
+    cache_options (dict): max_bytes, ttl and path of the message cache
+    """
+
+    def __init__(self, name, host, port, user, password, use_ssl=True, pool_size=4,
+                 uid_index_path=None, mirror_path=None, pool_options=None, cache_options=None):
+        self.name = name
+        self.user = user
+        self.pool_size = pool_size
+        self.imap_pool = IMAPConnectionPool(host, port, user, password, max_size=pool_size, use_ssl=use_ssl, **(pool_options or {}))
+        self.uid_index = MessageIdIndex(path=uid_index_path)
+        self.message_cache = MessageCache(**(cache_options or {}))
+        self.mailbox_mirror = MailboxMirror(path=mirror_path)
+        self.mailbox_mirror_path = mirror_path
+        self.special_folders = SpecialUseFolders()
+
+    def stats(self):
+        return {
+            'user': self.user,
+            'pool': self.imap_pool.stats(),
+            'uid_index': self.uid_index.stats(),
+            'message_cache': self.message_cache.stats(),
+            'mailbox_mirror': self.mailbox_mirror.stats(),
+            'special_folders': self.special_folders.stats()
+        }
+
+    def close(self):
+        self.imap_pool.close()
+
+
+def load_account_configs(path):
+    """
+    Read the accounts file, a JSON object of account key -> settings:
+
+        {"sales": {"host": "imap.example.com", "user": "sales@example.com", "password_env": "SALES_IMAP_PASS"}}
+
+    Settings that are left out fall back to the IMAP_* environment of the default account.
+    'password_env' names an environment variable so the file needs no secrets.
+
+    Returns:
+    dict: account key -> settings
+    """
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        configs = json.load(f)
+    if not isinstance(configs, dict):
+        raise ValueError(f'{path} must contain a JSON object of accounts')
+    for name, config in configs.items():
+        if ':' in name or '/' in name or not name:
+            raise ValueError(f'Invalid account key {name!r}')
+        if 'password_env' in config:
+            config['password'] = os.getenv(config['password_env'])
+    return configs
+
+
+class AccountRegistry:
+    """
+    The accounts this process serves, looked up by the 'account' field of a request.
+
+    Parameters:
+    accounts (dict): account key -> Account served here
+    known (iterable): Every configured key, including accounts served by other processes
+    default (str): Key used when a request names no account
+    """
+
+    def __init__(self, accounts, known=(), default='default'):
+        self.accounts = accounts
+        self.known = set(known) | set(accounts)
+        self.default = default
+
+    def resolve(self, name=None):
+        """
+        Returns:
+        tuple: (Account, error)
+        """
+        name = str(name) if name else self.default
+        account = self.accounts.get(name)
+        if account is not None:
+            return account, None
+        if name in self.known:
+            return None, f'Account {name} is served by another process'
+        return None, f'Unknown account {name}'
+
+    def get(self, name=None):
+        """The account or None, for callers that only want to peek at its caches."""
+        return self.accounts.get(str(name) if name else self.default)
+
+    def __iter__(self):
+        return iter(self.accounts.values())
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def pool_size(self):
+        return sum(account.pool_size for account in self.accounts.values())
+
+    def stats(self):
+        return {name: account.stats() for name, account in self.accounts.items()}
+
+    def close(self):
+        for account in self.accounts.values():
+            try:
+                account.close()
+            except Exception as e:
+                logging.warning(f'Closing account {account.name} failed: {str(e)}')
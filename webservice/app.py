@@ -1,385 +1,1325 @@
 import imaplib
 import time
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from openai import OpenAI
-from bs4 import BeautifulSoup
-import email
 from email.message import EmailMessage
 from email.utils import make_msgid, formatdate
 import os
+import json
 from dotenv import load_dotenv
 import logging
+import re
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from accounts import Account, AccountRegistry, account_path, load_account_configs
+from uid_index import select_mailbox
+from imap_batch import move_uids, store_flags, summarize
+from mail_text import select_text, set_html_engine
+from bodystructure import fetch_text_parts, fetch_text_parts_batch
+from mime_stream import fetch_text_stream
+from jobs import JobQueue
+from response_cache import ResponseCache
+from prompt_prep import count_tokens, prepare_email_text
+from similarity import SimilarityIndex, mentions_changes
+from special_use import quote_mailbox
+from envelope import decode_words
+from token_budget import TokenBudget
+from shared_state import ProcessLock, state_path
+from metrics import CONTENT_TYPE, openai_tokens, phase_seconds, registry, request_seconds
 
 load_dotenv()
 
 IMAP_HOST = os.getenv('IMAP_HOST')
-IMAP_PORT = int(os.getenv('IMAP_PORT')) 
+IMAP_PORT = int(os.getenv('IMAP_PORT', 993))
 IMAP_USER = os.getenv('IMAP_USER')
 IMAP_PASS = os.getenv('IMAP_PASS')
+# Only for local test servers, real mail servers are always reached over TLS
+IMAP_SSL = os.getenv('IMAP_SSL', '1') != '0'
 PORT = int(os.getenv('PORT')) 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+IMAP_POOL_SIZE = int(os.getenv('IMAP_POOL_SIZE', 4))
+IMAP_POOL_MAX_IDLE = int(os.getenv('IMAP_POOL_MAX_IDLE', 300))
+IMAP_POOL_KEEPALIVE = int(os.getenv('IMAP_POOL_KEEPALIVE', 60))
+IMAP_POOL_TIMEOUT = int(os.getenv('IMAP_POOL_TIMEOUT', 30))
+# Seconds an IMAP connect or read may block, 0 waits forever
+IMAP_SOCKET_TIMEOUT = int(os.getenv('IMAP_SOCKET_TIMEOUT', 60))
+# Worker processes of the prefork server, they split IMAP_POOL_SIZE between them
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+# Directory for the SQLite files worker processes share, each *_PATH below defaults into it
+STATE_DIR = os.getenv('STATE_DIR')
+UID_INDEX_PATH = os.getenv('UID_INDEX_PATH') or state_path(STATE_DIR, 'uid_index.db')
+MESSAGE_CACHE_PATH = os.getenv('MESSAGE_CACHE_PATH') or state_path(STATE_DIR, 'message_cache.db')
+MESSAGE_CACHE_BYTES = int(os.getenv('MESSAGE_CACHE_BYTES', 32 * 1024 * 1024))
+MESSAGE_CACHE_TTL = int(os.getenv('MESSAGE_CACHE_TTL', 900))
+FETCH_MODE = os.getenv('FETCH_MODE', 'partial')
+# Full fetches stream emails in windows of FETCH_WINDOW_BYTES and keep FETCH_TEXT_BYTES of each text part,
+# emails smaller than a window are downloaded whole, FETCH_BATCH_BYTES of them per FETCH
+FETCH_WINDOW_BYTES = int(os.getenv('FETCH_WINDOW_BYTES', 1024 * 1024))
+FETCH_BATCH_BYTES = int(os.getenv('FETCH_BATCH_BYTES', 8 * 1024 * 1024))
+FETCH_TEXT_BYTES = int(os.getenv('FETCH_TEXT_BYTES', 1024 * 1024))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_MAX_QUEUED = int(os.getenv('JOB_MAX_QUEUED', 1000))
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 3600))
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH') or state_path(STATE_DIR, 'jobs.db')
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH') or state_path(STATE_DIR, 'response_cache.db')
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+HTML_ENGINE = os.getenv('HTML_ENGINE', 'parser')
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+# Tokens per minute OpenAI calls may use (split between worker processes), 0 for no limit
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', 0))
+# OpenAI calls triage runs make at once, and the most emails one run takes
+TRIAGE_CONCURRENCY = int(os.getenv('TRIAGE_CONCURRENCY', 8))
+TRIAGE_MAX_MESSAGES = int(os.getenv('TRIAGE_MAX_MESSAGES', 200))
+# Earlier suggestions for near-identical emails (estimated share of equal word triples): from SIMILARITY_REUSE_THRESHOLD
+# on they are returned as they are, from SIMILARITY_ADAPT_THRESHOLD on ChatGPT adapts them with a short prompt, 0 turns either off
+SIMILARITY_REUSE_THRESHOLD = float(os.getenv('SIMILARITY_REUSE_THRESHOLD', 0.9))
+SIMILARITY_ADAPT_THRESHOLD = float(os.getenv('SIMILARITY_ADAPT_THRESHOLD', 0.5))
+SIMILARITY_INDEX_PATH = os.getenv('SIMILARITY_INDEX_PATH') or state_path(STATE_DIR, 'similarity.db')
+SIMILARITY_INDEX_ENTRIES = int(os.getenv('SIMILARITY_INDEX_ENTRIES', 5000))
+UPDATE_MESSAGE_URL = os.getenv('UPDATE_MESSAGE_URL') or 'http://discord-bot:4210/update-message'
+MIRROR_PATH = os.getenv('MIRROR_PATH') or state_path(STATE_DIR, 'mirror.db')
+METRICS_DIR = os.getenv('METRICS_DIR') or state_path(STATE_DIR, 'metrics')
+MIRROR_SYNC_INTERVAL = int(os.getenv('MIRROR_SYNC_INTERVAL', 30))
+# More mailboxes next to the IMAP_* one, and the subset this process serves (empty: all)
+IMAP_ACCOUNTS_FILE = os.getenv('IMAP_ACCOUNTS_FILE')
+DEFAULT_ACCOUNT = os.getenv('DEFAULT_ACCOUNT', 'default')
+SERVE_ACCOUNTS = [name.strip() for name in os.getenv('SERVE_ACCOUNTS', '').split(',') if name.strip()]
+
+OPENAI_MODEL = "gpt-4"
+OPENAI_TEMPERATURE = 0.6
+OPENAI_MAX_TOKENS = 500
+SYSTEM_PROMPT = "Erstelle Mail-Antworten für eine Internetagentur. Ansprache Sie oder du je nach E-Mail. Halte den Ton professionell, präzise sowie strukturiert und freundlich. Bitte erstelle NUR die E-Mail-Antwort ohne Betreff, einleitende Worte oder Erläuterungen nach dem E-Mail-Text. Verzichte generell auf 'und mit Kommas' (und,)"
 
 app = Flask(__name__)
 
+if STATE_DIR:
+    os.makedirs(STATE_DIR, exist_ok=True)
+elif WEB_WORKERS > 1:
+    logging.warning('WEB_WORKERS > 1 without STATE_DIR, every worker process warms its own caches')
+# With several worker processes every one of them answers /metrics for all
+if METRICS_DIR:
+    registry.share(METRICS_DIR)
+
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-# Function for IMAP connection
-def connect_to_imap():
-    try:
-        mail = imaplib.IMAP4_SSL(host=IMAP_HOST, port=IMAP_PORT)
-        mail.login(IMAP_USER, IMAP_PASS)
-        return mail, None  # successful, no error
-    except imaplib.IMAP4.error as e:
-        return None, f"IMAP connection failed: {str(e)}"
+# Request timing by route pattern, so UIDs and job IDs do not become label values.
+# Streamed answers are timed until the headers go out, the stream itself is the openai phase
+@app.before_request
+def start_request_timer():
+    request.environ['metrics.started'] = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = request.environ.get('metrics.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - started, route, request.method)
+    return response
+
+# Function to build the accounts this process serves. Each one has its own pool of logged-in
+# IMAP sessions, Message-ID index, message cache and mailbox mirror, so a busy inbox cannot
+# starve another one. The IMAP_* environment is the default account
+def create_accounts():
+    configs = {}
+    if IMAP_USER:
+        configs[DEFAULT_ACCOUNT] = {'host': IMAP_HOST, 'port': IMAP_PORT, 'user': IMAP_USER, 'password': IMAP_PASS}
+    configs.update(load_account_configs(IMAP_ACCOUNTS_FILE))
+
+    served = {}
+    for name, config in configs.items():
+        if SERVE_ACCOUNTS and name not in SERVE_ACCOUNTS:
+            continue
+        served[name] = Account(
+            name,
+            config.get('host', IMAP_HOST),
+            int(config.get('port', IMAP_PORT)),
+            config['user'],
+            config.get('password'),
+            use_ssl=config.get('ssl', IMAP_SSL),
+            # The pool size is the account's login budget for all worker processes together
+            pool_size=max(1, int(config.get('pool_size', IMAP_POOL_SIZE)) // WEB_WORKERS),
+            uid_index_path=config.get('uid_index_path') or account_path(UID_INDEX_PATH, name, DEFAULT_ACCOUNT),
+            mirror_path=config.get('mirror_path') or account_path(MIRROR_PATH, name, DEFAULT_ACCOUNT),
+            pool_options={'max_idle': IMAP_POOL_MAX_IDLE, 'keepalive_interval': IMAP_POOL_KEEPALIVE, 'acquire_timeout': IMAP_POOL_TIMEOUT,
+                          'socket_timeout': IMAP_SOCKET_TIMEOUT or None},
+            cache_options={'max_bytes': int(config.get('message_cache_bytes', MESSAGE_CACHE_BYTES)), 'ttl': MESSAGE_CACHE_TTL,
+                           'path': account_path(MESSAGE_CACHE_PATH, name, DEFAULT_ACCOUNT)}
+        )
+    logging.info(f"Serving accounts: {', '.join(served) or 'none'}")
+    return AccountRegistry(served, configs, DEFAULT_ACCOUNT)
+
+# Requests pick their account with an 'account' field, without one they go to DEFAULT_ACCOUNT
+accounts = create_accounts()
+
+# How HTML-only emails are turned into text
+set_html_engine(HTML_ENGINE)
+
+# Generated replies by content hash, so asking again for the same email costs no OpenAI call
+response_cache = ResponseCache(path=RESPONSE_CACHE_PATH or None, max_bytes=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL)
+
+# Generated replies by MinHash signature of their email, offered for near-identical emails that miss the response cache
+similar_replies = SimilarityIndex(path=SIMILARITY_INDEX_PATH or None, max_entries=SIMILARITY_INDEX_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+
+# Function to keep the mailbox mirror of an account current on its own session, outside the pool.
+# A mirror file is synced by one worker process for all of them, another one takes over if it exits
+def mirror_sync_loop(account):
+    lock = ProcessLock(f'{account.mailbox_mirror_path}.lock') if account.mailbox_mirror_path else None
+    mail = None
+    while True:
+        if lock is not None and not lock.acquire():
+            time.sleep(MIRROR_SYNC_INTERVAL)
+            continue
+        try:
+            if mail is None:
+                mail, error = account.imap_pool.open_session()
+                if error:
+                    raise imaplib.IMAP4.error(error)
+                mode = account.mailbox_mirror.prepare_session(mail)
+                logging.info(f'Mailbox mirror of {account.name} syncing INBOX in {mode} mode')
+            changes = account.mailbox_mirror.sync(mail, 'INBOX')
+            # The mirror SELECTs every interval, so a new UIDVALIDITY reaches the Message-ID index even without requests
+            account.uid_index.note_uidvalidity('INBOX', account.mailbox_mirror.uidvalidity('INBOX'))
+            if changes['added'] or changes['removed'] or changes['flag_updates']:
+                logging.info(f'Mailbox mirror of {account.name} synced: {changes}')
+        except (imaplib.IMAP4.error, OSError) as e:
+            logging.error(f'Mailbox mirror sync of {account.name} failed: {str(e)}')
+            if mail is not None:
+                account.imap_pool.close_session(mail)
+            mail = None
+        time.sleep(MIRROR_SYNC_INTERVAL)
+
+# Function to start one mirror sync thread per account
+def start_mirror_sync():
+    for account in accounts:
+        threading.Thread(target=mirror_sync_loop, args=(account,), name=f'mailbox-mirror-{account.name}', daemon=True).start()
+
+if MIRROR_SYNC_INTERVAL > 0:
+    start_mirror_sync()
+
+# Function for IMAP connection - checks out a pooled session of the account, hand it back with release_imap()
+def connect_to_imap(account):
+    return account.imap_pool.acquire()
+
+def release_imap(account, mail):
+    account.imap_pool.release(mail)
 
-# Function to search UID by message_id
-def getemailuidbymessage_id(message_id):
-    mail, error = connect_to_imap()
+# Function to search UID by message_id - served from the local index, IMAP only on a miss
+def getemailuidbymessage_id(account, message_id):
+    uid = account.mailbox_mirror.get_uid(message_id) or account.uid_index.get(message_id)
+    if uid:
+        return uid, None
+
+    mail, error = connect_to_imap(account)
     if error:
         return None, error
 
     try:
-        mail.select('inbox')
-        result, data = mail.search(None, f'HEADER Message-ID "{message_id}"')
-
-        if result == 'OK':
-            email_ids = data[0].split()
-            if email_ids:
-                result, data = mail.fetch(email_ids[0], '(UID)')
-                if result == 'OK':
-                    uid = data[0].decode().split()[2].strip(')')
-                    return uid, None
-                else:
-                    return None, 'Failed to fetch UID'
-            else:
-                return None, 'No emails found with that Message-ID'
-        else:
-            return None, 'Search for Message-ID failed'
+        return account.uid_index.lookup(mail, message_id)
+    except imaplib.IMAP4.error as e:
+        return None, f'Message-ID lookup failed: {str(e)}'
     finally:
-        mail.logout()
+        release_imap(account, mail)
 
-def getmailtextbyuid(uid):
-    try:
-        # Connect to IMAP server
-        mail, error = connect_to_imap()
-        if error:
-            return None
+# Function to select a mailbox and let the message cache know its UIDVALIDITY
+def select_cached_mailbox(account, mail, mailbox='INBOX'):
+    uidvalidity, _ = select_mailbox(mail, mailbox)
+    account.message_cache.note_uidvalidity(mailbox, uidvalidity)
+    account.uid_index.note_uidvalidity(mailbox, uidvalidity)
+    return uidvalidity
 
+# Function to get headers and text of an email, downloaded and parsed at most once while cached
+def fetch_message(account, mail, uid, mailbox='INBOX', lookup=True):
+    """
+    Returns the cached entry for a UID, fetching and parsing it on a miss.
+
+    Parameters:
+    account (Account): The account the session belongs to
+    mail: A pooled IMAP session
+    uid (str): The UID of the email
+    mailbox (str): The mailbox the UID belongs to
+    lookup (bool): Check the cache first, False when the caller just did
+
+    Returns:
+    dict: {'headers': email.message.Message, 'text': str or None} or None if the fetch failed
+    """
+    uidvalidity = select_cached_mailbox(account, mail, mailbox)
+    key = (mailbox, uidvalidity, str(uid))
+    entry = account.message_cache.get(key) if lookup else None
+    if entry:
+        return entry
+
+    # Partial mode downloads the header and the text part only, attachments stay on the server
+    if FETCH_MODE == 'partial':
         try:
-            # Select inbox and fetch email content
-            mail.select('INBOX')
-            result, data = mail.uid('FETCH', uid, '(RFC822)')
-            
-            if result != 'OK':
+            fetched = fetch_text_parts(mail, uid, FETCH_TEXT_BYTES)
+            if fetched:
+                headers, text_content, html_content = fetched
+                return account.message_cache.put(key, headers, select_text(text_content, html_content))
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            logging.warning(f'Partial fetch of UID {uid} failed, falling back to full fetch: {str(e)}')
+
+    # Streamed in windows, attachments are dropped as they pass instead of parsing the whole email at once
+    fetched = fetch_text_stream(mail, [uid], FETCH_WINDOW_BYTES, FETCH_BATCH_BYTES, FETCH_TEXT_BYTES).get(str(uid))
+    if not fetched:
+        return None
+    headers, text_content, html_content = fetched
+    return account.message_cache.put(key, headers, select_text(text_content, html_content))
+
+# Function to get headers and text of many emails, the uncached ones with a few batched FETCHes
+def fetch_messages(account, mail, uids, mailbox='INBOX'):
+    """
+    Parameters:
+    account (Account): The account the session belongs to
+    mail: A pooled IMAP session
+    uids (list): UIDs of the emails
+    mailbox (str): The mailbox the UIDs belong to
+
+    Returns:
+    dict: uid (str) -> cached entry, UIDs that could not be fetched are missing
+    """
+    uidvalidity = select_cached_mailbox(account, mail, mailbox)
+    entries = {}
+    for uid in map(str, uids):
+        entry = account.message_cache.get((mailbox, uidvalidity, uid))
+        if entry:
+            entries[uid] = entry
+    missing = [str(uid) for uid in uids if str(uid) not in entries]
+
+    if missing and FETCH_MODE == 'partial':
+        try:
+            for uid, (headers, text_content, html_content) in fetch_text_parts_batch(mail, missing, FETCH_TEXT_BYTES).items():
+                entries[uid] = account.message_cache.put((mailbox, uidvalidity, uid), headers, select_text(text_content, html_content))
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            logging.warning(f'Partial batch fetch failed, falling back to full fetch: {str(e)}')
+        missing = [uid for uid in missing if uid not in entries]
+
+    # BODY.PEEK[] instead of RFC822, a triage must not mark the whole backlog as read
+    if missing:
+        for uid, (headers, text_content, html_content) in fetch_text_stream(mail, missing, FETCH_WINDOW_BYTES, FETCH_BATCH_BYTES, FETCH_TEXT_BYTES).items():
+            entries[uid] = account.message_cache.put((mailbox, uidvalidity, uid), headers, select_text(text_content, html_content))
+    return entries
+
+def getmailtextbyuid(account, uid, mail=None):
+    # Served from the message cache without touching IMAP while the message is hot
+    entry = account.message_cache.get(account.message_cache.key('INBOX', uid))
+    if entry:
+        return entry['text']
+
+    try:
+        # Connect to IMAP server, unless the caller already holds a session
+        owns_connection = mail is None
+        if owns_connection:
+            mail, error = connect_to_imap(account)
+            if error:
                 return None
-                
-            # Parse the email content
-            import email
-            email_body = email.message_from_bytes(data[0][1])
-            
-            text_content = None
-            html_content = None
-            
-            # Extract text content from email parts
-            if email_body.is_multipart():
-                for part in email_body.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get('Content-Disposition'))
-                    
-                    # Skip attachments
-                    if 'attachment' in content_disposition:
-                        continue
-                        
-                    try:
-                        # Get the email part payload
-                        payload = part.get_payload(decode=True).decode()
-                    except:
-                        continue
-                        
-                    if content_type == 'text/plain':
-                        text_content = payload
-                    elif content_type == 'text/html':
-                        html_content = payload
-            else:
-                # Handle non-multipart emails
-                content_type = email_body.get_content_type()
-                try:
-                    payload = email_body.get_payload(decode=True).decode()
-                    if content_type == 'text/plain':
-                        text_content = payload
-                    elif content_type == 'text/html':
-                        html_content = payload
-                except:
-                    return None
-            # If plain text is available, use it
-            if text_content:
-                return text_content.strip()
-            
-            # Otherwise, convert HTML to plain text if available
-            elif html_content:
-                from bs4 import BeautifulSoup
-                soup = BeautifulSoup(html_content, 'html.parser')
-                return soup.get_text(separator='\n', strip=True)
-             
-            return None
+
+        try:
+            entry = fetch_message(account, mail, uid, lookup=False)
+            return entry['text'] if entry else None
 
         finally:
-            # Always logout from mail server
-            mail.logout()
+            # Always hand the session back to the pool
+            if owns_connection:
+                release_imap(account, mail)
             
     except Exception as e:
         logging.error(f'Error retrieving email content: {str(e)}')
         return None
 
-def create_reply_draft(uid, suggested_reply):
+# Function to build the reply message for a draft, quoting the text extracted together with the headers
+def build_reply_draft(original, suggested_reply):
+    """
+    Parameters:
+    original (dict): Message cache entry of the original email
+    suggested_reply (str): The reply text
+
+    Returns:
+    bytes: The draft as RFC 822 message
+    """
+    original_email = original['headers']
+    reply = EmailMessage()
+
+    # Set basic headers
+    reply['Message-ID'] = make_msgid()
+    reply['Date'] = formatdate(localtime=True)
+    reply['From'] = original_email.get('To')  # We are replying, so our From is their To
+
+    # Set To field (original sender)
+    original_from = original_email.get('From')
+    reply['To'] = original_from
+
+    # Set Subject
+    original_subject = original_email.get('Subject', '')
+    if not original_subject.lower().startswith('re:'):
+        reply['Subject'] = f"Re: {original_subject}"
+    else:
+        reply['Subject'] = original_subject
+
+    # Set In-Reply-To and References headers for proper threading
+    reply['In-Reply-To'] = original_email.get('Message-ID', '')
+    references = original_email.get('References', '')
+    if references:
+        reply['References'] = f"{references} {original_email['Message-ID']}"
+    else:
+        reply['References'] = original_email['Message-ID']
+
+    original_text = original['text']
+    if original_text:
+        quoted_text = '\n'.join(f'> {line}' for line in original_text.split('\n'))
+        reply_body = f"{suggested_reply}\n\n---\n\nAm {original_email['Date']} schrieb {original_from}:\n\n{quoted_text}"
+    else:
+        reply_body = suggested_reply
+
+    reply.set_content(reply_body)
+    return reply.as_string().encode('utf-8')
+
+def create_reply_draft(account, uid, suggested_reply):
     """
     Creates a draft reply to an email using the suggested text.
-    
+
+    The original comes from the message cache when hot and the Drafts folder from the
+    special-use lookup, so a draft usually costs a single APPEND and no SELECT.
+
     Parameters:
+    account (Account): The account of the original email
     uid (str): The UID of the original email to reply to
     suggested_reply (str): The suggested reply text from ChatGPT
-    
+
     Returns:
     tuple: (success: bool, message: str)
     """
     try:
+        # Usually still cached from generating the suggestion
+        original = account.message_cache.get(account.message_cache.key('INBOX', uid))
+
         # Connect to IMAP server
-        mail, error = connect_to_imap()
+        mail, error = connect_to_imap(account)
         if error:
             return False, f"IMAP connection failed: {error}"
 
         try:
-            # Select inbox and fetch original email
-            mail.select('INBOX')
-            result, data = mail.uid('FETCH', uid, '(RFC822)')
-            
-            if result != 'OK':
-                return False, "Failed to fetch original email"
-                
-            # Parse the original email
-            import email
-            from email.message import EmailMessage
-            from email.utils import make_msgid, formatdate
-            
-            original_email = email.message_from_bytes(data[0][1])
-            
-            # Create new message
-            reply = EmailMessage()
-            
-            # Set basic headers
-            reply['Message-ID'] = make_msgid()
-            reply['Date'] = formatdate(localtime=True)
-            reply['From'] = original_email.get('To')  # We are replying, so our From is their To
-            
-            # Set To field (original sender)
-            original_from = original_email.get('From')
-            reply['To'] = original_from
-            
-            # Set Subject
-            original_subject = original_email.get('Subject', '')
-            if not original_subject.lower().startswith('re:'):
-                reply['Subject'] = f"Re: {original_subject}"
-            else:
-                reply['Subject'] = original_subject
-                
-            # Set In-Reply-To and References headers for proper threading
-            reply['In-Reply-To'] = original_email.get('Message-ID', '')
-            references = original_email.get('References', '')
-            if references:
-                reply['References'] = f"{references} {original_email['Message-ID']}"
-            else:
-                reply['References'] = original_email['Message-ID']
-
-            # Prepare the reply text
-            # First, get the original email text for quoting
-            original_text = getmailtextbyuid(uid)
-            if original_text:
-                quoted_text = '\n'.join(f'> {line}' for line in original_text.split('\n'))
-                reply_body = f"{suggested_reply}\n\n---\n\nAm {original_email['Date']} schrieb {original_from}:\n\n{quoted_text}"
-            else:
-                reply_body = suggested_reply
+            if not original:
+                original = fetch_message(account, mail, uid, lookup=False)
+                if not original:
+                    return False, "Failed to fetch original email"
 
-            # Set the content
-            reply.set_content(reply_body)
+            drafts = account.special_folders.get(mail, '\\Drafts')
+            if not drafts:
+                return False, "Could not find Drafts folder"
 
-            # Convert to string and encode
-            reply_string = reply.as_string().encode('utf-8')
-            
-            # Append to Drafts folder
-            try:
-                # First, try to select 'Drafts' folder
-                result = mail.select('Drafts')
-                if result[0] != 'OK':
-                    # If 'Drafts' doesn't exist, try 'Entwürfe' (German)
-                    result = mail.select('Entwürfe')
-                    if result[0] != 'OK':
-                        return False, "Could not find Drafts folder"
-
-                # Append the draft
-                result = mail.append('Drafts' if result[0] == 'OK' else 'Entwürfe', 
-                                   '', 
-                                   imaplib.Time2Internaldate(time.time()), 
-                                   reply_string)
-                
-                if result[0] != 'OK':
-                    return False, "Failed to save draft"
-                    
-                return True, "Draft created successfully"
-                
-            except imaplib.IMAP4.error as e:
-                return False, f"IMAP error while saving draft: {str(e)}"
+            # APPEND works without a selected mailbox
+            result = mail.append(quote_mailbox(drafts), '(\\Draft \\Seen)',
+                                 imaplib.Time2Internaldate(time.time()),
+                                 build_reply_draft(original, suggested_reply))
+            if result[0] != 'OK':
+                # The folder may have been renamed, look it up again next time
+                account.special_folders.forget()
+                return False, "Failed to save draft"
+
+            return True, "Draft created successfully"
+
+        except imaplib.IMAP4.error as e:
+            return False, f"IMAP error while saving draft: {str(e)}"
 
         finally:
-            # Always logout from mail server
-            mail.logout()
-            
+            # Always hand the session back to the pool
+            release_imap(account, mail)
+
     except Exception as e:
         logging.error(f'Error creating reply draft: {str(e)}')
         return False, f"Error creating reply draft: {str(e)}"
 
+# Function to report the outcome of a draft in a response
+def draft_result(account, uid, suggested_reply):
+    success, message = create_reply_draft(account, uid, suggested_reply)
+    return {'status': 'success' if success else 'error', 'message': message}
+
+# Route IMAP - save a reply as draft ('message' is the reply text)
+def handle_create_draft(data):
+    uid = data.get('uid')
+    suggested_reply = data.get('message')
+
+    if not uid:
+        return {'status': 'error', 'message': 'UID not provided'}
+    if not suggested_reply:
+        return {'status': 'error', 'message': 'Reply text not provided'}
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
+
+    return draft_result(account, str(uid), suggested_reply)
+
+@app.route('/create-draft', methods=['POST'])
+def create_draft():
+    return jsonify(handle_create_draft(request.get_json()))
+
 # Route IMAP - get UID by message_id
-@app.route('/get-uid', methods=['POST'])
-def get_uid():
-    data = request.get_json()
+def handle_get_uid(data):
     message_id = data.get('message_id')
 
     # Validate message_id
     if not message_id:
-        return jsonify({'status': 'error', 'message': 'Message-ID not provided'})
+        return {'status': 'error', 'message': 'Message-ID not provided'}
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
 
     # Attempt to retrieve the UID
-    uid, error = getemailuidbymessage_id(message_id)
+    uid, error = getemailuidbymessage_id(account, message_id)
 
     if error:
         # Handle error during UID retrieval
-        return jsonify({'status': 'error', 'message': f'Error retrieving UID: {error}'})
+        return {'status': 'error', 'message': f'Error retrieving UID: {error}'}
 
     if uid:
         # Success: UID found
-        return jsonify({'status': 'success', 'uid': uid, 'message': f'UID found for Message-ID'})
+        return {'status': 'success', 'uid': uid, 'message': 'UID found for Message-ID'}
     else:
         # UID not found
-        return jsonify({'status': 'error', 'message': f'UID not found for Message-ID {message_id}'})
+        return {'status': 'error', 'message': f'UID not found for Message-ID {message_id}'}
 
-# Route IMAP - move email to Trash
-@app.route('/move-email', methods=['POST'])
-def move_email():
-    data = request.get_json()
+@app.route('/get-uid', methods=['POST'])
+def get_uid():
+    return jsonify(handle_get_uid(request.get_json()))
+
+# System flags (\\Seen) and keywords, nothing that could break out of the flag list
+FLAG_RE = re.compile(r'^\\?[A-Za-z0-9$_.-]+$')
+
+# Helper - validate a list of UIDs from a request body
+def parse_uid_list(uids):
+    if not isinstance(uids, list) or not uids:
+        return None, 'UIDs must be a non-empty list'
+    uids = [str(uid).strip() for uid in uids]
+    invalid = [uid for uid in uids if not uid.isdigit()]
+    if invalid:
+        return None, f'Invalid UIDs: {", ".join(invalid)}'
+    return uids, None
+
+# Helper - run a batch operation on INBOX with one pooled session and report per UID
+def run_batch(account, uids, operation):
+    uids, error = parse_uid_list(uids)
+    if error:
+        return {'status': 'error', 'message': error}
+
+    mail, error = connect_to_imap(account)
+    if error:
+        return {'status': 'error', 'message': f'IMAP connection error: {error}'}
+
+    try:
+        select_cached_mailbox(account, mail)
+        results = operation(mail, uids)
+        status = summarize(results)
+        succeeded = sum(1 for result in results.values() if result['status'] == 'success')
+        return {
+            'status': status,
+            'message': f'{succeeded} of {len(results)} emails processed successfully',
+            'results': results
+        }
+
+    except imaplib.IMAP4.error as e:
+        return {'status': 'error', 'message': f'Batch command failed: {str(e)}'}
+
+    finally:
+        # Always hand the session back to the pool
+        release_imap(account, mail)
+
+# Helper - move UIDs from INBOX to Trash and forget those that left INBOX, copies still in it stay known
+def move_to_trash(account, mail, uids):
+    results = move_uids(mail, uids, 'Trash')
+    moved = [uid for uid, result in results.items() if result['status'] == 'success']
+    account.uid_index.discard_uids(moved)
+    account.mailbox_mirror.discard_uids(moved)
+    account.message_cache.discard('INBOX', moved)
+    return results
+
+# Route IMAP - move email to Trash (single 'uid' or a list of 'uids')
+def handle_move_email(data):
     uid = data.get('uid')
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
+
+    if 'uids' in data:
+        return run_batch(account, data.get('uids'), lambda mail, uids: move_to_trash(account, mail, uids))
 
     # Validate UID
     if not uid:
-        return jsonify({'status': 'error', 'message': 'UID not provided'})
+        return {'status': 'error', 'message': 'UID not provided'}
+    uids, error = parse_uid_list([uid])
+    if error:
+        return {'status': 'error', 'message': error}
 
     # Connect to IMAP
-    mail, error = connect_to_imap()
+    mail, error = connect_to_imap(account)
     if error:
-        return jsonify({'status': 'error', 'message': f'IMAP connection error: {error}'})
+        return {'status': 'error', 'message': f'IMAP connection error: {error}'}
 
     try:
-        # Select INBOX and attempt to move the email to Trash
-        mail.select('INBOX')
-        result = mail.uid('MOVE', uid, 'Trash')
+        # Select INBOX and attempt to move the email to Trash, with the COPY fallback of the batch path
+        select_cached_mailbox(account, mail)
+        result = move_to_trash(account, mail, uids)[uids[0]]
 
-        if result[0] == 'OK':
-            # Successful move
-            return jsonify({'status': 'success', 'message': f'Email moved to Trash successfully'})
-        else:
-            # Failed to move email
-            return jsonify({'status': 'error', 'message': f'Failed to move email with UID {uid}'})
+        if result['status'] == 'success':
+            return {'status': 'success', 'message': 'Email moved to Trash successfully'}
+        if result['status'] == 'partial':
+            # Copied to Trash, but the original is still in INBOX
+            return {'status': 'partial', 'message': f"{result['message']} for UID {uid}"}
+        # Failed to move email
+        return {'status': 'error', 'message': f"Failed to move email with UID {uid}: {result['message']}"}
 
     except imaplib.IMAP4.error as e:
         # Handle IMAP errors
-        return jsonify({'status': 'error', 'message': f'MOVE command failed: {str(e)} for UID {uid}'})
+        return {'status': 'error', 'message': f'MOVE command failed: {str(e)} for UID {uid}'}
 
     finally:
-        # Always logout from the mail server
-        mail.logout()
+        # Always hand the session back to the pool
+        release_imap(account, mail)
 
-# Route IMAP - mark email as read
-@app.route('/mark-as-read', methods=['POST'])
-def mark_as_read():
-    data = request.get_json()
+@app.route('/move-email', methods=['POST'])
+def move_email():
+    return jsonify(handle_move_email(request.get_json()))
+
+# Helper - STORE flags and apply what succeeded to the mailbox mirror
+def store_mirrored_flags(account, mail, uids, flags, action, silent):
+    results = store_flags(mail, uids, flags, action, silent)
+    account.mailbox_mirror.apply_flags([uid for uid, result in results.items() if result['status'] == 'success'], flags, action)
+    return results
+
+# Route IMAP - mark email as read (single 'uid' or a list of 'uids')
+def handle_mark_as_read(data):
     uid = data.get('uid')
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
+
+    if 'uids' in data:
+        silent = data.get('silent', True)
+        return run_batch(account, data.get('uids'), lambda mail, uids: store_mirrored_flags(account, mail, uids, ['\\Seen'], 'add', silent))
 
     # Validate UID
     if not uid:
-        return jsonify({'status': 'error', 'message': 'UID not provided'})
+        return {'status': 'error', 'message': 'UID not provided'}
 
     # Connect to IMAP
-    mail, error = connect_to_imap()
+    mail, error = connect_to_imap(account)
     if error:
-        return jsonify({'status': 'error', 'message': f'IMAP connection error: {error}'})
+        return {'status': 'error', 'message': f'IMAP connection error: {error}'}
 
     try:
         # Select INBOX
-        mail.select('INBOX')
+        select_cached_mailbox(account, mail)
 
         # Set the \Seen flag to mark the email as read
         result = mail.uid('STORE', uid, '+FLAGS', '(\\Seen)')
         
         if result[0] == 'OK':
-            # Success response
-            return jsonify({'status': 'success', 'message': 'Email marked as read successfully'})
+            # Success response, the mirror knows the new flag without a resync
+            account.mailbox_mirror.apply_flags([uid], ['\\Seen'])
+            return {'status': 'success', 'message': 'Email marked as read successfully'}
         else:
             # Failed to mark email as read
-            return jsonify({'status': 'error', 'message': f'Failed to mark email {uid} as read'})
+            return {'status': 'error', 'message': f'Failed to mark email {uid} as read'}
 
     except imaplib.IMAP4.error as e:
         # Handle IMAP errors
-        return jsonify({'status': 'error', 'message': f'Error marking email as read: {str(e)}'})
+        return {'status': 'error', 'message': f'Error marking email as read: {str(e)}'}
 
     finally:
-        # Always logout from the mail server
-        mail.logout()
+        # Always hand the session back to the pool
+        release_imap(account, mail)
 
-# Route OpenAI suggest answer
-@app.route('/suggest-answer', methods=['POST'])
-def suggest_answer():
+@app.route('/mark-as-read', methods=['POST'])
+def mark_as_read():
+    return jsonify(handle_mark_as_read(request.get_json()))
+
+# Route IMAP - add, remove or replace flags on a list of UIDs
+def handle_set_flags(data):
+    flags = data.get('flags')
+    action = data.get('action', 'add')
+    silent = data.get('silent', True)
+
+    # Validate flags and action
+    if not isinstance(flags, list) or not flags:
+        return {'status': 'error', 'message': 'Flags not provided'}
+    if action not in ('add', 'remove', 'replace'):
+        return {'status': 'error', 'message': f'Unknown action {action}'}
+    invalid = [flag for flag in flags if not FLAG_RE.match(str(flag))]
+    if invalid:
+        return {'status': 'error', 'message': f'Invalid flags: {", ".join(map(str, invalid))}'}
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
+
+    return run_batch(account, data.get('uids'), lambda mail, uids: store_mirrored_flags(account, mail, uids, flags, action, silent))
+
+@app.route('/set-flags', methods=['POST'])
+def set_flags():
+    return jsonify(handle_set_flags(request.get_json()))
+
+# Route - search INBOX by Message-ID, UIDs, sender, subject or flags, answered from the mailbox mirror
+def handle_find_emails(data):
+    flags = data.get('flags') or []
+    without_flags = data.get('without_flags') or []
+    if not isinstance(flags, list) or not isinstance(without_flags, list):
+        return {'status': 'error', 'message': 'Flags must be lists'}
+    invalid = [flag for flag in flags + without_flags if not FLAG_RE.match(str(flag))]
+    if invalid:
+        return {'status': 'error', 'message': f'Invalid flags: {", ".join(map(str, invalid))}'}
+    uids = None
+    if 'uids' in data:
+        uids, error = parse_uid_list(data.get('uids'))
+        if error:
+            return {'status': 'error', 'message': error}
     try:
-        data = request.json
-        uid = data.get('uid')
-        user_context = data.get('context', '')
+        limit = min(max(int(data.get('limit', 50)), 1), 1000)
+    except (TypeError, ValueError):
+        return {'status': 'error', 'message': 'Invalid limit'}
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
 
-        # Get email content using helper function
-        email_content = getmailtextbyuid(uid)
-        
-        if not email_content:
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to retrieve email content'
-            })
+    # 'refresh': true resyncs before answering, otherwise the answer is as fresh as the last background sync
+    if data.get('refresh'):
+        mail, error = connect_to_imap(account)
+        if error:
+            return {'status': 'error', 'message': f'IMAP connection error: {error}'}
+        try:
+            account.mailbox_mirror.sync(mail, 'INBOX')
+            account.uid_index.note_uidvalidity('INBOX', account.mailbox_mirror.uidvalidity('INBOX'))
+        except imaplib.IMAP4.error as e:
+            return {'status': 'error', 'message': f'Mirror sync failed: {str(e)}'}
+        finally:
+            release_imap(account, mail)
+
+    emails = account.mailbox_mirror.find(
+        uids=uids,
+        message_id=data.get('message_id'),
+        sender=data.get('from'),
+        subject=data.get('subject'),
+        flags=flags,
+        without_flags=without_flags,
+        limit=limit
+    )
+    synced_at = account.mailbox_mirror.synced_at()
+    return {
+        'status': 'success',
+        'message': f'{len(emails)} emails found',
+        'emails': emails,
+        'synced_seconds_ago': round(time.time() - synced_at, 1) if synced_at else None
+    }
+
+@app.route('/find-emails', methods=['POST'])
+def find_emails():
+    return jsonify(handle_find_emails(request.get_json()))
+
+# Route IMAP - connection pool statistics, 'pool' is the default account
+def handle_pool_stats():
+    default = accounts.get()
+    return {
+        'status': 'success',
+        'pool': default.imap_pool.stats() if default else None,
+        'accounts': {account.name: account.imap_pool.stats() for account in accounts}
+    }
+
+@app.route('/pool-stats', methods=['GET'])
+def pool_stats():
+    return jsonify(handle_pool_stats())
+
+# Route - Message-ID index and message cache statistics, the top level is the default account
+def handle_cache_stats():
+    stats = {'status': 'success', 'response_cache': response_cache.stats()}
+    default = accounts.get()
+    if default:
+        stats.update({key: value for key, value in default.stats().items() if key not in ('user', 'pool')})
+    stats['accounts'] = accounts.stats()
+    return stats
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(handle_cache_stats())
+
+# Route - latency histograms and counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+# Function to count the tokens OpenAI billed for a completion
+def record_openai_usage(usage):
+    if usage:
+        openai_tokens.inc(usage.prompt_tokens, 'prompt')
+        openai_tokens.inc(usage.completion_tokens, 'completion')
 
-        # Construct prompt for ChatGPT
-        prompt = f"""
+# Tokens the prompt preprocessing kept away from OpenAI
+prompt_savings = {'requests': 0, 'tokens_before': 0, 'tokens_after': 0, 'truncated': 0}
+prompt_savings_lock = threading.Lock()
+
+# Function to drop quoted history, signature and disclaimers from an email and cut it to the token budget
+def prepare_prompt_text(email_content):
+    with phase_seconds.time('prompt_prep'):
+        return prepare_email_text(email_content, PROMPT_TOKEN_BUDGET)
+
+# Function to count what the preprocessing saved on a prompt that goes to OpenAI
+def record_prompt_savings(stats):
+    logging.info(f"Prompt preprocessing saved {stats['tokens_saved']} of {stats['tokens_before']} tokens "
+                 f"(removed: {', '.join(stats['removed']) or 'nothing'})")
+    with prompt_savings_lock:
+        prompt_savings['requests'] += 1
+        prompt_savings['tokens_before'] += stats['tokens_before']
+        prompt_savings['tokens_after'] += stats['tokens_after']
+        prompt_savings['truncated'] += 'truncated' in stats['removed']
+
+# Function to build the ChatGPT messages for a prepared email and the user's hint
+def prompt_messages(email_text, user_context):
+    # Construct prompt for ChatGPT
+    prompt = f"""
         Basierend auf der folgenden E-Mail und dem Kontext, erstelle bitte eine professionelle Antwort:
         
         Original E-Mail:
-        {email_content}
+        {email_text}
         
         Hinweis vom Benutzer für die Antwort:
         {user_context}
         """
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+# Tokens per minute for OpenAI, split between the worker processes like the IMAP logins
+openai_budget = TokenBudget(OPENAI_TPM // WEB_WORKERS if OPENAI_TPM else 0)
+
+# Function to estimate the most a completion can cost, reserved from the budget before the call
+def estimate_tokens(messages):
+    return sum(count_tokens(message['content']) for message in messages) + OPENAI_MAX_TOKENS
+
+# Function to ask ChatGPT for a reply within the tokens-per-minute budget
+def complete_reply(messages):
+    reserved = estimate_tokens(messages)
+    time.sleep(openai_budget.reserve(reserved))
+    try:
+        with phase_seconds.time('openai'):
+            response = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=OPENAI_TEMPERATURE,
+                max_tokens=OPENAI_MAX_TOKENS
+            )
+    except Exception:
+        openai_budget.settle(reserved, 0)
+        raise
+    record_openai_usage(response.usage)
+    openai_budget.settle(reserved, response.usage.total_tokens if response.usage else None)
+    return response.choices[0].message.content
+
+# Function to tell the tokens a streamed completion used. Without its usage chunk nothing is billed when the request
+# failed, a stream that broke off is counted as the prompt plus one token per chunk relayed
+def streamed_tokens(reserved, usage, chunks):
+    if usage is not None:
+        return usage.total_tokens
+    if chunks is None:
+        return 0
+    return reserved - OPENAI_MAX_TOKENS + chunks
+
+# Function to build the response cache key of a suggestion request
+def suggestion_cache_key(email_content, user_context):
+    return ResponseCache.key(email_content, user_context, SYSTEM_PROMPT, OPENAI_MODEL, OPENAI_TEMPERATURE, OPENAI_MAX_TOKENS)
+
+# OpenAI calls the similarity index answered or shortened, and the ones it could not
+similarity_savings = {'reused': 0, 'adapted': 0, 'full': 0, 'full_seconds': 0.0, 'adapted_seconds': 0.0, 'tokens_saved': 0}
+similarity_savings_lock = threading.Lock()
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+
+# Function to build the messages that ask ChatGPT to adapt the answer to a near-identical email. Instead of
+# the whole email the prompt only carries the sentences in which the two emails differ
+def build_adapt_messages(email_text, match, user_context):
+    earlier = [sentence.strip() for sentence in SENTENCE_RE.split(match['email_text']) if sentence.strip()]
+    current = [sentence.strip() for sentence in SENTENCE_RE.split(email_text) if sentence.strip()]
+    earlier_set, current_set = set(earlier), set(current)
+    added = '\n'.join(sentence for sentence in current if sentence not in earlier_set)
+    removed = '\n'.join(sentence for sentence in earlier if sentence not in current_set)
+    prompt = f"""
+        Die folgende Antwort wurde für eine fast gleiche E-Mail erstellt:
+        {match['reply']}
         
-        # Call ChatGPT API with new client
-        response = client.chat.completions.create(
-            model="gpt-4", 
-            messages=[
-                {"role": "system", "content": "Erstelle Mail-Antworten für eine Internetagentur. Ansprache Sie oder du je nach E-Mail. Halte den Ton professionell, präzise sowie strukturiert und freundlich. Bitte erstelle NUR die E-Mail-Antwort ohne Betreff, einleitende Worte oder Erläuterungen nach dem E-Mail-Text. Verzichte generell auf 'und mit Kommas' (und,)"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.6,
-            max_tokens=500
-        )
+        Neu in der aktuellen E-Mail:
+        {added or '-'}
         
-        suggested_reply = response.choices[0].message.content
-
-        # success, message = create_reply_draft(uid, suggested_reply)
+        Nicht mehr in der aktuellen E-Mail:
+        {removed or '-'}
         
-        return jsonify({
+        Hinweis vom Benutzer für die Antwort:
+        {user_context}
+        
+        Passe die Antwort an die aktuelle E-Mail an und ändere nur, was die Unterschiede erfordern.
+        """
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+# Function to decide how to answer an email
+def plan_suggestion(email_content, user_context, regenerate=False):
+    """
+    Looks for an answer that needs no OpenAI call, else for the cheapest prompt.
+
+    An answer for the same email comes from the response cache. An earlier answer for a
+    near-identical email is reused from SIMILARITY_REUSE_THRESHOLD on, and from
+    SIMILARITY_ADAPT_THRESHOLD on ChatGPT adapts it with only the differences in the prompt.
+
+    Parameters:
+    email_content (str): Text of the email
+    user_context (str): Hint from the user for the answer
+    regenerate (bool): Skip the response cache and the similarity index
+
+    Returns:
+    dict: 'reply' when no call is needed ('mode' cached or reused), else the 'messages' for ChatGPT
+          ('mode' adapted or full) - hand the plan and the answer to remember_suggestion()
+    """
+    plan = {
+        'cache_key': suggestion_cache_key(email_content, user_context),
+        # Earlier answers are only offered for the same hint, system prompt and model
+        'scope': suggestion_cache_key('', user_context),
+        'reply': None,
+        'messages': None,
+        'mode': 'full',
+        'similarity': None,
+        'email_text': None,
+        'tokens_saved': 0
+    }
+    if not regenerate:
+        plan['reply'] = response_cache.get(plan['cache_key'])
+        if plan['reply'] is not None:
+            plan['mode'] = 'cached'
+            return plan
+
+    email_text, stats = prepare_prompt_text(email_content)
+    plan['email_text'] = email_text
+    messages = prompt_messages(email_text, user_context)
+    thresholds = [threshold for threshold in (SIMILARITY_REUSE_THRESHOLD, SIMILARITY_ADAPT_THRESHOLD) if threshold]
+    if thresholds and not regenerate:
+        with phase_seconds.time('similarity'):
+            match = similar_replies.find(email_text, plan['scope'], min(thresholds))
+        if match:
+            plan['similarity'] = round(match['similarity'], 3)
+            # An answer naming the earlier sender or their order number is adapted, not reused
+            if (SIMILARITY_REUSE_THRESHOLD and match['similarity'] >= SIMILARITY_REUSE_THRESHOLD
+                    and not mentions_changes(match['reply'], match['email_text'], email_text)):
+                plan.update(reply=match['reply'], mode='reused')
+                response_cache.put(plan['cache_key'], match['reply'])
+                with similarity_savings_lock:
+                    similarity_savings['reused'] += 1
+                return plan
+            adapt_messages = build_adapt_messages(email_text, match, user_context)
+            tokens_saved = estimate_tokens(messages) - estimate_tokens(adapt_messages)
+            # Emails that differ all over make no shorter prompt
+            if tokens_saved > 0:
+                plan.update(messages=adapt_messages, mode='adapted', tokens_saved=tokens_saved)
+                return plan
+
+    record_prompt_savings(stats)
+    plan['messages'] = messages
+    return plan
+
+# Function to keep an answer ChatGPT wrote for a plan, for the same email and for near-identical ones
+def remember_suggestion(plan, suggested_reply, seconds):
+    response_cache.put(plan['cache_key'], suggested_reply)
+    with similarity_savings_lock:
+        similarity_savings[plan['mode']] += 1
+        similarity_savings[f"{plan['mode']}_seconds"] += seconds
+        similarity_savings['tokens_saved'] += plan['tokens_saved']
+    if SIMILARITY_REUSE_THRESHOLD or SIMILARITY_ADAPT_THRESHOLD:
+        similar_replies.put(plan['email_text'], plan['scope'], suggested_reply)
+
+# Function to format one Server-Sent Event
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+# Function to replay a cached answer in the same event format as a live stream
+def cached_suggestion(suggested_reply, account=None, draft_uid=None):
+    yield sse_event({'delta': suggested_reply})
+    done = {'status': 'success', 'message': suggested_reply, 'done': True, 'cached': True}
+    if draft_uid:
+        done['draft'] = draft_result(account, draft_uid, suggested_reply)
+    yield sse_event(done)
+
+# Function to relay the ChatGPT answer for a plan token by token as Server-Sent Events, saved as draft when draft_uid is set
+def stream_suggestion(plan, account=None, draft_uid=None):
+    suggested_reply = ''
+    reserved = estimate_tokens(plan['messages'])
+    time.sleep(openai_budget.reserve(reserved))
+    started = time.perf_counter()
+    first_token = True
+    usage = chunks = None
+    try:
+        try:
+            stream = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=plan['messages'],
+                temperature=OPENAI_TEMPERATURE,
+                max_tokens=OPENAI_MAX_TOKENS,
+                stream=True,
+                # The last chunk then carries the token usage and no choices
+                stream_options={'include_usage': True}
+            )
+            chunks = 0
+            for chunk in stream:
+                if not chunk.choices:
+                    record_openai_usage(chunk.usage)
+                    usage = chunk.usage
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token:
+                        phase_seconds.observe(time.perf_counter() - started, 'openai_first_token')
+                        first_token = False
+                    chunks += 1
+                    suggested_reply += delta
+                    yield sse_event({'delta': delta})
+            phase_seconds.observe(time.perf_counter() - started, 'openai')
+        finally:
+            # Also when the stream fails or the client goes away before the usage chunk
+            openai_budget.settle(reserved, streamed_tokens(reserved, usage, chunks))
+        remember_suggestion(plan, suggested_reply, time.perf_counter() - started)
+        done = {'status': 'success', 'message': suggested_reply, 'done': True}
+        if draft_uid:
+            done['draft'] = draft_result(account, draft_uid, suggested_reply)
+        yield sse_event(done)
+    except Exception as e:
+        logging.error(f'Error while streaming suggested answer: {str(e)}')
+        yield sse_event({'status': 'error', 'message': str(e), 'done': True})
+
+# Function to generate a suggested answer without streaming
+def generate_suggestion(account, uid, user_context, regenerate=False):
+    """
+    Fetches the email and asks ChatGPT for a reply, unless the same or a near-identical request was answered before.
+
+    Parameters:
+    account (Account): The account of the email
+    uid (str): The UID of the email
+    user_context (str): Hint from the user for the answer
+    regenerate (bool): Skip the response cache and ask ChatGPT again
+
+    Returns:
+    tuple: (suggested_reply, error)
+    """
+    email_content = getmailtextbyuid(account, uid)
+    if not email_content:
+        return None, 'Failed to retrieve email content'
+
+    plan = plan_suggestion(email_content, user_context, regenerate)
+    if plan['reply'] is not None:
+        return plan['reply'], None
+
+    started = time.perf_counter()
+    suggested_reply = complete_reply(plan['messages'])
+    remember_suggestion(plan, suggested_reply, time.perf_counter() - started)
+    return suggested_reply, None
+
+# Job handler - runs on a worker thread of the job queue
+def run_suggestion_job(payload):
+    account, error = accounts.resolve(payload['account'])
+    if error:
+        return None, error
+    suggested_reply, error = generate_suggestion(account, payload['uid'], payload['context'], payload['regenerate'])
+    if suggested_reply and payload.get('draft'):
+        success, message = create_reply_draft(account, payload['uid'], suggested_reply)
+        if not success:
+            logging.error(f"Draft for UID {payload['uid']} failed: {message}")
+    return suggested_reply, error
+
+# Function to report a finished job to the Discord bot, like the workflow does after a synchronous call
+def post_job_callback(callback_url, discord_message_id, job):
+    payload = {
+        'action': 'suggest',
+        'status': job['status'],
+        'message': job['result'] if job['status'] == 'success' else job['message'],
+        'discordMessageId': discord_message_id,
+        'jobId': job['id']
+    }
+    response = requests.post(callback_url, json=payload, timeout=30)
+    if response.status_code != 200:
+        logging.error(f'Job callback to {callback_url} failed: {response.status_code}')
+
+# Suggestions run one at a time per (uid, context), at most JOB_WORKERS in parallel
+suggestion_jobs = JobQueue(run_suggestion_job, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED, result_ttl=JOB_RESULT_TTL,
+                           path=JOB_STORE_PATH)
+
+# Route OpenAI suggest answer as a job - answers with the job ID right away
+def handle_submit_suggestion(data):
+    uid = data.get('uid')
+    if not uid:
+        return {'status': 'error', 'message': 'UID not provided'}
+    user_context = data.get('context', '')
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return {'status': 'error', 'message': error}
+
+    # With a Discord message ID the result is sent to the bot's /update-message when ready
+    callback = None
+    discord_message_id = data.get('discordMessageId')
+    if discord_message_id:
+        callback_url = data.get('callback_url') or UPDATE_MESSAGE_URL
+        callback = lambda job: post_job_callback(callback_url, str(discord_message_id), job)
+
+    payload = {
+        'account': account.name,
+        'uid': str(uid),
+        'context': user_context,
+        'regenerate': bool(data.get('regenerate')),
+        'draft': bool(data.get('draft'))
+    }
+    # A draft request does not join a job that would not save one, a regenerate request none that may answer from the cache
+    job, error = suggestion_jobs.submit((account.name, str(uid), user_context, payload['regenerate'], payload['draft']), payload, callback)
+    if error:
+        return {'status': 'error', 'message': error}
+    return {
+        'status': 'success',
+        'message': 'Joined pending job' if job['deduplicated'] else 'Job queued',
+        'job_id': job['id'],
+        'job_status': job['status'],
+        'deduplicated': job['deduplicated']
+    }
+
+# Route - poll a suggestion job
+def handle_get_job(job_id):
+    job = suggestion_jobs.get(job_id)
+    if job is None:
+        return {'status': 'error', 'message': f'Job {job_id} not found'}
+    return {'status': 'success', 'job': job}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    return jsonify(handle_get_job(job_id))
+
+# Route - tokens saved by prompt preprocessing
+def handle_prompt_stats():
+    with prompt_savings_lock:
+        stats = dict(prompt_savings)
+    stats['tokens_saved'] = stats['tokens_before'] - stats['tokens_after']
+    stats['budget'] = PROMPT_TOKEN_BUDGET
+    return {'status': 'success', 'prompt': stats}
+
+@app.route('/prompt-stats', methods=['GET'])
+def prompt_stats():
+    return jsonify(handle_prompt_stats())
+
+# Route - job queue depth and wait times
+@app.route('/job-stats', methods=['GET'])
+def job_stats():
+    return jsonify({'status': 'success', 'jobs': suggestion_jobs.stats()})
+
+# OpenAI calls of triage runs, shared so that parallel runs stay within TRIAGE_CONCURRENCY together
+triage_executor = ThreadPoolExecutor(max_workers=TRIAGE_CONCURRENCY, thread_name_prefix='triage')
+
+# Function to load the emails of a triage run on one session: UID SEARCH UNSEEN unless UIDs are given, then batched fetches
+def prepare_triage(data):
+    """
+    Returns:
+    tuple: ((account, [(uid, entry or None), ...]), error)
+    """
+    account, error = accounts.resolve(data.get('account'))
+    if error:
+        return None, error
+    uids = None
+    if data.get('uids') is not None:
+        uids, error = parse_uid_list(data.get('uids'))
+        if error:
+            return None, error
+
+    mail, error = connect_to_imap(account)
+    if error:
+        return None, f'IMAP connection error: {error}'
+    try:
+        if uids is None:
+            select_cached_mailbox(account, mail)
+            result, found = mail.uid('SEARCH', None, 'UNSEEN')
+            if result != 'OK':
+                return None, 'Search for unseen emails failed'
+            uids = [uid.decode() for uid in (found[0] or b'').split()] if found else []
+        uids = uids[:TRIAGE_MAX_MESSAGES]
+        entries = fetch_messages(account, mail, uids) if uids else {}
+    except imaplib.IMAP4.error as e:
+        return None, f'Fetching emails failed: {str(e)}'
+    finally:
+        release_imap(account, mail)
+    return (account, [(uid, entries.get(uid)) for uid in uids]), None
+
+# Function to describe one triaged email in a result
+def triage_result(uid, entry, result):
+    headers = entry['headers'] if entry else None
+    return dict({
+        'uid': uid,
+        'subject': decode_words(headers.get('Subject')) if headers else None,
+        'from': decode_words(headers.get('From')) if headers else None,
+    }, **result)
+
+# Function to answer the emails of a triage run that share one prompt with one OpenAI call, runs on the triage pool
+def triage_reply(account, group, plan, draft):
+    started = time.perf_counter()
+    suggested_reply = complete_reply(plan['messages'])
+    remember_suggestion(plan, suggested_reply, time.perf_counter() - started)
+    results = []
+    for index, (uid, entry) in enumerate(group):
+        # Only the first email asked ChatGPT, the others reuse its answer
+        result = {'status': 'success', 'message': suggested_reply, 'cached': index > 0}
+        if plan['similarity'] is not None:
+            result['similarity'] = plan['similarity']
+        if draft:
+            result['draft'] = draft_result(account, uid, suggested_reply)
+        results.append(triage_result(uid, entry, result))
+    return results
+
+# Function to suggest answers for a triage run: cached and reused answers right away, the others as their OpenAI
+# calls finish. Emails with the same text share one call, like they share one response cache entry
+def run_triage(account, items, user_context, regenerate=False, draft=False):
+    futures = {}
+    try:
+        groups = {}
+        for uid, entry in items:
+            email_content = entry['text'] if entry else None
+            if not email_content:
+                yield triage_result(uid, entry, {'status': 'error', 'message': 'Failed to retrieve email content'})
+                continue
+            cache_key = suggestion_cache_key(email_content, user_context)
+            if cache_key in groups:
+                groups[cache_key][1].append((uid, entry))
+                continue
+            plan = plan_suggestion(email_content, user_context, regenerate)
+            if plan['reply'] is not None:
+                result = {'status': 'success', 'message': plan['reply'], 'cached': True}
+                if plan['similarity'] is not None:
+                    result['similarity'] = plan['similarity']
+                if draft:
+                    result['draft'] = draft_result(account, uid, plan['reply'])
+                yield triage_result(uid, entry, result)
+                continue
+            groups[cache_key] = (plan, [(uid, entry)])
+
+        for plan, group in groups.values():
+            futures[triage_executor.submit(triage_reply, account, group, plan, draft)] = group
+
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                yield from future.result()
+            except Exception as e:
+                logging.error(f'Triage of UID {", ".join(uid for uid, _ in group)} failed: {str(e)}')
+                for uid, entry in group:
+                    yield triage_result(uid, entry, {'status': 'error', 'message': str(e)})
+    finally:
+        # The client went away, no tokens for answers nobody reads
+        for future in futures:
+            future.cancel()
+
+# Function to stream a triage run as Server-Sent Events, one per email and a closing one
+def triage_events(results, total):
+    yield sse_event({'total': total})
+    count = 0
+    for result in results:
+        count += 1
+        yield sse_event(result)
+    yield sse_event({'status': 'success', 'message': f'{count} emails triaged', 'done': True})
+
+# Route - suggest answers for all unseen emails (or the given 'uids'), streamed as Server-Sent Events as
+# they complete. 'stream': false answers with one JSON at the end, 'draft': true also saves every answer as draft
+@app.route('/triage', methods=['POST'])
+def triage():
+    data = request.get_json()
+    prepared, error = prepare_triage(data)
+    if error:
+        return jsonify({'status': 'error', 'message': error})
+    account, items = prepared
+    results = run_triage(account, items, data.get('context', ''), bool(data.get('regenerate')), bool(data.get('draft')))
+    if not data.get('stream', True):
+        results = list(results)
+        return jsonify({'status': 'success', 'message': f'{len(results)} emails triaged', 'results': results})
+    return Response(
+        triage_events(results, len(items)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Route - tokens-per-minute budget of the OpenAI calls
+@app.route('/budget-stats', methods=['GET'])
+def budget_stats():
+    return jsonify({'status': 'success', 'budget': openai_budget.stats()})
+
+# Route - OpenAI calls the similarity index saved, the time saved is estimated from the average full call
+def handle_similarity_stats():
+    with similarity_savings_lock:
+        stats = dict(similarity_savings)
+    answered = stats['reused'] + stats['adapted'] + stats['full']
+    average = stats['full_seconds'] / stats['full'] if stats['full'] else 0
+    stats.update({
+        'hit_rate': round((stats['reused'] + stats['adapted']) / answered, 3) if answered else 0,
+        'seconds_saved': round(max(0, (stats['reused'] + stats['adapted']) * average - stats['adapted_seconds']), 1),
+        'full_seconds': round(stats['full_seconds'], 1),
+        'adapted_seconds': round(stats['adapted_seconds'], 1),
+        'reuse_threshold': SIMILARITY_REUSE_THRESHOLD,
+        'adapt_threshold': SIMILARITY_ADAPT_THRESHOLD,
+        'index': similar_replies.stats()
+    })
+    return {'status': 'success', 'similarity': stats}
+
+@app.route('/similarity-stats', methods=['GET'])
+def similarity_stats():
+    return jsonify(handle_similarity_stats())
+
+# Route OpenAI suggest answer ('stream': true answers with Server-Sent Events, 'job': true with a job ID,
+# 'draft': true also saves the answer as reply draft)
+@app.route('/suggest-answer', methods=['POST'])
+def suggest_answer():
+    try:
+        data = request.json
+        if data.get('job'):
+            return jsonify(handle_submit_suggestion(data))
+
+        uid = data.get('uid')
+        user_context = data.get('context', '')
+        # 'regenerate': true asks ChatGPT again even if the answer is cached
+        regenerate = bool(data.get('regenerate'))
+        draft_uid = str(uid) if data.get('draft') else None
+        account, error = accounts.resolve(data.get('account'))
+        if error:
+            return jsonify({'status': 'error', 'message': error})
+
+        if data.get('stream'):
+            # Get email content using helper function
+            email_content = getmailtextbyuid(account, uid)
+
+            if not email_content:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Failed to retrieve email content'
+                })
+
+            plan = plan_suggestion(email_content, user_context, regenerate)
+            if plan['reply'] is not None:
+                events = cached_suggestion(plan['reply'], account, draft_uid)
+            else:
+                events = stream_suggestion(plan, account, draft_uid)
+            return Response(
+                events,
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        suggested_reply, error = generate_suggestion(account, uid, user_context, regenerate)
+        if error:
+            return jsonify({
+                'status': 'error',
+                'message': error
+            })
+
+        result = {
             'status': 'success',
             'message': suggested_reply
-        })
+        }
+        if draft_uid:
+            result['draft'] = draft_result(account, draft_uid, suggested_reply)
+        return jsonify(result)
         
     except Exception as e:
         return jsonify({
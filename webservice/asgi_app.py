@@ -0,0 +1,401 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, Response, request, jsonify
+from openai import AsyncOpenAI
+
+# The IMAP pool, caches and route handlers are shared with the Flask app
+import app as service
+from metrics import CONTENT_TYPE, phase_seconds, registry, request_seconds
+
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 50))
+# Threads for the other blocking work: SQLite caches and indexes, token counting, MinHash signatures
+BLOCKING_THREADS = int(os.getenv('BLOCKING_THREADS', 8))
+
+app = Quart(__name__)
+
+async_client = AsyncOpenAI(api_key=service.OPENAI_API_KEY)
+
+# imaplib is blocking, so IMAP work runs on a thread per pooled session and never more than that
+imap_executor = ThreadPoolExecutor(max_workers=max(service.accounts.pool_size(), 1), thread_name_prefix='imap')
+# SQLite files are shared by worker processes and may be locked for a while, so lookups and stores wait here
+# rather than on the event loop, and apart from the IMAP threads so they cannot hold up a session
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix='blocking')
+# One limit per account, sized like its pool, so a busy inbox cannot occupy every thread
+imap_limits = {}
+openai_limit = None
+triage_limit = None
+in_flight = {'imap': 0, 'openai': 0}
+
+# Request timing by route pattern, streamed answers until the headers go out
+@app.before_request
+async def start_request_timer():
+    request.metrics_started = time.perf_counter()
+
+@app.after_request
+async def observe_request(response):
+    started = getattr(request, 'metrics_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - started, route, request.method)
+    return response
+
+@app.before_serving
+async def create_limits():
+    global openai_limit, triage_limit
+    imap_limits.update({account.name: asyncio.Semaphore(account.pool_size) for account in service.accounts})
+    # Requests for accounts this process does not serve only produce an error
+    imap_limits[None] = asyncio.Semaphore(1)
+    openai_limit = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    triage_limit = asyncio.Semaphore(service.TRIAGE_CONCURRENCY)
+
+@app.after_serving
+async def close_clients():
+    await async_client.close()
+    imap_executor.shutdown(wait=False)
+    blocking_executor.shutdown(wait=False)
+    service.suggestion_jobs.close()
+    service.accounts.close()
+
+# Run a blocking IMAP helper of an account (its key, None for the default) without holding up the event loop
+async def run_imap(func, *args, account=None):
+    limit = imap_limits.get(account or service.accounts.default) or imap_limits[None]
+    async with limit:
+        in_flight['imap'] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(imap_executor, func, *args)
+        finally:
+            in_flight['imap'] -= 1
+
+# Run a blocking helper that needs no IMAP session without holding up the event loop
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, func, *args)
+
+# Route IMAP - get UID by message_id
+@app.route('/get-uid', methods=['POST'])
+async def get_uid():
+    data = await request.get_json()
+    # Index hits need no IMAP session at all
+    message_id = data.get('message_id')
+    account = service.accounts.get(data.get('account'))
+    uid = await run_blocking(lambda: account.mailbox_mirror.get_uid(message_id) or account.uid_index.get(message_id)) if account and message_id else None
+    if uid:
+        return jsonify({'status': 'success', 'uid': uid, 'message': 'UID found for Message-ID'})
+    return jsonify(await run_imap(service.handle_get_uid, data, account=data.get('account')))
+
+# Route IMAP - save a reply as draft
+@app.route('/create-draft', methods=['POST'])
+async def create_draft():
+    data = await request.get_json()
+    return jsonify(await run_imap(service.handle_create_draft, data, account=data.get('account')))
+
+# Route IMAP - move email to Trash
+@app.route('/move-email', methods=['POST'])
+async def move_email():
+    data = await request.get_json()
+    return jsonify(await run_imap(service.handle_move_email, data, account=data.get('account')))
+
+# Route IMAP - mark email as read
+@app.route('/mark-as-read', methods=['POST'])
+async def mark_as_read():
+    data = await request.get_json()
+    return jsonify(await run_imap(service.handle_mark_as_read, data, account=data.get('account')))
+
+# Route IMAP - add, remove or replace flags on a list of UIDs
+@app.route('/set-flags', methods=['POST'])
+async def set_flags():
+    data = await request.get_json()
+    return jsonify(await run_imap(service.handle_set_flags, data, account=data.get('account')))
+
+# Route - search INBOX from the mailbox mirror, only a refresh needs an IMAP session
+@app.route('/find-emails', methods=['POST'])
+async def find_emails():
+    data = await request.get_json()
+    if data.get('refresh'):
+        return jsonify(await run_imap(service.handle_find_emails, data, account=data.get('account')))
+    return jsonify(await run_blocking(service.handle_find_emails, data))
+
+# Route IMAP - connection pool statistics
+@app.route('/pool-stats', methods=['GET'])
+async def pool_stats():
+    stats = service.handle_pool_stats()
+    stats['limits'] = {'imap': {account.name: account.pool_size for account in service.accounts}, 'openai': OPENAI_CONCURRENCY}
+    stats['in_flight'] = dict(in_flight)
+    return jsonify(stats)
+
+# Route - Message-ID index and message cache statistics
+@app.route('/cache-stats', methods=['GET'])
+async def cache_stats():
+    return jsonify(service.handle_cache_stats())
+
+# Route - latency histograms and counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+# Route - poll a suggestion job
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    return jsonify(await run_blocking(service.handle_get_job, job_id))
+
+# Route - tokens saved by prompt preprocessing
+@app.route('/prompt-stats', methods=['GET'])
+async def prompt_stats():
+    return jsonify(service.handle_prompt_stats())
+
+# Route - job queue depth and wait times
+@app.route('/job-stats', methods=['GET'])
+async def job_stats():
+    return jsonify({'status': 'success', 'jobs': service.suggestion_jobs.stats()})
+
+# Route - tokens-per-minute budget of the OpenAI calls
+@app.route('/budget-stats', methods=['GET'])
+async def budget_stats():
+    return jsonify({'status': 'success', 'budget': service.openai_budget.stats()})
+
+# Route - OpenAI calls the similarity index saved
+@app.route('/similarity-stats', methods=['GET'])
+async def similarity_stats():
+    return jsonify(await run_blocking(service.handle_similarity_stats))
+
+# Ask ChatGPT for a reply within the tokens-per-minute budget, waiting for it only costs a coroutine
+async def complete_reply(messages):
+    reserved = await run_blocking(service.estimate_tokens, messages)
+    await asyncio.sleep(service.openai_budget.reserve(reserved))
+    async with openai_limit:
+        in_flight['openai'] += 1
+        try:
+            with phase_seconds.time('openai'):
+                response = await async_client.chat.completions.create(
+                    model=service.OPENAI_MODEL,
+                    messages=messages,
+                    temperature=service.OPENAI_TEMPERATURE,
+                    max_tokens=service.OPENAI_MAX_TOKENS
+                )
+        except Exception:
+            service.openai_budget.settle(reserved, 0)
+            raise
+        finally:
+            in_flight['openai'] -= 1
+    service.record_openai_usage(response.usage)
+    service.openai_budget.settle(reserved, response.usage.total_tokens if response.usage else None)
+    return response.choices[0].message.content
+
+# Replay a cached answer, the draft is saved off the event loop
+async def cached_suggestion(suggested_reply, account=None, draft_uid=None):
+    yield service.sse_event({'delta': suggested_reply})
+    done = {'status': 'success', 'message': suggested_reply, 'done': True, 'cached': True}
+    if draft_uid:
+        done['draft'] = await run_imap(service.draft_result, account, draft_uid, suggested_reply, account=account.name)
+    yield service.sse_event(done)
+
+# Relay the ChatGPT answer for a plan token by token as Server-Sent Events, saved as draft when draft_uid is set
+async def stream_suggestion(plan, account=None, draft_uid=None):
+    suggested_reply = ''
+    try:
+        reserved = await run_blocking(service.estimate_tokens, plan['messages'])
+        usage = chunks = None
+        try:
+            await asyncio.sleep(service.openai_budget.reserve(reserved))
+            async with openai_limit:
+                in_flight['openai'] += 1
+                started = time.perf_counter()
+                first_token = True
+                try:
+                    stream = await async_client.chat.completions.create(
+                        model=service.OPENAI_MODEL,
+                        messages=plan['messages'],
+                        temperature=service.OPENAI_TEMPERATURE,
+                        max_tokens=service.OPENAI_MAX_TOKENS,
+                        stream=True,
+                        stream_options={'include_usage': True}
+                    )
+                    chunks = 0
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            service.record_openai_usage(chunk.usage)
+                            usage = chunk.usage
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if first_token:
+                                phase_seconds.observe(time.perf_counter() - started, 'openai_first_token')
+                                first_token = False
+                            chunks += 1
+                            suggested_reply += delta
+                            yield service.sse_event({'delta': delta})
+                    phase_seconds.observe(time.perf_counter() - started, 'openai')
+                finally:
+                    in_flight['openai'] -= 1
+        finally:
+            # Also when the wait is cancelled, the stream fails or the client goes away before the usage chunk
+            service.openai_budget.settle(reserved, service.streamed_tokens(reserved, usage, chunks))
+        await run_blocking(service.remember_suggestion, plan, suggested_reply, time.perf_counter() - started)
+        done = {'status': 'success', 'message': suggested_reply, 'done': True}
+        if draft_uid:
+            done['draft'] = await run_imap(service.draft_result, account, draft_uid, suggested_reply, account=account.name)
+        yield service.sse_event(done)
+    except Exception as e:
+        logging.error(f'Error while streaming suggested answer: {str(e)}')
+        yield service.sse_event({'status': 'error', 'message': str(e), 'done': True})
+
+# Route OpenAI suggest answer
+@app.route('/suggest-answer', methods=['POST'])
+async def suggest_answer():
+    try:
+        data = await request.get_json()
+        if data.get('job'):
+            # Jobs run on the shared worker pool, submitting only waits for the job store
+            return jsonify(await run_blocking(service.handle_submit_suggestion, data))
+
+        uid = data.get('uid')
+        user_context = data.get('context', '')
+        # 'regenerate': true asks ChatGPT again even if the answer is cached
+        regenerate = bool(data.get('regenerate'))
+        # 'draft': true also saves the answer as reply draft
+        draft_uid = str(uid) if data.get('draft') else None
+        account, error = service.accounts.resolve(data.get('account'))
+        if error:
+            return jsonify({'status': 'error', 'message': error})
+
+        # Cached messages are answered without an IMAP session
+        entry = await run_blocking(lambda: account.message_cache.get(account.message_cache.key('INBOX', uid)))
+        email_content = entry['text'] if entry else await run_imap(service.getmailtextbyuid, account, uid, account=account.name)
+
+        if not email_content:
+            return jsonify({
+                'status': 'error',
+                'message': 'Failed to retrieve email content'
+            })
+
+        # A cached answer, or one for a near-identical email, is returned without any OpenAI traffic
+        plan = await run_blocking(service.plan_suggestion, email_content, user_context, regenerate)
+        suggested_reply = plan['reply']
+
+        if data.get('stream'):
+            if suggested_reply is not None:
+                events = cached_suggestion(suggested_reply, account, draft_uid)
+            else:
+                events = stream_suggestion(plan, account, draft_uid)
+            return Response(
+                events,
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        if suggested_reply is not None:
+            result = {'status': 'success', 'message': suggested_reply}
+            if draft_uid:
+                result['draft'] = await run_imap(service.draft_result, account, draft_uid, suggested_reply, account=account.name)
+            return jsonify(result)
+
+        # Waiting for OpenAI only costs a coroutine, the limit protects the API quota
+        started = time.perf_counter()
+        suggested_reply = await complete_reply(plan['messages'])
+        await run_blocking(service.remember_suggestion, plan, suggested_reply, time.perf_counter() - started)
+        result = {
+            'status': 'success',
+            'message': suggested_reply
+        }
+        if draft_uid:
+            result['draft'] = await run_imap(service.draft_result, account, draft_uid, suggested_reply, account=account.name)
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        })
+
+# Answer the emails of a triage run that share one prompt with one OpenAI call, at most
+# TRIAGE_CONCURRENCY calls at once over all triage runs
+async def triage_reply(account, group, plan, draft):
+    async with triage_limit:
+        started = time.perf_counter()
+        suggested_reply = await complete_reply(plan['messages'])
+    await run_blocking(service.remember_suggestion, plan, suggested_reply, time.perf_counter() - started)
+    results = []
+    for index, (uid, entry) in enumerate(group):
+        # Only the first email asked ChatGPT, the others reuse its answer
+        result = {'status': 'success', 'message': suggested_reply, 'cached': index > 0}
+        if plan['similarity'] is not None:
+            result['similarity'] = plan['similarity']
+        if draft:
+            result['draft'] = await run_imap(service.draft_result, account, uid, suggested_reply, account=account.name)
+        results.append(service.triage_result(uid, entry, result))
+    return results
+
+# Suggest answers for a triage run: cached and reused answers right away, the others as their OpenAI calls
+# finish. Emails with the same text share one call
+async def run_triage(account, items, user_context, regenerate=False, draft=False):
+    tasks = {}
+    try:
+        groups = {}
+        for uid, entry in items:
+            email_content = entry['text'] if entry else None
+            if not email_content:
+                yield service.triage_result(uid, entry, {'status': 'error', 'message': 'Failed to retrieve email content'})
+                continue
+            cache_key = service.suggestion_cache_key(email_content, user_context)
+            if cache_key in groups:
+                groups[cache_key][1].append((uid, entry))
+                continue
+            # Response cache and similarity index lookups hit SQLite and compute a MinHash signature
+            plan = await run_blocking(service.plan_suggestion, email_content, user_context, regenerate)
+            if plan['reply'] is not None:
+                result = {'status': 'success', 'message': plan['reply'], 'cached': True}
+                if plan['similarity'] is not None:
+                    result['similarity'] = plan['similarity']
+                if draft:
+                    result['draft'] = await run_imap(service.draft_result, account, uid, plan['reply'], account=account.name)
+                yield service.triage_result(uid, entry, result)
+                continue
+            groups[cache_key] = (plan, [(uid, entry)])
+
+        for plan, group in groups.values():
+            tasks[asyncio.create_task(triage_reply(account, group, plan, draft))] = group
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                group = tasks[task]
+                try:
+                    results = task.result()
+                except Exception as e:
+                    logging.error(f'Triage of UID {", ".join(uid for uid, _ in group)} failed: {str(e)}')
+                    results = [service.triage_result(uid, entry, {'status': 'error', 'message': str(e)}) for uid, entry in group]
+                for result in results:
+                    yield result
+    finally:
+        # The client went away, no tokens for answers nobody reads
+        for task in tasks:
+            task.cancel()
+
+async def triage_events(results, total):
+    yield service.sse_event({'total': total})
+    count = 0
+    async for result in results:
+        count += 1
+        yield service.sse_event(result)
+    yield service.sse_event({'status': 'success', 'message': f'{count} emails triaged', 'done': True})
+
+# Route - suggest answers for all unseen emails (or the given 'uids'), streamed as they complete
+@app.route('/triage', methods=['POST'])
+async def triage():
+    data = await request.get_json()
+    prepared, error = await run_imap(service.prepare_triage, data, account=data.get('account'))
+    if error:
+        return jsonify({'status': 'error', 'message': error})
+    account, items = prepared
+    results = run_triage(account, items, data.get('context', ''), bool(data.get('regenerate')), bool(data.get('draft')))
+    if not data.get('stream', True):
+        results = [result async for result in results]
+        return jsonify({'status': 'success', 'message': f'{len(results)} emails triaged', 'results': results})
+    return Response(
+        triage_events(results, len(items)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
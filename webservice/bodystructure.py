@@ -0,0 +1,303 @@
+import base64
+import binascii
+import email
+import quopri
+import re
+from imap_batch import uid_set_chunks
+from metrics import phase_seconds
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+# List delimiters, distinct from quoted strings that happen to contain '(' or ')'
+OPEN = object()
+CLOSE = object()
+
+
+class Literal(bytes):
+    """Raw bytes of an IMAP literal, kept apart from atoms and quoted strings."""
+
+
+def _flatten(data):
+    """
+    Join the pieces imaplib returns for a FETCH into one token source.
+
+    imaplib splits responses at literals: ('prefix {n}', literal_bytes) tuples followed by the
+    rest of the line as plain bytes.
+    """
+    pieces = []
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            pieces.append(LITERAL_RE.sub(b'', head))
+            pieces.append(Literal(literal))
+        elif item is not None:
+            pieces.append(item)
+    return pieces
+
+
+def _tokenize(pieces):
+    for piece in pieces:
+        if isinstance(piece, Literal):
+            yield piece
+            continue
+        i = 0
+        length = len(piece)
+        while i < length:
+            char = piece[i:i + 1]
+            if char in b' \r\n':
+                i += 1
+            elif char in b'()':
+                yield OPEN if char == b'(' else CLOSE
+                i += 1
+            elif char == b'"':
+                i += 1
+                value = bytearray()
+                while i < length and piece[i:i + 1] != b'"':
+                    if piece[i:i + 1] == b'\\':
+                        i += 1
+                    value += piece[i:i + 1]
+                    i += 1
+                i += 1
+                yield bytes(value).decode('utf-8', 'replace')
+            else:
+                start = i
+                depth = 0
+                # Atoms such as BODY[HEADER.FIELDS (MESSAGE-ID)] may contain spaces and parens inside []
+                while i < length:
+                    char = piece[i:i + 1]
+                    if char == b'[':
+                        depth += 1
+                    elif char == b']':
+                        depth -= 1
+                    elif depth == 0 and char in b' ()\r\n':
+                        break
+                    i += 1
+                atom = piece[start:i].decode('utf-8', 'replace')
+                yield None if atom.upper() == 'NIL' else atom
+
+
+def _parse(tokens):
+    stack = [[]]
+    for token in tokens:
+        if token is OPEN:
+            stack.append([])
+        elif token is CLOSE:
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def parse_fetch_response(data):
+    """
+    Parse the data of a (UID) FETCH into one dict per message.
+
+    Parameters:
+    data (list): Second element of what imaplib's uid('FETCH', ...) returns
+
+    Returns:
+    list: Dicts mapping upper-cased item names (UID, BODYSTRUCTURE, BODY[HEADER], ...) to values
+    """
+    messages = []
+    values = _parse(_tokenize(_flatten(data)))
+    for index, value in enumerate(values):
+        if isinstance(value, list) and index > 0:
+            items = {}
+            for i in range(0, len(value) - 1, 2):
+                items[str(value[i]).upper()] = value[i + 1]
+            messages.append(items)
+    return messages
+
+
+def _params(value):
+    params = {}
+    if isinstance(value, list):
+        for i in range(0, len(value) - 1, 2):
+            params[str(value[i]).lower()] = value[i + 1]
+    return params
+
+
+def find_text_parts(structure, prefix=''):
+    """
+    Walk a parsed BODYSTRUCTURE and list its inline text/plain and text/html parts.
+
+    Returns:
+    list: Dicts with section, subtype, encoding, charset and size, in the order walk() would visit them
+    """
+    parts = []
+    if not isinstance(structure, list) or not structure:
+        return parts
+
+    # Multipart: one or more nested bodies followed by the subtype
+    if isinstance(structure[0], list):
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            parts.extend(find_text_parts(child, f'{prefix}{number}.'))
+        return parts
+
+    section = prefix.rstrip('.') or '1'
+    body_type = str(structure[0]).lower()
+    subtype = str(structure[1]).lower() if len(structure) > 1 else ''
+
+    if body_type == 'message' and subtype == 'rfc822' and len(structure) > 8:
+        # Encapsulated message: its body is numbered below this part
+        nested = structure[8]
+        if isinstance(nested, list) and nested and isinstance(nested[0], list):
+            return find_text_parts(nested, f'{section}.')
+        return find_text_parts(nested, f'{section}.1.')
+
+    if body_type != 'text' or subtype not in ('plain', 'html'):
+        return parts
+
+    # text parts: type subtype params id description encoding size lines md5 disposition ...
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == 'attachment':
+        return parts
+
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError, IndexError):
+        size = 0
+    parts.append({
+        'section': section,
+        'subtype': subtype,
+        'encoding': str(structure[5] or '7bit').lower() if len(structure) > 5 else '7bit',
+        'charset': _params(structure[2]).get('charset') or 'utf-8',
+        'size': size,
+    })
+    return parts
+
+
+def _as_bytes(value):
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return bytes(value)
+    return str(value).encode()
+
+
+def decode_part(payload, encoding, charset):
+    """Undo the transfer encoding and charset of a fetched section."""
+    if encoding == 'base64':
+        try:
+            payload = base64.b64decode(payload)
+        except (binascii.Error, ValueError):
+            # Cut off by a size limit: decode the complete groups of four characters
+            payload = b''.join(payload.split())
+            payload = binascii.a2b_base64(payload[:len(payload) - len(payload) % 4])
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def _text_part(parts):
+    # The part extract_text() would have used: the last text/plain part, else the last text/html part
+    plain = [part for part in parts if part['subtype'] == 'plain']
+    html = [part for part in parts if part['subtype'] == 'html']
+    return plain[-1] if plain else html[-1] if html else None
+
+
+def _section(section, max_text):
+    # FETCH item for a text section and the name the response gives it, <0.n> caps what is downloaded
+    if max_text:
+        return f'BODY.PEEK[{section}]<0.{max_text}>', f'BODY[{section}]<0>'
+    return f'BODY.PEEK[{section}]', f'BODY[{section}]'
+
+
+def _texts(part, payload):
+    with phase_seconds.time('mime_parse'):
+        text = decode_part(_as_bytes(payload), part['encoding'], part['charset'])
+    return (text, None) if part['subtype'] == 'plain' else (None, text)
+
+
+def fetch_text_parts(mail, uid, max_text=None):
+    """
+    Fetch only the headers and the text part of an email, never its attachments.
+
+    The first FETCH asks for BODYSTRUCTURE and the header, the second downloads the section
+    extract_text() would have used: the last text/plain part, else the last text/html part.
+
+    Parameters:
+    mail: IMAP session with the mailbox selected
+    uid (str): The UID of the email
+    max_text (int): Bytes downloaded of the text part at most, None for all of it
+
+    Returns:
+    tuple: (headers, text_content, html_content) or None if the message could not be fetched
+    """
+    result, data = mail.uid('FETCH', uid, '(BODYSTRUCTURE BODY.PEEK[HEADER])')
+    if result != 'OK':
+        return None
+    with phase_seconds.time('mime_parse'):
+        messages = [message for message in parse_fetch_response(data) if 'BODYSTRUCTURE' in message]
+        if not messages:
+            return None
+        message = messages[0]
+        headers = email.message_from_bytes(_as_bytes(message.get('BODY[HEADER]')))
+        part = _text_part(find_text_parts(message['BODYSTRUCTURE']))
+    if part is None:
+        return headers, None, None
+
+    item, name = _section(part['section'], max_text)
+    result, data = mail.uid('FETCH', uid, f'({item})')
+    if result != 'OK':
+        return None
+    fetched = [message for message in parse_fetch_response(data) if name in message]
+    payload = fetched[0][name] if fetched else None
+    if payload is None:
+        return headers, None, None
+    return (headers, *_texts(part, payload))
+
+
+def fetch_text_parts_batch(mail, uids, max_text=None):
+    """
+    fetch_text_parts() for many emails at once.
+
+    One FETCH asks for BODYSTRUCTURE and header of every UID, then one FETCH per distinct text
+    section ('1', '1.1', ...) downloads the text parts of all emails that have it there. A
+    mailbox of a hundred similar emails costs three or four round trips instead of two hundred.
+
+    Parameters:
+    mail: IMAP session with the mailbox selected
+    uids (list): UIDs of the emails
+    max_text (int): Bytes downloaded of each text part at most, None for all of it
+
+    Returns:
+    dict: uid (str) -> (headers, text_content, html_content), UIDs that could not be fetched are missing
+    """
+    found = {}
+    sections = {}  # section -> {uid: part}
+    for sequence_set, _ in uid_set_chunks(uids):
+        result, data = mail.uid('FETCH', sequence_set, '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+        if result != 'OK':
+            continue
+        with phase_seconds.time('mime_parse'):
+            for message in parse_fetch_response(data):
+                if 'UID' not in message or 'BODYSTRUCTURE' not in message:
+                    continue
+                uid = str(int(message['UID']))
+                found[uid] = (email.message_from_bytes(_as_bytes(message.get('BODY[HEADER]'))), None, None)
+                part = _text_part(find_text_parts(message['BODYSTRUCTURE']))
+                if part is not None:
+                    sections.setdefault(part['section'], {})[uid] = part
+
+    for section, parts in sections.items():
+        item, name = _section(section, max_text)
+        for sequence_set, _ in uid_set_chunks(parts):
+            result, data = mail.uid('FETCH', sequence_set, f'(UID {item})')
+            if result != 'OK':
+                continue
+            for message in parse_fetch_response(data):
+                uid = str(int(message['UID'])) if 'UID' in message else None
+                payload = message.get(name)
+                if uid in parts and payload is not None:
+                    found[uid] = (found[uid][0], *_texts(parts[uid], payload))
+    return found
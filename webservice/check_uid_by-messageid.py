@@ -1,6 +1,7 @@
 import imaplib
 import os
 from dotenv import load_dotenv
+from uid_index import search_uid_by_message_id
 
 # Load environment variables
 load_dotenv()
@@ -44,24 +45,8 @@ def get_uid_by_message_id(message_id):
         # Select inbox
         mail.select('inbox')
         
-        # Search for the email with the given Message-ID
-        result, data = mail.search(None, f'HEADER Message-ID "{message_id}"')
-
-        if result == 'OK':
-            email_ids = data[0].split()
-            if email_ids:
-                # Get the UID for the found message
-                result, data = mail.fetch(email_ids[0], '(UID)')
-                if result == 'OK':
-                    # Extract UID from the response
-                    uid = data[0].decode().split()[2].strip(')')
-                    return uid, None
-                else:
-                    return None, 'Failed to fetch UID'
-            else:
-                return None, 'No emails found with that Message-ID'
-        else:
-            return None, 'Search for Message-ID failed'
+        # Search for the UID directly, no second FETCH round trip needed
+        return search_uid_by_message_id(mail, message_id)
     except imaplib.IMAP4.error as e:
         return None, f"IMAP error: {str(e)}"
     finally:
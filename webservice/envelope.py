@@ -0,0 +1,48 @@
+import email.errors
+import email.header
+from uid_index import normalize_message_id
+
+
+def decode_words(value):
+    """Undo RFC 2047 encoded words in an ENVELOPE string or header value."""
+    if value is None:
+        return None
+    text = value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+    try:
+        return str(email.header.make_header(email.header.decode_header(text)))
+    except (UnicodeDecodeError, LookupError, email.errors.HeaderParseError):
+        return text
+
+
+def _addresses(value):
+    addresses = []
+    for address in value or []:
+        # (name adl mailbox host)
+        if isinstance(address, list) and len(address) >= 4 and address[2] is not None:
+            addresses.append({
+                'name': decode_words(address[0]),
+                'address': f'{decode_words(address[2])}@{decode_words(address[3])}' if address[3] is not None else decode_words(address[2]),
+            })
+    return addresses
+
+
+def parse_envelope(envelope):
+    """
+    Turn a parsed ENVELOPE (see bodystructure.parse_fetch_response) into plain fields.
+
+    Parameters:
+    envelope (list): (date subject from sender reply-to to cc bcc in-reply-to message-id)
+
+    Returns:
+    dict: date, subject, from, to, cc, in_reply_to and message_id
+    """
+    envelope = list(envelope) + [None] * (10 - len(envelope))
+    return {
+        'date': decode_words(envelope[0]),
+        'subject': decode_words(envelope[1]),
+        'from': _addresses(envelope[2]),
+        'to': _addresses(envelope[5]),
+        'cc': _addresses(envelope[6]),
+        'in_reply_to': normalize_message_id(decode_words(envelope[8])),
+        'message_id': normalize_message_id(decode_words(envelope[9])),
+    }
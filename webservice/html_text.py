@@ -0,0 +1,104 @@
+import re
+from html.parser import HTMLParser
+
+# Elements whose content is never readable text
+SKIP_TAGS = {'head', 'title', 'style', 'script', 'noscript', 'template', 'object', 'iframe'}
+
+# Elements without an end tag, they never open a nesting level
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+# Elements that start a new line in the extracted text
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'center', 'dd', 'div', 'dl', 'dt', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li',
+    'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+}
+
+# Inline styles newsletters use for preheaders and tracking blocks
+HIDDEN_STYLE_RE = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden|mso-hide\s*:\s*all', re.I)
+WHITESPACE_RE = re.compile(r'[ \t\r\f\v ]+')
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Collects the visible text of an HTML document while it is tokenized, without building a tree.
+
+    Content of <style>, <script> and similar elements is dropped, as is everything inside
+    elements hidden by the hidden attribute, aria-hidden or an inline display:none style.
+    Block elements end the current line; inline elements keep their text on it.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._lines = []
+        self._line = []
+        self._skip = []  # open elements since entering a skipped element, innermost last
+
+    def _break(self):
+        if self._line:
+            line = WHITESPACE_RE.sub(' ', ''.join(self._line)).strip()
+            if line:
+                self._lines.append(line)
+            self._line = []
+
+    @staticmethod
+    def _hidden(attrs):
+        for name, value in attrs:
+            if name == 'hidden':
+                return True
+            if name == 'aria-hidden' and (value or '').lower() == 'true':
+                return True
+            if name == 'style' and value and HIDDEN_STYLE_RE.search(value):
+                return True
+        return False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if not self._skip and tag in BLOCK_TAGS:
+                self._break()
+            return
+        if self._skip:
+            self._skip.append(tag)
+            return
+        if tag in SKIP_TAGS or self._hidden(attrs):
+            self._skip.append(tag)
+            return
+        if tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_startendtag(self, tag, attrs):
+        # <br/>, <img/> and friends; a self-closed element never opens a nesting level
+        if not self._skip and tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_endtag(self, tag):
+        if self._skip:
+            # Close back to the matching element, unmatched end tags are ignored like browsers do
+            if tag in self._skip:
+                while self._skip.pop() != tag:
+                    pass
+            return
+        if tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_data(self, data):
+        if not self._skip:
+            # Line breaks in the source are just whitespace in HTML
+            self._line.append(data.replace('\n', ' '))
+
+    def text(self):
+        self._break()
+        return '\n'.join(self._lines)
+
+
+def html_to_text_fast(html_content):
+    """
+    Extract the visible text of an HTML email in one streaming pass.
+
+    Returns:
+    str: One line per block element, whitespace collapsed
+    """
+    extractor = HTMLTextExtractor()
+    extractor.feed(html_content)
+    extractor.close()
+    return extractor.text()
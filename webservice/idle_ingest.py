@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import time
+import imaplib2
+import requests
+from dotenv import load_dotenv
+from uid_index import select_mailbox
+from imap_batch import uid_set_chunks
+from bodystructure import parse_fetch_response
+from envelope import parse_envelope
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+IMAP_HOST = os.getenv('IMAP_HOST')
+IMAP_PORT = int(os.getenv('IMAP_PORT'))
+IMAP_USER = os.getenv('IMAP_USER')
+IMAP_PASS = os.getenv('IMAP_PASS')
+# Only for local test servers, real mail servers are always reached over TLS
+IMAP_SSL = os.getenv('IMAP_SSL', '1') != '0'
+INGEST_MAILBOX = os.getenv('INGEST_MAILBOX', 'INBOX')
+# Webservice account key of the watched login, sent with every mail so its buttons act on that account
+INGEST_ACCOUNT = os.getenv('INGEST_ACCOUNT', '')
+# 'log' only logs new mails, anything else is the URL new mails are POSTed to
+INGEST_SINK_URL = os.getenv('INGEST_SINK_URL') or 'http://discord-bot:4210/new-mail'
+INGEST_STATE_PATH = os.getenv('INGEST_STATE_PATH')
+# Servers drop IDLE after 30 minutes, re-issue it before that
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', 25 * 60))
+INGEST_RETRY_MAX = int(os.getenv('INGEST_RETRY_MAX', 60))
+
+
+class SinkRefused(Exception):
+    """The sink will never take this mail, delivering it again does not help."""
+
+
+class HTTPSink:
+    """
+    POSTs every new mail as JSON, e.g. to the Discord bot's /new-mail route.
+
+    A 4xx answer or a 200 with an error status refuses the mail for good, connection errors,
+    timeouts, rate limits and 5xx answers are worth a retry.
+    """
+
+    def __init__(self, url, timeout=15):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, mail):
+        response = self.session.post(self.url, json=mail, timeout=self.timeout)
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise SinkRefused(f"Sink {self.url} answered {response.status_code} for UID {mail['uid']}")
+        if response.status_code != 200:
+            raise RuntimeError(f'Sink {self.url} answered {response.status_code}')
+        # Our services answer 200 with a status field, an error there means the mail will not be taken, a retry gets a 5xx
+        result = response.json()
+        if result.get('status') != 'success':
+            raise SinkRefused(f"Sink {self.url} refused UID {mail['uid']}: {result.get('message')}")
+
+
+class LogSink:
+    """Only logs new mails, useful to watch the ingest without a consumer."""
+
+    def send(self, mail):
+        logging.info(f'New mail: {json.dumps(mail, ensure_ascii=False)}')
+
+
+def build_sink(url):
+    return LogSink() if url == 'log' else HTTPSink(url)
+
+
+def fetch_envelopes(mail, uids):
+    """
+    Fetch the ENVELOPE of new messages, nothing of their bodies.
+
+    Returns:
+    list: Dicts with uid plus the parse_envelope() fields, ordered by UID
+    """
+    found = []
+    for uid_set, _ in uid_set_chunks(uids):
+        result, data = mail.uid('FETCH', uid_set, '(UID ENVELOPE)')
+        if result != 'OK':
+            raise mail.error(f'FETCH {uid_set} failed')
+        for message in parse_fetch_response(data):
+            if 'UID' in message and 'ENVELOPE' in message:
+                found.append(dict(parse_envelope(message['ENVELOPE']), uid=str(message['UID'])))
+    return sorted(found, key=lambda message: int(message['uid']))
+
+
+class MailboxWatcher:
+    """
+    Holds one IMAP session in IDLE on a mailbox and hands every new UID to a sink.
+
+    The last delivered UID (with the mailbox's UIDVALIDITY) is kept in a JSON file when a path
+    is given, so a restart delivers what arrived while the ingest was down. Without a path, or
+    when UIDVALIDITY changed, delivery starts with the next message that arrives.
+
+    Parameters:
+    sink: Object with send(mail), raising SinkRefused for mails it will never take and anything else to retry
+    mailbox (str): Mailbox to watch
+    state_path (str): Optional JSON file for the last delivered UID
+    idle_timeout (int): Seconds before IDLE is re-issued
+    account (str): Webservice account key sent with every mail, empty for the default account
+    """
+
+    def __init__(self, sink, mailbox='INBOX', state_path=None, idle_timeout=25 * 60, account=''):
+        self.sink = sink
+        self.mailbox = mailbox
+        self.account = account
+        self.state_path = state_path
+        self.idle_timeout = idle_timeout
+        self.uidvalidity = None
+        self.last_uid = None
+        self.stats = {'delivered': 0, 'refused': 0, 'idle_wakeups': 0, 'reconnects': 0}
+        self._load_state()
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.uidvalidity = state.get('uidvalidity')
+            self.last_uid = state.get('last_uid')
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable ingest state {self.state_path}: {str(e)}')
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        temporary = f'{self.state_path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'uidvalidity': self.uidvalidity, 'last_uid': self.last_uid}, f)
+        os.replace(temporary, self.state_path)
+
+    def connect(self):
+        mail = (imaplib2.IMAP4_SSL if IMAP_SSL else imaplib2.IMAP4)(IMAP_HOST, IMAP_PORT)
+        mail.login(IMAP_USER, IMAP_PASS)
+        uidvalidity, uidnext = select_mailbox(mail, self.mailbox, readonly=True)
+        if uidvalidity != self.uidvalidity or self.last_uid is None:
+            if self.uidvalidity is not None:
+                logging.info(f'UIDVALIDITY of {self.mailbox} changed, starting with new mail')
+            self.uidvalidity = uidvalidity
+            self.last_uid = (uidnext or 1) - 1
+            self._save_state()
+        return mail
+
+    def catch_up(self, mail):
+        """Deliver every message above the last delivered UID, oldest first."""
+        result, data = mail.uid('SEARCH', None, f'UID {self.last_uid + 1}:*')
+        if result != 'OK':
+            raise mail.error('UID SEARCH failed')
+        # n:* always matches the highest UID, even when it is below n
+        uids = [int(uid) for uid in (data[0] or b'').split() if int(uid) > self.last_uid]
+        if not uids:
+            return 0
+        for message in fetch_envelopes(mail, uids):
+            message['mailbox'] = self.mailbox
+            if self.account:
+                message['account'] = self.account
+            try:
+                self.sink.send(message)
+            except SinkRefused as e:
+                # Retrying would hold back every later mail, skip this one
+                logging.error(f"Skipping UID {message['uid']}: {str(e)}")
+                self.stats['refused'] += 1
+            else:
+                self.stats['delivered'] += 1
+                logging.info(f"Delivered UID {message['uid']}: {message['subject']}")
+            # Advance only after the sink took or refused it, any other failure redelivers from here
+            self.last_uid = int(message['uid'])
+            self._save_state()
+        return len(uids)
+
+    def run_once(self):
+        mail = self.connect()
+        try:
+            while True:
+                self.catch_up(mail)
+                # Returns as soon as the server reports a change (EXISTS), or after the timeout
+                mail.idle(timeout=self.idle_timeout)
+                self.stats['idle_wakeups'] += 1
+        finally:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    def run(self, retry_max=60):
+        """Watch forever, reconnecting with exponential backoff after errors."""
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f'Ingest session ended: {str(e)}')
+            self.stats['reconnects'] += 1
+            # A session that ran for a while resets the backoff
+            if time.monotonic() - started > retry_max:
+                delay = 1
+            time.sleep(delay)
+            delay = min(delay * 2, retry_max)
+
+
+def main():
+    watcher = MailboxWatcher(
+        build_sink(INGEST_SINK_URL),
+        mailbox=INGEST_MAILBOX,
+        state_path=INGEST_STATE_PATH or None,
+        idle_timeout=IDLE_TIMEOUT,
+        account=INGEST_ACCOUNT
+    )
+    logging.info(f'Watching {INGEST_MAILBOX} on {IMAP_HOST}, delivering to {INGEST_SINK_URL}')
+    watcher.run(retry_max=INGEST_RETRY_MAX)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.info('Ingest stopped')
@@ -0,0 +1,184 @@
+import imaplib
+from special_use import quote_mailbox
+
+# Keep command lines well below the limits common IMAP servers enforce
+MAX_SET_LENGTH = 4000
+
+
+def compress_uids(uids):
+    """
+    Turn UIDs into IMAP sequence-set ranges, e.g. [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'.
+
+    Parameters:
+    uids (iterable): UIDs as ints or numeric strings
+
+    Returns:
+    str: The sequence set
+    """
+    return ','.join(_ranges(sorted({int(uid) for uid in uids})))
+
+
+def _ranges(sorted_uids):
+    ranges = []
+    start = prev = None
+    for uid in sorted_uids:
+        if start is None:
+            start = prev = uid
+        elif uid == prev + 1:
+            prev = uid
+        else:
+            ranges.append(f'{start}:{prev}' if start != prev else f'{start}')
+            start = prev = uid
+    if start is not None:
+        ranges.append(f'{start}:{prev}' if start != prev else f'{start}')
+    return ranges
+
+
+def uid_set_chunks(uids, max_length=MAX_SET_LENGTH):
+    """
+    Split UIDs into sequence sets no longer than max_length characters.
+
+    Returns:
+    list: (sequence_set, [uid, ...]) per chunk
+    """
+    chunks = []
+    parts, members, length = [], [], 0
+    for part in _ranges(sorted({int(uid) for uid in uids})):
+        if parts and length + len(part) + 1 > max_length:
+            chunks.append((','.join(parts), members))
+            parts, members, length = [], [], 0
+        parts.append(part)
+        first, _, last = part.partition(':')
+        members.extend(range(int(first), int(last or first) + 1))
+        length += len(part) + 1
+    if parts:
+        chunks.append((','.join(parts), members))
+    return chunks
+
+
+def _members(sequence_set):
+    uids = set()
+    for part in sequence_set.split(','):
+        first, _, last = part.partition(':')
+        uids.update(range(int(first), int(last or first) + 1))
+    return uids
+
+
+def _existing_uids(mail, sequence_set):
+    result, data = mail.uid('SEARCH', None, f'UID {sequence_set}')
+    if result != 'OK':
+        return None
+    return {int(uid) for uid in (data[0] or b'').split()}
+
+
+def _run_per_chunk(mail, uids, command):
+    """
+    Run command(sequence_set) once per chunk and record an outcome for every UID.
+
+    command returns (status, message), status being 'success', 'error' or 'partial' when the
+    command only took part of its effect. UIDs the server does not know are reported as not
+    found instead of failing the chunk.
+    """
+    results = {}
+    for sequence_set, members in uid_set_chunks(uids):
+        try:
+            existing = _existing_uids(mail, sequence_set)
+            existing = set(members) if existing is None else existing & set(members)
+            for uid in members:
+                if uid not in existing:
+                    results[str(uid)] = {'status': 'error', 'message': 'UID not found'}
+            if not existing:
+                continue
+
+            status, message = command(compress_uids(existing))
+        except imaplib.IMAP4.error as e:
+            status, message = 'error', str(e)
+            existing = {uid for uid in members if str(uid) not in results}
+        for uid in existing:
+            results[str(uid)] = {'status': status, 'message': message}
+    return results
+
+
+def supports(mail, capability):
+    return capability in getattr(mail, 'capabilities', ())
+
+
+def move_uids(mail, uids, destination):
+    """
+    Move UIDs from the selected mailbox to destination, one UID MOVE per chunk.
+
+    Servers without MOVE get UID COPY + \\Deleted + UID EXPUNGE instead. A plain EXPUNGE would
+    also remove every other message flagged \\Deleted, so without UIDPLUS it is only sent when
+    no other message carries the flag, otherwise the originals stay behind flagged. Whenever the
+    copy was made but the original is still in the mailbox the UID is reported as 'partial',
+    only 'success' UIDs have left it.
+
+    Parameters:
+    destination (str): Mailbox name as the server lists it, quoted here
+
+    Returns:
+    dict: uid -> {'status', 'message'}
+    """
+    use_move = supports(mail, 'MOVE')
+    use_uid_expunge = supports(mail, 'UIDPLUS')
+    mailbox = quote_mailbox(destination)
+
+    def move(sequence_set):
+        if use_move:
+            result = mail.uid('MOVE', sequence_set, mailbox)
+            return ('success', f'Moved to {destination}') if result[0] == 'OK' else ('error', 'MOVE failed')
+
+        result = mail.uid('COPY', sequence_set, mailbox)
+        if result[0] != 'OK':
+            return 'error', 'COPY failed'
+        result = mail.uid('STORE', sequence_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if result[0] != 'OK':
+            return 'partial', f'Copied to {destination} but could not flag original as deleted'
+        if use_uid_expunge:
+            result = mail.uid('EXPUNGE', sequence_set)
+        else:
+            result, data = mail.uid('SEARCH', None, 'DELETED')
+            if result != 'OK':
+                return 'partial', f'Copied to {destination}, original flagged as deleted'
+            if {int(uid) for uid in (data[0] or b'').split()} - _members(sequence_set):
+                return 'partial', f'Copied to {destination}, original left flagged as deleted, EXPUNGE would remove other deleted messages'
+            result = mail.expunge()
+        if result[0] != 'OK':
+            return 'partial', f'Copied to {destination}, original flagged as deleted but EXPUNGE failed'
+        return 'success', f'Moved to {destination}'
+
+    return _run_per_chunk(mail, uids, move)
+
+
+def store_flags(mail, uids, flags, action='add', silent=True):
+    """
+    Add, remove or replace flags on UIDs in the selected mailbox, one UID STORE per chunk.
+
+    Parameters:
+    flags (list): Flags such as ['\\Seen', '\\Flagged']
+    action (str): 'add', 'remove' or 'replace'
+    silent (bool): Use .SILENT so the server does not echo the new flags back
+
+    Returns:
+    dict: uid -> {'status', 'message'}
+    """
+    item = {'add': '+FLAGS', 'remove': '-FLAGS', 'replace': 'FLAGS'}[action]
+    if silent:
+        item += '.SILENT'
+    flag_list = f"({' '.join(flags)})"
+
+    def store(sequence_set):
+        result = mail.uid('STORE', sequence_set, item, flag_list)
+        return ('success', 'Flags updated') if result[0] == 'OK' else ('error', 'STORE failed')
+
+    return _run_per_chunk(mail, uids, store)
+
+
+def summarize(results):
+    """Overall status for a batch: success, partial or error."""
+    succeeded = sum(1 for result in results.values() if result['status'] == 'success')
+    if results and succeeded == len(results):
+        return 'success'
+    if succeeded or any(result['status'] == 'partial' for result in results.values()):
+        return 'partial'
+    return 'error'
@@ -0,0 +1,290 @@
+import imaplib
+import logging
+import threading
+import time
+from metrics import imap_bytes, phase_seconds
+
+
+class PooledIMAP4(imaplib.IMAP4):
+    """
+    IMAP4 session that remembers when its socket has died so the pool can drop it.
+
+    Every command is timed into webservice_phase_seconds under its name (UID commands under
+    their subcommand, EXAMINE as select) and the bytes read for it are counted.
+    """
+
+    broken = False
+    _received = 0
+
+    def read(self, size):
+        data = super().read(size)
+        self._received += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self._received += len(line)
+        return line
+
+    def _simple_command(self, name, *args):
+        phase = str(args[0]).lower() if name == 'UID' and args else 'select' if name == 'EXAMINE' else name.lower()
+        started = time.perf_counter()
+        try:
+            return super()._simple_command(name, *args)
+        except (imaplib.IMAP4.abort, OSError):
+            self.broken = True
+            raise
+        finally:
+            phase_seconds.observe(time.perf_counter() - started, phase)
+            if self._received:
+                imap_bytes.inc(self._received)
+                self._received = 0
+
+
+class PooledIMAP4_SSL(PooledIMAP4, imaplib.IMAP4_SSL):
+    """The same over TLS, what every real mail server gets."""
+
+
+class IMAPConnectionPool:
+    """
+    Bounded pool of authenticated IMAP sessions shared by all request threads.
+
+    Parameters:
+    host (str): IMAP server host
+    port (int): IMAP server port
+    user (str): Login user
+    password (str): Login password
+    max_size (int): Maximum number of sessions open at the same time
+    max_idle (float): Seconds an unused session may stay open before it is logged out
+    keepalive_interval (float): Seconds between NOOPs on idle sessions
+    acquire_timeout (float): Seconds to wait for a free session before giving up
+    socket_timeout (float): Seconds a connect or a read may block before the session is given up, None waits forever
+    use_ssl (bool): Connect with TLS; plain TCP is only meant for local test servers
+    """
+
+    def __init__(self, host, port, user, password, max_size=4, max_idle=300,
+                 keepalive_interval=60, acquire_timeout=30, socket_timeout=60, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_size = max(1, max_size)
+        self.max_idle = max_idle
+        self.keepalive_interval = keepalive_interval
+        self.acquire_timeout = acquire_timeout
+        self.socket_timeout = socket_timeout
+        self.session_class = PooledIMAP4_SSL if use_ssl else PooledIMAP4
+
+        self._cond = threading.Condition()
+        self._idle = []  # (mail, last_used, last_checked), most recently used last
+        self._size = 0  # idle + checked out
+        self._keepalive_thread = None
+        self._closed = False
+
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'reconnects': 0,
+            'discarded': 0,
+            'expired': 0,
+            'keepalives': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'connect_errors': 0,
+        }
+
+    def _connect(self):
+        # TCP and TLS handshake, greeting and the first CAPABILITY
+        with phase_seconds.time('connect'):
+            mail = self.session_class(host=self.host, port=self.port, timeout=self.socket_timeout)
+        try:
+            mail.login(self.user, self.password)
+            # Many servers only advertise extensions such as MOVE after LOGIN
+            result, data = mail.capability()
+            if result == 'OK' and data and data[-1]:
+                mail.capabilities = tuple(data[-1].decode().upper().split())
+        except Exception:
+            self._close_quietly(mail)
+            raise
+        return mail
+
+    def open_session(self):
+        """
+        Log in a session that is not part of the pool, for long-lived work such as mailbox syncing.
+
+        Returns:
+        tuple: (mail, error)
+        """
+        try:
+            mail = self._connect()
+        except (imaplib.IMAP4.error, OSError) as e:
+            with self._cond:
+                self._stats['connect_errors'] += 1
+            return None, f"IMAP connection failed: {str(e)}"
+        return mail, None
+
+    def close_session(self, mail):
+        """Log out a session from open_session()."""
+        self._close_quietly(mail)
+
+    @staticmethod
+    def _close_quietly(mail):
+        try:
+            mail.logout()
+        except Exception:
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_alive(mail):
+        try:
+            return mail.noop()[0] == 'OK'
+        except Exception:
+            return False
+
+    def _start_keepalive(self):
+        if self._keepalive_thread is None and self.keepalive_interval > 0:
+            self._keepalive_thread = threading.Thread(
+                target=self._keepalive_loop, name='imap-pool-keepalive', daemon=True)
+            self._keepalive_thread.start()
+
+    def acquire(self):
+        """
+        Check out an authenticated session.
+
+        Returns:
+        tuple: (mail, error) - same contract as connect_to_imap()
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            mail = None
+            checked = 0.0
+            create = False
+            expired = None
+            with self._cond:
+                if self._closed:
+                    return None, 'IMAP connection pool is closed'
+                self._start_keepalive()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        return None, 'Timed out waiting for a free IMAP connection'
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    mail, last_used, checked = self._idle.pop()
+                    if time.monotonic() - last_used > self.max_idle:
+                        # Too old to trust, replace it with a fresh session
+                        self._stats['expired'] += 1
+                        expired, mail = mail, None
+                        create = True
+                else:
+                    self._size += 1
+                    create = True
+
+            if expired is not None:
+                # LOGOUT waits for the server, other threads must not wait for the lock meanwhile
+                self._close_quietly(expired)
+
+            if mail is not None:
+                # Sessions that have not been pinged recently get a NOOP before reuse
+                if time.monotonic() - checked <= self.keepalive_interval or self._is_alive(mail):
+                    with self._cond:
+                        self._stats['reused'] += 1
+                    return mail, None
+                logging.info('Pooled IMAP session is dead, reconnecting')
+                self._close_quietly(mail)
+                with self._cond:
+                    self._stats['reconnects'] += 1
+                create = True
+
+            if create:
+                try:
+                    mail = self._connect()
+                except (imaplib.IMAP4.error, OSError) as e:
+                    with self._cond:
+                        self._size -= 1
+                        self._stats['connect_errors'] += 1
+                        self._cond.notify()
+                    return None, f"IMAP connection failed: {str(e)}"
+                with self._cond:
+                    self._stats['created'] += 1
+                return mail, None
+
+    def release(self, mail, discard=False):
+        """Return a session to the pool; broken or logged-out sessions are closed instead."""
+        if mail is None:
+            return
+        discard = discard or mail.broken or mail.state not in ('AUTH', 'SELECTED')
+        with self._cond:
+            if self._closed:
+                discard = True
+            if discard:
+                self._size -= 1
+                self._stats['discarded'] += 1
+            else:
+                now = time.monotonic()
+                self._idle.append((mail, now, now))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(mail)
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(max(1.0, self.keepalive_interval / 2))
+            now = time.monotonic()
+            with self._cond:
+                if self._closed:
+                    return
+                due = []
+                keep = []
+                for entry in self._idle:
+                    mail, last_used, checked = entry
+                    if now - last_used > self.max_idle or now - checked >= self.keepalive_interval:
+                        due.append(entry)
+                    else:
+                        keep.append(entry)
+                self._idle = keep
+                # Sessions being pinged still count towards the size limit
+            for mail, last_used, checked in due:
+                if now - last_used > self.max_idle:
+                    self._close_quietly(mail)
+                    with self._cond:
+                        self._size -= 1
+                        self._stats['expired'] += 1
+                        self._cond.notify()
+                elif self._is_alive(mail):
+                    with self._cond:
+                        self._stats['keepalives'] += 1
+                        self._idle.insert(0, (mail, last_used, time.monotonic()))
+                        self._cond.notify()
+                else:
+                    self._close_quietly(mail)
+                    with self._cond:
+                        self._size -= 1
+                        self._stats['discarded'] += 1
+                        self._cond.notify()
+
+    def close(self):
+        """Log out every idle session and refuse further checkouts."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for mail, _, _ in idle:
+            self._close_quietly(mail)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'max_size': self.max_size,
+                'open': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            })
+        return stats
@@ -0,0 +1,209 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from shared_state import connect
+
+
+class JobQueue:
+    """
+    Bounded worker pool for slow requests, answered by job ID instead of holding the HTTP request.
+
+    Jobs are keyed: submitting a key that is still queued or running joins the existing job
+    instead of starting a second one. Finished jobs stay available for polling for result_ttl
+    seconds, and every submitter's callback is called once the job is done.
+
+    With a path the state of every job is also written to a SQLite file, so a job submitted to
+    one worker process can be polled through any other.
+
+    Parameters:
+    handler (callable): handler(payload) -> (result, error), run on a worker thread
+    workers (int): Jobs processed in parallel
+    max_queued (int): Queued jobs accepted before submit() refuses new ones
+    result_ttl (float): Seconds finished jobs can still be polled
+    path (str): Optional SQLite file shared with other processes
+    """
+
+    def __init__(self, handler, workers=4, max_queued=1000, result_ttl=3600, path=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._queue = deque()  # job ids waiting for a worker
+        self._jobs = {}  # job id -> job dict
+        self._active = {}  # key -> job id while queued or running
+        self._running = 0
+        self._waits = deque(maxlen=1000)  # seconds recent jobs spent queued
+        self._counters = {'submitted': 0, 'deduplicated': 0, 'succeeded': 0, 'failed': 0, 'rejected': 0}
+        self._closed = False
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    snapshot TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at);
+            """)
+        self._threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _public(job):
+        view = {key: job[key] for key in ('id', 'status', 'submitted_at', 'started_at', 'finished_at')}
+        if job['status'] == 'success':
+            view['result'] = job['result']
+        elif job['status'] == 'error':
+            view['message'] = job['error']
+        return view
+
+    def _expire(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and job['finished_at'] + self.result_ttl <= now]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _share(self, job):
+        # Called with the lock held, finished jobs also prune the expired ones of every process
+        if self._db is None:
+            return
+        now = time.time()
+        with self._db:
+            self._db.execute('REPLACE INTO jobs VALUES (?, ?, ?)', (job['id'], json.dumps(self._public(job)), now))
+            if job['finished_at'] is not None:
+                self._db.execute('DELETE FROM jobs WHERE updated_at < ?', (now - self.result_ttl,))
+
+    def submit(self, key, payload, callback=None):
+        """
+        Queue a job, or join the queued or running job with the same key.
+
+        Parameters:
+        key (hashable): Identity of the work, e.g. (uid, context)
+        payload: Passed to the handler
+        callback (callable): callback(job) once the job finished, optional
+
+        Returns:
+        tuple: (job, error) - job is a snapshot dict with 'id' and 'status', 'deduplicated' tells whether it was joined
+        """
+        with self._lock:
+            if self._closed:
+                return None, 'Job queue is shut down'
+            self._expire(time.time())
+            job_id = self._active.get(key)
+            if job_id is not None:
+                job = self._jobs[job_id]
+                if callback:
+                    job['callbacks'].append(callback)
+                self._counters['deduplicated'] += 1
+                return dict(self._public(job), deduplicated=True), None
+
+            if len(self._queue) >= self.max_queued:
+                self._counters['rejected'] += 1
+                return None, 'Job queue is full'
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'key': key,
+                'payload': payload,
+                'status': 'queued',
+                'result': None,
+                'error': None,
+                'callbacks': [callback] if callback else [],
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+            }
+            self._jobs[job['id']] = job
+            self._active[key] = job['id']
+            self._queue.append(job['id'])
+            self._share(job)
+            self._counters['submitted'] += 1
+            self._ready.notify()
+            return dict(self._public(job), deduplicated=False), None
+
+    def get(self, job_id):
+        """Returns a snapshot of the job or None if it is unknown or expired."""
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            job = self._jobs.get(job_id)
+            if job:
+                return self._public(job)
+            if self._db is None:
+                return None
+            # Submitted to another worker process
+            row = self._db.execute('SELECT snapshot FROM jobs WHERE id = ? AND updated_at >= ?',
+                                   (job_id, now - self.result_ttl)).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._ready.wait()
+                if self._closed:
+                    return
+                job = self._jobs[self._queue.popleft()]
+                job['status'] = 'running'
+                job['started_at'] = time.time()
+                self._waits.append(job['started_at'] - job['submitted_at'])
+                self._running += 1
+                self._share(job)
+
+            try:
+                result, error = self.handler(job['payload'])
+            except Exception as e:
+                logging.exception('Job failed')
+                result, error = None, str(e)
+
+            with self._lock:
+                self._running -= 1
+                job['finished_at'] = time.time()
+                job['status'] = 'error' if error else 'success'
+                job['result'] = result
+                job['error'] = error
+                self._counters['failed' if error else 'succeeded'] += 1
+                self._active.pop(job['key'], None)
+                self._share(job)
+                callbacks = list(job['callbacks'])
+                snapshot = self._public(job)
+
+            for callback in callbacks:
+                try:
+                    callback(snapshot)
+                except Exception:
+                    logging.exception('Job callback failed')
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._ready.notify_all()
+
+    def stats(self):
+        """Queue depth, worker usage and how long jobs waited for a worker."""
+        with self._lock:
+            now = time.time()
+            waits = sorted(self._waits)
+            oldest = self._jobs[self._queue[0]]['submitted_at'] if self._queue else None
+            stats = dict(self._counters)
+            stats.update({
+                'queue_depth': len(self._queue),
+                'running': self._running,
+                'workers': self.workers,
+                'oldest_queued_seconds': round(now - oldest, 3) if oldest else 0,
+                'wait_seconds': {
+                    'avg': round(sum(waits) / len(waits), 3) if waits else 0,
+                    'p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0,
+                    'max': round(waits[-1], 3) if waits else 0,
+                },
+            })
+        return stats
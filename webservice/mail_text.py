@@ -0,0 +1,80 @@
+import logging
+from html_text import html_to_text_fast
+from metrics import phase_seconds
+
+# Function to extract the plain text of a parsed email, converting HTML if there is no text part
+def extract_text(email_body):
+    text_content = None
+    html_content = None
+    
+    # Extract text content from email parts
+    if email_body.is_multipart():
+        for part in email_body.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get('Content-Disposition'))
+            
+            # Skip attachments
+            if 'attachment' in content_disposition:
+                continue
+                
+            try:
+                # Get the email part payload
+                payload = part.get_payload(decode=True).decode()
+            except:
+                continue
+                
+            if content_type == 'text/plain':
+                text_content = payload
+            elif content_type == 'text/html':
+                html_content = payload
+    else:
+        # Handle non-multipart emails
+        content_type = email_body.get_content_type()
+        try:
+            payload = email_body.get_payload(decode=True).decode()
+            if content_type == 'text/plain':
+                text_content = payload
+            elif content_type == 'text/html':
+                html_content = payload
+        except:
+            return None
+    return select_text(text_content, html_content)
+
+# Function to pick the text of an email: plain text if available, otherwise converted HTML
+def select_text(text_content, html_content):
+    # If plain text is available, use it
+    if text_content:
+        return text_content.strip()
+    
+    # Otherwise, convert HTML to plain text if available
+    elif html_content:
+        return html_to_text(html_content)
+     
+    return None
+
+# HTML extraction engine: 'parser' streams through html.parser, 'bs4' builds a BeautifulSoup tree
+html_engine = 'parser'
+
+def set_html_engine(engine):
+    global html_engine
+    if engine not in ('parser', 'bs4'):
+        raise ValueError(f'Unknown HTML engine: {engine}')
+    html_engine = engine
+
+# Function to convert HTML to plain text
+def html_to_text(html_content):
+    with phase_seconds.time('html_convert'):
+        return _html_to_text(html_content)
+
+def _html_to_text(html_content):
+    if html_engine == 'parser':
+        try:
+            return html_to_text_fast(html_content)
+        except Exception as e:
+            logging.warning(f'Streaming HTML extraction failed, falling back to BeautifulSoup: {str(e)}')
+    return html_to_text_bs4(html_content)
+
+def html_to_text_bs4(html_content):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    return soup.get_text(separator='\n', strip=True)
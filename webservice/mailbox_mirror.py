@@ -0,0 +1,395 @@
+import imaplib
+import logging
+import re
+import threading
+import time
+from bodystructure import parse_fetch_response
+from envelope import parse_envelope
+from imap_batch import supports
+from shared_state import connect
+from uid_index import normalize_message_id
+
+# '(EARLIER) 41,43:116' -> the sequence set after the tag
+VANISHED_RE = re.compile(r'^\s*(\(EARLIER\)\s*)?([\d:,]+)\s*$', re.I)
+
+
+def _status_value(mail, name):
+    _, data = mail.response(name)
+    try:
+        return int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _vanished_ranges(data):
+    """Parse the VANISHED responses imaplib collected into (first, last) UID ranges."""
+    ranges = []
+    for item in data or []:
+        if item is None:
+            continue
+        match = VANISHED_RE.match(item.decode() if isinstance(item, bytes) else str(item))
+        if not match:
+            continue
+        for part in match.group(2).split(','):
+            first, _, last = part.partition(':')
+            first, last = int(first), int(last or first)
+            ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def _flag_string(flags):
+    # Padded so instr(flags, ' \\Seen ') matches whole flags only
+    return ' ' + ' '.join(sorted(str(flag) for flag in flags or [])) + ' '
+
+
+def _address_string(addresses):
+    return ', '.join(f"{address['name']} <{address['address']}>" if address['name'] else address['address']
+                     for address in addresses)
+
+
+class MailboxMirror:
+    """
+    Local copy of the UIDs, flags and envelopes of a mailbox, kept current incrementally.
+
+    Servers with QRESYNC report changed flags and expunged UIDs since the last known
+    HIGHESTMODSEQ in one UID FETCH (CHANGEDSINCE ... VANISHED). CONDSTORE servers report changed
+    flags the same way, expunges are noticed by the message count. Everything else gets a
+    UID-range diff: one UID FETCH of the flags of all known messages. New messages are always
+    fetched above the last known UID, envelopes only.
+
+    Lookups by Message-ID, flags, sender or subject are answered from SQLite (a file with a
+    path, memory otherwise) without IMAP traffic. Our own MOVE and STORE commands are applied
+    in place with discard_uids() and apply_flags(). Worker processes opening the same file
+    read one mirror, only one of them needs to sync it.
+
+    Parameters:
+    path (str): Optional SQLite file
+    sync_batch (int): Number of new UIDs fetched per FETCH while syncing
+    """
+
+    def __init__(self, path=None, sync_batch=500):
+        self.sync_batch = sync_batch
+        self._lock = threading.RLock()
+        # One sync at a time, the background loop and a refresh must not interleave their state
+        self._sync_lock = threading.Lock()
+        self._db = connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS mirror_mailboxes (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                highestmodseq INTEGER,
+                last_uid INTEGER NOT NULL,
+                synced_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS mirror_messages (
+                mailbox TEXT NOT NULL,
+                uid INTEGER NOT NULL,
+                message_id TEXT,
+                flags TEXT NOT NULL,
+                sender TEXT,
+                subject TEXT,
+                date TEXT,
+                sender_key TEXT,
+                subject_key TEXT,
+                PRIMARY KEY (mailbox, uid)
+            );
+            CREATE INDEX IF NOT EXISTS mirror_messages_message_id ON mirror_messages (mailbox, message_id);
+        """)
+        self._stats = {'syncs': 0, 'added': 0, 'flag_updates': 0, 'removed': 0, 'resets': 0, 'lookups': 0,
+                       'sync_errors': 0, 'last_sync_mode': None, 'last_sync_seconds': None}
+
+    def _state(self, mailbox):
+        row = self._db.execute('SELECT uidvalidity, highestmodseq, last_uid, synced_at FROM mirror_mailboxes WHERE mailbox = ?',
+                               (mailbox,)).fetchone()
+        if row is None:
+            return {'uidvalidity': None, 'highestmodseq': None, 'last_uid': 0, 'synced_at': None}
+        return dict(zip(('uidvalidity', 'highestmodseq', 'last_uid', 'synced_at'), row))
+
+    def _save_state(self, mailbox, state):
+        self._db.execute('REPLACE INTO mirror_mailboxes VALUES (?, ?, ?, ?, ?)',
+                         (mailbox, state['uidvalidity'], state['highestmodseq'], state['last_uid'], state['synced_at']))
+
+    @staticmethod
+    def sync_mode(mail):
+        """'qresync', 'condstore' or 'uid-diff', depending on what the server advertises."""
+        if supports(mail, 'QRESYNC') and supports(mail, 'ENABLE'):
+            return 'qresync'
+        if supports(mail, 'CONDSTORE'):
+            return 'condstore'
+        return 'uid-diff'
+
+    def prepare_session(self, mail):
+        """
+        ENABLE QRESYNC (or CONDSTORE) on a freshly logged-in session, before anything is selected.
+
+        Returns:
+        str: The sync mode the session supports
+        """
+        mode = self.sync_mode(mail)
+        if mode == 'qresync':
+            result, _ = mail.enable('QRESYNC')
+            if result != 'OK':
+                mode = 'condstore' if supports(mail, 'CONDSTORE') else 'uid-diff'
+        if mode == 'condstore' and supports(mail, 'ENABLE'):
+            # Some servers only report HIGHESTMODSEQ on SELECT once CONDSTORE is enabled
+            mail.enable('CONDSTORE')
+        mail.mirror_mode = mode
+        return mode
+
+    def _select(self, mail, mailbox):
+        result, data = mail.select(mailbox, readonly=True)
+        if result != 'OK':
+            raise mail.error(f'SELECT {mailbox} failed')
+        try:
+            exists = int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            exists = None
+        return {
+            'exists': exists,
+            'uidvalidity': _status_value(mail, 'UIDVALIDITY'),
+            'uidnext': _status_value(mail, 'UIDNEXT'),
+            # Missing when the mailbox does not keep mod-sequences (NOMODSEQ)
+            'highestmodseq': _status_value(mail, 'HIGHESTMODSEQ'),
+        }
+
+    def _fetch(self, mail, uid_range, items, modifier=None):
+        args = [uid_range, items] + ([modifier] if modifier else [])
+        result, data = mail.uid('FETCH', *args)
+        if result != 'OK':
+            raise mail.error(f'FETCH {uid_range} {items} failed')
+        return [message for message in parse_fetch_response(data) if 'UID' in message]
+
+    def _update_flags(self, mailbox, messages):
+        rows = [(_flag_string(message.get('FLAGS')), mailbox, int(message['UID'])) for message in messages]
+        with self._lock, self._db:
+            self._db.executemany('UPDATE mirror_messages SET flags = ? WHERE mailbox = ? AND uid = ?', rows)
+            self._stats['flag_updates'] += len(rows)
+
+    def _remove_ranges(self, mailbox, ranges):
+        removed = 0
+        with self._lock, self._db:
+            for first, last in ranges:
+                removed += self._db.execute('DELETE FROM mirror_messages WHERE mailbox = ? AND uid BETWEEN ? AND ?',
+                                            (mailbox, first, last)).rowcount
+            self._stats['removed'] += removed
+        return removed
+
+    def _remove_missing(self, mailbox, existing, last_uid):
+        with self._lock, self._db:
+            known = {uid for (uid,) in self._db.execute(
+                'SELECT uid FROM mirror_messages WHERE mailbox = ? AND uid <= ?', (mailbox, last_uid))}
+            missing = known - existing
+            self._db.executemany('DELETE FROM mirror_messages WHERE mailbox = ? AND uid = ?',
+                                 [(mailbox, uid) for uid in missing])
+            self._stats['removed'] += len(missing)
+        return len(missing)
+
+    def _sync_known(self, mail, mailbox, mode, state, selected):
+        """Bring flags of known UIDs up to date and drop expunged ones."""
+        last_uid = state['last_uid']
+        modseq = state['highestmodseq']
+        if mode != 'uid-diff' and modseq and selected['highestmodseq']:
+            if selected['highestmodseq'] == modseq:
+                return
+            if mode == 'qresync':
+                # Drop VANISHED responses left over from earlier commands on this session
+                mail.response('VANISHED')
+                changed = self._fetch(mail, f'1:{last_uid}', '(UID FLAGS)', f'(CHANGEDSINCE {modseq} VANISHED)')
+                self._update_flags(mailbox, changed)
+                self._remove_ranges(mailbox, _vanished_ranges(mail.response('VANISHED')[1]))
+                return
+            self._update_flags(mailbox, self._fetch(mail, f'1:{last_uid}', '(UID FLAGS)', f'(CHANGEDSINCE {modseq})'))
+            return
+
+        # UID-range diff: the flags of everything we know, whatever is not returned is gone
+        messages = self._fetch(mail, f'1:{last_uid}', '(UID FLAGS)')
+        self._update_flags(mailbox, [message for message in messages if int(message['UID']) <= last_uid])
+        self._remove_missing(mailbox, {int(message['UID']) for message in messages}, last_uid)
+
+    def _sync_new(self, mail, mailbox, state, selected):
+        """Fetch envelope and flags of every UID above the last known one."""
+        uidnext = selected['uidnext']
+        if uidnext is not None and uidnext - 1 <= state['last_uid']:
+            return
+        start = state['last_uid'] + 1
+        while True:
+            end = start + self.sync_batch - 1
+            # Last batch runs up to '*' so nothing added during the sync is missed
+            last_batch = uidnext is None or end >= uidnext - 1
+            messages = self._fetch(mail, f"{start}:{'*' if last_batch else end}", '(UID FLAGS ENVELOPE)')
+            rows = []
+            for message in messages:
+                uid = int(message['UID'])
+                # 'n:*' always returns the newest message, even when it is below n
+                if uid < start:
+                    continue
+                envelope = parse_envelope(message.get('ENVELOPE') or [])
+                sender = _address_string(envelope['from'])
+                subject = envelope['subject'] or ''
+                rows.append((mailbox, uid, envelope['message_id'], _flag_string(message.get('FLAGS')), sender, subject,
+                             envelope['date'], sender.casefold(), subject.casefold()))
+                state['last_uid'] = max(state['last_uid'], uid)
+            if last_batch and uidnext is not None:
+                state['last_uid'] = max(state['last_uid'], uidnext - 1)
+            elif not last_batch:
+                state['last_uid'] = max(state['last_uid'], end)
+            with self._lock, self._db:
+                self._db.executemany('REPLACE INTO mirror_messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._save_state(mailbox, state)
+                self._stats['added'] += len(rows)
+            if last_batch:
+                return
+            start = end + 1
+
+    def sync(self, mail, mailbox='INBOX'):
+        """
+        Resync a mailbox incrementally. The session is left with the mailbox selected read-only.
+
+        Parameters:
+        mail: A logged-in session, passed through prepare_session() for QRESYNC
+        mailbox (str): Mailbox to mirror
+
+        Returns:
+        dict: mode, added, removed and flag_updates of this sync
+        """
+        with self._sync_lock:
+            return self._sync(mail, mailbox)
+
+    def _sync(self, mail, mailbox):
+        started = time.monotonic()
+        mode = getattr(mail, 'mirror_mode', None) or ('condstore' if supports(mail, 'CONDSTORE') else 'uid-diff')
+        with self._lock:
+            before = dict(self._stats)
+            state = self._state(mailbox)
+
+        try:
+            selected = self._select(mail, mailbox)
+            if selected['uidvalidity'] != state['uidvalidity']:
+                if state['uidvalidity'] is not None:
+                    logging.info(f'UIDVALIDITY of {mailbox} changed, dropping mailbox mirror')
+                with self._lock, self._db:
+                    self._db.execute('DELETE FROM mirror_messages WHERE mailbox = ?', (mailbox,))
+                    self._stats['resets'] += 1
+                state = {'uidvalidity': selected['uidvalidity'], 'highestmodseq': None, 'last_uid': 0, 'synced_at': None}
+
+            if state['last_uid']:
+                self._sync_known(mail, mailbox, mode, state, selected)
+            self._sync_new(mail, mailbox, state, selected)
+
+            # CONDSTORE alone does not report expunges, a shrunken mailbox needs a UID diff
+            if mode == 'condstore' and selected['exists'] is not None:
+                with self._lock:
+                    count = self._db.execute('SELECT COUNT(*) FROM mirror_messages WHERE mailbox = ?', (mailbox,)).fetchone()[0]
+                if count > selected['exists']:
+                    result, data = mail.uid('SEARCH', None, 'ALL')
+                    if result != 'OK':
+                        raise mail.error('UID SEARCH ALL failed')
+                    self._remove_missing(mailbox, {int(uid) for uid in (data[0] or b'').split()}, state['last_uid'])
+        except (imaplib.IMAP4.error, OSError):
+            with self._lock:
+                self._stats['sync_errors'] += 1
+            raise
+
+        # The mod-sequence from SELECT: anything changed while we synced is newer and comes next time
+        state['highestmodseq'] = selected['highestmodseq'] if mode != 'uid-diff' else None
+        state['synced_at'] = time.time()
+        with self._lock, self._db:
+            self._save_state(mailbox, state)
+            self._stats['syncs'] += 1
+            self._stats['last_sync_mode'] = mode
+            self._stats['last_sync_seconds'] = round(time.monotonic() - started, 3)
+            return {
+                'mode': mode,
+                'added': self._stats['added'] - before['added'],
+                'removed': self._stats['removed'] - before['removed'],
+                'flag_updates': self._stats['flag_updates'] - before['flag_updates'],
+            }
+
+    def discard_uids(self, uids, mailbox='INBOX'):
+        """Forget UIDs that no longer exist in the mailbox, e.g. after a MOVE."""
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM mirror_messages WHERE mailbox = ? AND uid = ?',
+                                 [(mailbox, int(uid)) for uid in uids])
+
+    def apply_flags(self, uids, flags, action='add', mailbox='INBOX'):
+        """Apply a successful STORE locally: action is 'add', 'remove' or 'replace' as in store_flags()."""
+        flags = [str(flag) for flag in flags]
+        with self._lock, self._db:
+            rows = []
+            for uid in uids:
+                row = self._db.execute('SELECT flags FROM mirror_messages WHERE mailbox = ? AND uid = ?',
+                                       (mailbox, int(uid))).fetchone()
+                if row is None:
+                    continue
+                current = set(row[0].split())
+                if action == 'add':
+                    current |= set(flags)
+                elif action == 'remove':
+                    current -= set(flags)
+                else:
+                    current = set(flags)
+                rows.append((_flag_string(current), mailbox, int(uid)))
+            self._db.executemany('UPDATE mirror_messages SET flags = ? WHERE mailbox = ? AND uid = ?', rows)
+
+    def get_uid(self, message_id, mailbox='INBOX'):
+        """Local lookup only, no IMAP traffic. Returns the UID as string or None."""
+        with self._lock:
+            self._stats['lookups'] += 1
+            row = self._db.execute('SELECT uid FROM mirror_messages WHERE mailbox = ? AND message_id = ? LIMIT 1',
+                                   (mailbox, normalize_message_id(message_id))).fetchone()
+        return str(row[0]) if row else None
+
+    def find(self, mailbox='INBOX', uids=None, message_id=None, sender=None, subject=None, flags=(), without_flags=(), limit=50):
+        """
+        Search the mirror, newest first. Sender and subject match case-insensitive substrings.
+
+        Returns:
+        list: Dicts with uid, message_id, flags, from, subject and date
+        """
+        clauses, params = ['mailbox = ?'], [mailbox]
+        if uids:
+            clauses.append(f"uid IN ({','.join('?' * len(uids))})")
+            params.extend(int(uid) for uid in uids)
+        if message_id:
+            clauses.append('message_id = ?')
+            params.append(normalize_message_id(message_id))
+        if sender:
+            clauses.append('instr(sender_key, ?) > 0')
+            params.append(sender.casefold())
+        if subject:
+            clauses.append('instr(subject_key, ?) > 0')
+            params.append(subject.casefold())
+        for flag in flags or ():
+            clauses.append('instr(flags, ?) > 0')
+            params.append(f' {flag} ')
+        for flag in without_flags or ():
+            clauses.append('instr(flags, ?) = 0')
+            params.append(f' {flag} ')
+        params.append(int(limit))
+        with self._lock:
+            self._stats['lookups'] += 1
+            rows = self._db.execute(
+                f"SELECT uid, message_id, flags, sender, subject, date FROM mirror_messages "
+                f"WHERE {' AND '.join(clauses)} ORDER BY uid DESC LIMIT ?", params).fetchall()
+        return [{'uid': str(uid), 'message_id': message_id, 'flags': flags.split(), 'from': sender, 'subject': subject, 'date': date}
+                for uid, message_id, flags, sender, subject, date in rows]
+
+    def synced_at(self, mailbox='INBOX'):
+        with self._lock:
+            return self._state(mailbox)['synced_at']
+
+    def uidvalidity(self, mailbox='INBOX'):
+        with self._lock:
+            return self._state(mailbox)['uidvalidity']
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['mailboxes'] = {
+                mailbox: {'uidvalidity': uidvalidity, 'highestmodseq': highestmodseq, 'last_uid': last_uid,
+                          'synced_at': synced_at, 'entries': entries}
+                for mailbox, uidvalidity, highestmodseq, last_uid, synced_at, entries in self._db.execute(
+                    'SELECT m.mailbox, m.uidvalidity, m.highestmodseq, m.last_uid, m.synced_at, '
+                    '(SELECT COUNT(*) FROM mirror_messages WHERE mailbox = m.mailbox) FROM mirror_mailboxes m')
+            }
+        return stats
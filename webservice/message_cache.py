@@ -0,0 +1,209 @@
+import email.message
+import json
+import threading
+import time
+from collections import OrderedDict
+from shared_state import connect
+
+
+class MessageCache:
+    """
+    LRU cache of parsed messages keyed by (mailbox, UIDVALIDITY, UID).
+
+    Each entry holds the message headers and the extracted plain text, the attachments are
+    never kept. Entries are evicted least recently used first once max_bytes is exceeded,
+    and expire after ttl seconds.
+
+    With a path every entry is also written to a SQLite file that worker processes share: a
+    local miss is looked up there before anyone fetches the message again. The file has its
+    own max_bytes budget, the oldest entries leave it first.
+
+    Parameters:
+    max_bytes (int): Approximate memory budget for all entries
+    ttl (float): Seconds an entry stays valid
+    path (str): Optional SQLite file shared with other processes
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=900, path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, size, entry)
+        self._uidvalidity = {}  # mailbox -> last UIDVALIDITY seen on SELECT
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'shared_hits': 0}
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS cache_mailboxes (
+                    mailbox TEXT PRIMARY KEY,
+                    uidvalidity INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cached_messages (
+                    mailbox TEXT NOT NULL,
+                    uidvalidity INTEGER NOT NULL,
+                    uid TEXT NOT NULL,
+                    entry TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (mailbox, uidvalidity, uid)
+                );
+                CREATE INDEX IF NOT EXISTS cached_messages_expires_at ON cached_messages (expires_at);
+            """)
+
+    @staticmethod
+    def _size(headers, text):
+        size = len(text or '')
+        for name, value in headers.items():
+            size += len(name) + len(str(value))
+        return size
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _add(self, key, entry, size, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, entry)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._stats['evictions'] += 1
+
+    @staticmethod
+    def _encode(entry):
+        # JSON escapes the undecodable bytes some headers carry, SQLite text would reject them
+        return json.dumps({'headers': [[name, str(value)] for name, value in entry['headers'].items()], 'text': entry['text']})
+
+    @staticmethod
+    def _decode(data):
+        data = json.loads(data)
+        headers = email.message.Message()
+        for name, value in data['headers']:
+            headers[name] = value
+        return {'headers': headers, 'text': data['text']}
+
+    def _shared_get(self, key):
+        row = self._db.execute('SELECT entry, size, expires_at FROM cached_messages WHERE mailbox = ? AND uidvalidity = ? AND uid = ?',
+                               key).fetchone()
+        if row is None or row[2] < time.time():
+            return None
+        entry = self._decode(row[0])
+        self._add(key, entry, row[1], time.monotonic() + row[2] - time.time())
+        self._stats['shared_hits'] += 1
+        return entry
+
+    def _shared_put(self, key, entry, size):
+        now = time.time()
+        with self._db:
+            self._db.execute('REPLACE INTO cached_messages VALUES (?, ?, ?, ?, ?, ?)',
+                             (*key, self._encode(entry), size, now + self.ttl))
+            self._db.execute('DELETE FROM cached_messages WHERE expires_at < ?', (now,))
+            excess = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cached_messages').fetchone()[0] - self.max_bytes
+            if excess <= 0:
+                return
+            oldest = []
+            for mailbox, uidvalidity, uid, size in self._db.execute(
+                    'SELECT mailbox, uidvalidity, uid, size FROM cached_messages ORDER BY expires_at'):
+                oldest.append((mailbox, uidvalidity, uid))
+                excess -= size
+                if excess <= 0:
+                    break
+            self._db.executemany('DELETE FROM cached_messages WHERE mailbox = ? AND uidvalidity = ? AND uid = ?', oldest)
+
+    def _drop_mailbox(self, mailbox):
+        for key in [key for key in self._entries if key[0] == mailbox]:
+            self._remove(key)
+
+    def note_uidvalidity(self, mailbox, uidvalidity):
+        """Record the UIDVALIDITY from a SELECT, dropping the mailbox's entries if it changed."""
+        with self._lock:
+            previous = self._uidvalidity.get(mailbox)
+            self._uidvalidity[mailbox] = uidvalidity
+            if previous is not None and previous != uidvalidity:
+                self._drop_mailbox(mailbox)
+            if self._db and uidvalidity is not None and previous != uidvalidity:
+                with self._db:
+                    self._db.execute('DELETE FROM cached_messages WHERE mailbox = ? AND uidvalidity != ?', (mailbox, uidvalidity))
+                    self._db.execute('REPLACE INTO cache_mailboxes VALUES (?, ?)', (mailbox, uidvalidity))
+
+    def key(self, mailbox, uid):
+        """Cache key for a UID based on the last known UIDVALIDITY, None if the mailbox was never selected."""
+        with self._lock:
+            uidvalidity = self._uidvalidity.get(mailbox)
+            if self._db:
+                # Another worker process may have selected the mailbox, or seen its UIDVALIDITY change
+                row = self._db.execute('SELECT uidvalidity FROM cache_mailboxes WHERE mailbox = ?', (mailbox,)).fetchone()
+                if row and row[0] != uidvalidity:
+                    if uidvalidity is not None:
+                        # Our entries belong to UIDs the server may hand out again
+                        self._drop_mailbox(mailbox)
+                    uidvalidity = self._uidvalidity[mailbox] = row[0]
+        if uidvalidity is None:
+            return None
+        return (mailbox, uidvalidity, str(uid))
+
+    def get(self, key):
+        """
+        Returns:
+        dict: {'headers': email.message.Message, 'text': str or None} or None on a miss
+        """
+        if key is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] < time.monotonic():
+                self._remove(key)
+                self._stats['expired'] += 1
+                cached = None
+            if cached is None:
+                entry = self._shared_get(key) if self._db and key[1] is not None else None
+                self._stats['hits' if entry else 'misses'] += 1
+                return entry
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return cached[2]
+
+    def put(self, key, message, text):
+        """
+        Store the headers of a parsed message together with its extracted text.
+
+        Returns:
+        dict: The cached entry
+        """
+        headers = email.message.Message()
+        for name, value in message.items():
+            headers[name] = value
+        entry = {'headers': headers, 'text': text}
+        size = self._size(headers, text)
+        if key is None or size > self.max_bytes:
+            return entry
+        with self._lock:
+            self._add(key, entry, size, time.monotonic() + self.ttl)
+            if self._db and key[1] is not None:
+                self._shared_put(key, entry, size)
+        return entry
+
+    def discard(self, mailbox, uids):
+        """Drop entries for UIDs that left the mailbox, e.g. after a MOVE."""
+        uids = {str(uid) for uid in uids}
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == mailbox and key[2] in uids]:
+                self._remove(key)
+            if self._db:
+                with self._db:
+                    self._db.executemany('DELETE FROM cached_messages WHERE mailbox = ? AND uid = ?',
+                                         [(mailbox, uid) for uid in uids])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes})
+            if self._db:
+                entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cached_messages').fetchone()
+                stats['shared'] = {'entries': entries, 'bytes': size}
+        return stats
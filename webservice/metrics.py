@@ -0,0 +1,256 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a cached lookup to a slow OpenAI answer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels, inc() costs one lock round trip."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dump(self):
+        with self._lock:
+            return self.rows(self._values)
+
+    @staticmethod
+    def rows(values):
+        return [[list(labels), value] for labels, value in values.items()]
+
+    @staticmethod
+    def merge(values, dumped):
+        for labels, value in dumped:
+            labels = tuple(labels)
+            values[labels] = values.get(labels, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        return [f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}' for labels, value in sorted(values.items())]
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus layout, one set of buckets per label combination.
+
+    observe() does a bisect and three additions under a lock, cheap enough for every IMAP command.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [counts per bucket (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def dump(self):
+        with self._lock:
+            return self.rows(self._series)
+
+    @staticmethod
+    def rows(series):
+        return [[list(labels), list(counts), total, count] for labels, (counts, total, count) in series.items()]
+
+    @staticmethod
+    def merge(series, dumped):
+        for labels, counts, total, count in dumped:
+            labels = tuple(labels)
+            if labels not in series:
+                series[labels] = (list(counts), total, count)
+                continue
+            merged = series[labels]
+            series[labels] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + count)
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+
+    def samples(self, series=None):
+        if series is None:
+            series = self.snapshot()
+        lines = []
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {repr(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Registry:
+    """
+    The metrics of a process. With share() every worker process writes its values to a common
+    directory and render() adds up the files of all of them, so any worker answers a scrape
+    for the whole server. The master process clears the directory when the server starts and
+    folds the file of every exited worker into exited.json, which keeps counters monotonic
+    without a new worker that got the same PID overwriting them.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def share(self, directory, interval=5):
+        """
+        Write this process's values to directory every interval seconds and on every render().
+
+        Parameters:
+        directory (str): Shared by all worker processes, created if missing
+        interval (float): Seconds between writes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        def flush_loop():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        threading.Thread(target=flush_loop, name='metrics-flush', daemon=True).start()
+
+    def flush(self):
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        try:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({metric.name: metric.dump() for metric in self._metrics}, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logging.warning(f'Writing metrics to {path} failed: {str(e)}')
+
+    def _merge_files(self, paths):
+        merged = {metric.name: {} for metric in self._metrics}
+        for path in paths:
+            try:
+                with open(path) as f:
+                    dumped = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric in self._metrics:
+                metric.merge(merged[metric.name], dumped.get(metric.name, []))
+        return merged
+
+    def _merged(self):
+        self.flush()
+        return self._merge_files(glob.glob(os.path.join(self.directory, '*.json')))
+
+    def clear_shared(self, directory):
+        """Remove the files of an earlier run, for the master process before it starts any worker."""
+        for path in glob.glob(os.path.join(directory, '*.json')) + glob.glob(os.path.join(directory, '*.json.tmp')):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f'Removing metrics file {path} failed: {str(e)}')
+
+    def retire(self, directory, pid):
+        """
+        Fold the file of an exited worker into exited.json. Only for the master process, which
+        sees every exit once, so no file is counted twice.
+        """
+        path = os.path.join(directory, f'{pid}.json')
+        if not os.path.exists(path):
+            return
+        archive = os.path.join(directory, 'exited.json')
+        merged = self._merge_files([archive, path])
+        try:
+            with open(f'{archive}.tmp', 'w') as f:
+                json.dump({metric.name: metric.rows(merged[metric.name]) for metric in self._metrics}, f)
+            os.replace(f'{archive}.tmp', archive)
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f'Folding metrics of worker {pid} into {archive} failed: {str(e)}')
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        merged = self._merged() if self.directory else {}
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(merged.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = Registry()
+
+# Where the time of a request goes: IMAP commands by name, MIME parsing, HTML conversion, OpenAI
+phase_seconds = registry.histogram(
+    'webservice_phase_seconds', 'Duration of one phase of request handling', ('phase',))
+request_seconds = registry.histogram(
+    'webservice_request_seconds', 'Duration of HTTP requests by route', ('route', 'method'))
+imap_bytes = registry.counter(
+    'webservice_imap_received_bytes_total', 'Bytes read from IMAP connections')
+openai_tokens = registry.counter(
+    'webservice_openai_tokens_total', 'Tokens reported by the OpenAI API', ('type',))
@@ -0,0 +1,252 @@
+import email
+from bodystructure import _as_bytes, decode_part, parse_fetch_response
+from imap_batch import uid_set_chunks
+from metrics import phase_seconds
+
+# Longest line kept whole: boundaries are at most 70 characters, longer lines are passed on in pieces
+MAX_LINE = 8192
+# Header blocks beyond this are cut, a part's headers are only read for its type and boundary
+MAX_HEADER = 64 * 1024
+
+
+class TextPartCollector:
+    """
+    Incremental MIME parser that keeps the headers and inline text parts of an email.
+
+    Bytes are fed in as they arrive and walked line by line: headers of every part are parsed
+    to follow the multipart boundaries, the transfer-encoded body of inline text/plain and
+    text/html parts is kept up to max_text bytes, and every other payload is dropped the moment
+    it streams past. Memory stays at a few times max_text no matter how big the email is.
+
+    email.parser.BytesFeedParser is no help here: it holds each part until its closing
+    boundary, so one large attachment would still end up in memory whole.
+
+    Parameters:
+    max_text (int): Bytes kept of each text part, as transferred (base64 is about 4/3 of the text)
+    """
+
+    def __init__(self, max_text=1024 * 1024):
+        self.max_text = max_text
+        self.headers = None
+        self.text_content = None
+        self.html_content = None
+        self._buffer = bytearray()
+        self._line_start = True
+        self._boundaries = []
+        self._state = 'header'
+        self._header = bytearray()
+        self._part = None
+        self._body = bytearray()
+
+    def feed(self, data):
+        """Parse the next bytes of the email."""
+        buffer = self._buffer
+        buffer += data
+        start = 0
+        while start < len(buffer):
+            if self._skipping() and not (self._line_start and buffer.startswith(b'--', start)):
+                # Only a delimiter changes anything here, jump to the next line that could be one
+                found = buffer.find(b'\n--', start) if self._boundaries else -1
+                if found >= 0:
+                    start = found + 1
+                    self._line_start = True
+                    continue
+                last = buffer.rfind(b'\n', start)
+                if last >= 0:
+                    start = last + 1
+                    self._line_start = True
+                if not self._boundaries:
+                    start = len(buffer)
+                break
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                break
+            self._line(bytes(buffer[start:end + 1]))
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > MAX_LINE:
+            # No boundary is this long, hand the line on in pieces instead of buffering it whole
+            self._line(bytes(buffer))
+            buffer.clear()
+
+    def close(self):
+        """
+        Finish parsing once the whole email has been fed.
+
+        Returns:
+        tuple: (headers, text_content, html_content) like fetch_text_parts()
+        """
+        if self._buffer:
+            self._line(bytes(self._buffer))
+            self._buffer.clear()
+        if self._state == 'header':
+            self._end_header()
+        if self._state == 'body':
+            self._end_part()
+        if self.headers is None:
+            self.headers = email.message_from_bytes(b'')
+        return self.headers, self.text_content, self.html_content
+
+    def _skipping(self):
+        # Preamble, epilogue, attachments and text beyond max_text
+        if self._state == 'skip':
+            return True
+        return self._state == 'body' and (self._part is None or len(self._body) >= self.max_text)
+
+    def _line(self, line):
+        line_start = self._line_start
+        self._line_start = line.endswith(b'\n')
+        if line_start and line.startswith(b'--') and self._boundaries and self._boundary(line):
+            return
+        if self._state == 'header':
+            if line_start and line in (b'\r\n', b'\n'):
+                self._end_header()
+            elif len(self._header) < MAX_HEADER:
+                self._header += line
+        elif self._state == 'body' and self._part is not None and len(self._body) < self.max_text:
+            self._body += line[:self.max_text - len(self._body)]
+
+    def _boundary(self, line):
+        # A delimiter of the innermost multipart, or of an outer one whose inner parts were left open
+        marker = line.rstrip(b' \t\r\n')
+        for depth in range(len(self._boundaries) - 1, -1, -1):
+            delimiter = b'--' + self._boundaries[depth]
+            if marker not in (delimiter, delimiter + b'--'):
+                continue
+            if self._state == 'header':
+                self._end_header()
+            if self._state == 'body':
+                self._end_part()
+            if marker == delimiter:
+                del self._boundaries[depth + 1:]
+                self._state = 'header'
+                self._header.clear()
+            else:
+                # Closed: everything up to the next delimiter of the enclosing multipart is epilogue
+                del self._boundaries[depth:]
+                self._state = 'skip'
+            return True
+        return False
+
+    def _end_header(self):
+        with phase_seconds.time('mime_parse'):
+            headers = email.message_from_bytes(bytes(self._header))
+        self._header.clear()
+        if self.headers is None:
+            self.headers = headers
+        content_type = headers.get_content_type()
+        if headers.get_content_maintype() == 'multipart' and headers.get_boundary():
+            # Everything up to the first delimiter is preamble
+            self._boundaries.append(headers.get_boundary().encode('ascii', 'replace'))
+            self._state = 'skip'
+        elif content_type == 'message/rfc822':
+            # The body is an encapsulated email, its headers come next
+            self._state = 'header'
+        else:
+            self._state = 'body'
+            attachment = headers.get_content_disposition() == 'attachment'
+            if content_type in ('text/plain', 'text/html') and not attachment:
+                self._part = {
+                    'subtype': headers.get_content_subtype(),
+                    'encoding': str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower(),
+                    'charset': headers.get_content_charset() or 'utf-8',
+                }
+
+    def _end_part(self):
+        part, body = self._part, bytes(self._body)
+        self._part = None
+        self._body.clear()
+        self._state = 'skip'
+        if part is None:
+            return
+        # The line break before a delimiter belongs to the delimiter
+        if body.endswith(b'\r\n'):
+            body = body[:-2]
+        elif body.endswith(b'\n'):
+            body = body[:-1]
+        with phase_seconds.time('mime_parse'):
+            text = decode_part(body, part['encoding'], part['charset'])
+        # The last text/plain and the last text/html part, like extract_text() walks them
+        if part['subtype'] == 'plain':
+            self.text_content = text
+        else:
+            self.html_content = text
+
+
+def fetch_text_stream(mail, uids, window=1024 * 1024, batch_bytes=8 * 1024 * 1024, max_text=1024 * 1024):
+    """
+    Fetch emails in BODY.PEEK[]<offset.length> windows and keep only their headers and text parts.
+
+    One FETCH asks for the size of every email. Emails that fit into a window are then
+    downloaded whole, as many per FETCH as fit into batch_bytes; larger ones one window after
+    the other, each fed to a TextPartCollector before the next is asked for. At most
+    max(window, batch_bytes) of the emails is in memory at any time, plus the text kept.
+
+    Parameters:
+    mail: IMAP session with the mailbox selected
+    uids (list): UIDs of the emails
+    window (int): Bytes per FETCH of a large email
+    batch_bytes (int): Bytes of small emails per FETCH
+    max_text (int): Bytes kept of each text part
+
+    Returns:
+    dict: uid (str) -> (headers, text_content, html_content), UIDs that could not be fetched are missing
+    """
+    sizes = {}
+    for sequence_set, _ in uid_set_chunks(uids):
+        result, data = mail.uid('FETCH', sequence_set, '(UID RFC822.SIZE)')
+        if result != 'OK':
+            continue
+        for message in parse_fetch_response(data):
+            if 'UID' in message and 'RFC822.SIZE' in message:
+                sizes[str(int(message['UID']))] = int(message['RFC822.SIZE'])
+
+    found = {}
+    batch, batch_size = [], 0
+    for uid, size in sizes.items():
+        if size > window:
+            continue
+        if batch and batch_size + size > batch_bytes:
+            found.update(_fetch_whole(mail, batch, window, max_text))
+            batch, batch_size = [], 0
+        batch.append(uid)
+        batch_size += size
+    if batch:
+        found.update(_fetch_whole(mail, batch, window, max_text))
+
+    for uid, size in sizes.items():
+        if size > window:
+            fetched = _fetch_windows(mail, uid, size, window, max_text)
+            if fetched:
+                found[uid] = fetched
+    return found
+
+
+def _fetch_whole(mail, uids, window, max_text):
+    found = {}
+    for sequence_set, _ in uid_set_chunks(uids):
+        result, data = mail.uid('FETCH', sequence_set, f'(UID BODY.PEEK[]<0.{window}>)')
+        if result != 'OK':
+            continue
+        for message in parse_fetch_response(data):
+            if 'UID' not in message or 'BODY[]<0>' not in message:
+                continue
+            collector = TextPartCollector(max_text)
+            collector.feed(_as_bytes(message['BODY[]<0>']))
+            found[str(int(message['UID']))] = collector.close()
+    return found
+
+
+def _fetch_windows(mail, uid, size, window, max_text):
+    collector = TextPartCollector(max_text)
+    for offset in range(0, size, window):
+        result, data = mail.uid('FETCH', uid, f'(UID BODY.PEEK[]<{offset}.{window}>)')
+        if result != 'OK':
+            return None
+        chunks = [message[f'BODY[]<{offset}>'] for message in parse_fetch_response(data) if f'BODY[]<{offset}>' in message]
+        del data
+        if not chunks or not chunks[0]:
+            break
+        collector.feed(_as_bytes(chunks[0]))
+        del chunks
+    return collector.close()
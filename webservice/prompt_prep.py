@@ -0,0 +1,167 @@
+import logging
+import re
+
+# Lines that start the quoted or forwarded history below a reply
+HISTORY_MARKERS = [
+    re.compile(r'^\s*-{2,}\s*(Original Message|Ursprüngliche Nachricht|Originalnachricht)\s*-{2,}\s*$', re.I),
+    re.compile(r'^\s*-{2,}\s*(Forwarded message|Weitergeleitete Nachricht)\s*-{2,}\s*$', re.I),
+    re.compile(r'^\s*(Begin forwarded message|Anfang der weitergeleiteten Nachricht)\s*:\s*$', re.I),
+    re.compile(r'^\s*On\b.{0,200}\bwrote:\s*$', re.I),
+    re.compile(r'^\s*Am\b.{0,200}\bschrieb\b.{0,200}:\s*$', re.I),
+    re.compile(r'^_{20,}\s*$'),
+]
+
+# Outlook style header blocks: "Von: ..." followed by "Gesendet: ..." within the next lines
+HEADER_BLOCK_START = re.compile(r'^\s*\*?(From|Von)\s*:\*?\s', re.I)
+HEADER_BLOCK_FIELD = re.compile(r'^\s*\*?(Sent|Date|Gesendet|Datum|To|An|Subject|Betreff)\s*:', re.I)
+
+QUOTE_LINE = re.compile(r'^\s*>')
+
+# Closing phrases, everything after the line holding them and the sender's name is signature
+CLOSINGS = re.compile(
+    r'^\s*(mit freundlichen grüßen|mit freundlichen gruessen|freundliche grüße|viele grüße|beste grüße|'
+    r'liebe grüße|herzliche grüße|schöne grüße|gruß|mfg|lg|vg|best regards|kind regards|warm regards|'
+    r'regards|best wishes|best|cheers|thanks|many thanks|thank you|sincerely|yours sincerely)\b[\s,.!]*$',
+    re.I
+)
+SIGNATURE_DELIMITER = re.compile(r'^-- ?$')
+
+# Paragraphs of legal boilerplate that never help to answer an email
+DISCLAIMERS = re.compile(
+    r'(vertrauliche (und/oder rechtlich geschützte )?informationen|(is|are|may be) (strictly )?confidential|'
+    r'confidentiality notice|intended (solely )?for the (use of the )?(named )?(addressee|recipient)|'
+    r'nicht der (richtige|beabsichtigte) (adressat|empfänger)|unbefugte weitergabe|'
+    r'if you (have )?received this (e-?mail|message) (in error|by mistake)|'
+    r'sitz der gesellschaft|registergericht|handelsregister|amtsgericht|geschäftsführ(er|ung)\s*:|'
+    r'ust-?id|vat (reg|id)|hrb \d|registered (office|in england)|'
+    r'think before (you )?print|denken sie an die umwelt|bevor sie diese e-?mail ausdrucken)',
+    re.I
+)
+
+TRUNCATION_MARKER = '\n[…]'
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    """The GPT-4 tokenizer if tiktoken and its encoding file are available, else None."""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # Missing package or no cached encoding file: estimate instead of failing requests
+            logging.warning(f'tiktoken unavailable, estimating token counts: {str(e)}')
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # About four characters per token for German and English prose
+    return (len(text) + 3) // 4
+
+
+def truncate_to_budget(text, budget):
+    """Cut text to at most budget tokens, keeping the beginning where the newest message is."""
+    if budget <= 0 or count_tokens(text) <= budget:
+        return text, False
+    encoding = _get_encoding()
+    if encoding is not None:
+        text = encoding.decode(encoding.encode(text)[:budget])
+    else:
+        text = text[:budget * 4]
+    # Do not end in the middle of a word
+    cut = text.rfind(' ', len(text) - 80)
+    if cut > 0:
+        text = text[:cut]
+    return text.rstrip() + TRUNCATION_MARKER, True
+
+
+def strip_quoted_history(text):
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        if any(marker.match(line) for marker in HISTORY_MARKERS):
+            return '\n'.join(lines[:index])
+        if HEADER_BLOCK_START.match(line):
+            following = [l for l in lines[index + 1:index + 6] if l.strip()]
+            if sum(1 for l in following if HEADER_BLOCK_FIELD.match(l)) >= 2:
+                return '\n'.join(lines[:index])
+    # A quoted block at the end without a marker line; quotes answered inline stay as context
+    end = len(lines)
+    while end > 0 and (QUOTE_LINE.match(lines[end - 1]) or not lines[end - 1].strip()):
+        end -= 1
+    return '\n'.join(lines[:end])
+
+
+def strip_signature(text):
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        if SIGNATURE_DELIMITER.match(line):
+            return '\n'.join(lines[:index])
+    # Keep the closing and the next non-empty line (the sender's name), drop contact details below
+    for index in range(len(lines) - 1, -1, -1):
+        if CLOSINGS.match(lines[index]):
+            # Only a closing near the end, "Thanks" in the first paragraph is not a signature
+            if len('\n'.join(lines[index:])) > 1500:
+                break
+            keep = index + 1
+            while keep < len(lines) and not lines[keep].strip():
+                keep += 1
+            return '\n'.join(lines[:keep + 1])
+    return text
+
+
+def strip_disclaimers(text):
+    paragraphs = re.split(r'\n\s*\n', text)
+    # The first paragraph is the message itself, boilerplate only follows it
+    kept = paragraphs[:1] + [paragraph for paragraph in paragraphs[1:] if not DISCLAIMERS.search(paragraph)]
+    if len(kept) == len(paragraphs):
+        return text
+    return '\n\n'.join(kept)
+
+
+def prepare_email_text(text, budget):
+    """
+    Shorten an email for the prompt: drop quoted history, signature and disclaimers, then cut to the token budget.
+
+    Parameters:
+    text (str): Plain text of the email
+    budget (int): Maximum tokens for the email, 0 for no limit
+
+    Returns:
+    tuple: (prepared_text, stats) - stats has tokens_before, tokens_after, tokens_saved and removed
+    """
+    text = (text or '').replace('\r\n', '\n')
+    tokens_before = count_tokens(text)
+    removed = []
+
+    prepared = strip_quoted_history(text)
+    if not prepared.strip():
+        # A bare forward has nothing above the history, then the history is the email
+        prepared = text
+    elif prepared.strip() != text.strip():
+        removed.append('quoted')
+
+    for name, step in (('disclaimer', strip_disclaimers), ('signature', strip_signature)):
+        stripped = step(prepared)
+        if stripped.strip() and stripped.strip() != prepared.strip():
+            removed.append(name)
+            prepared = stripped
+
+    prepared = re.sub(r'\n{3,}', '\n\n', prepared).strip()
+    prepared, truncated = truncate_to_budget(prepared, budget)
+    if truncated:
+        removed.append('truncated')
+
+    tokens_after = count_tokens(prepared)
+    return prepared, {
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': tokens_before - tokens_after,
+        'removed': removed,
+    }
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import threading
+import time
+from shared_state import connect
+
+
+def normalize_text(text):
+    """Collapse whitespace so re-fetched or re-wrapped copies of an email hash the same."""
+    return ' '.join((text or '').split())
+
+
+class ResponseCache:
+    """
+    Persistent cache of generated replies, keyed by a hash of everything that shapes the answer.
+
+    Entries live in SQLite (a file with a path, memory otherwise), expire after ttl seconds and
+    are evicted least recently used first once max_bytes of replies are stored. The size budget
+    is counted in the database, so worker processes sharing the file share one budget.
+
+    Parameters:
+    path (str): Optional SQLite file
+    max_bytes (int): Budget for the stored replies
+    ttl (float): Seconds a reply stays valid
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+        """)
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    @staticmethod
+    def key(email_text, user_context, system_prompt, model, temperature, max_tokens):
+        """Content address of a request: same email, hint, prompt, model and sampling -> same key."""
+        material = json.dumps([
+            normalize_text(email_text),
+            normalize_text(user_context),
+            system_prompt,
+            model,
+            temperature,
+            max_tokens,
+        ], ensure_ascii=False)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached reply or None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT response, size, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            response, _, created_at = row
+            with self._db:
+                if created_at + self.ttl < now:
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._stats['expired'] += 1
+                    self._stats['misses'] += 1
+                    return None
+                self._db.execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+            self._stats['hits'] += 1
+            return response
+
+    def put(self, key, response):
+        if not response:
+            return
+        size = len(response.encode())
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._db:
+            # The write transaction starts here, so the total below includes other processes' writes
+            self._db.execute('REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, response, size, now, now))
+            self._stats['stores'] += 1
+
+            # Expired entries go first, then the least recently used until we fit again
+            expired = self._db.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,)).rowcount
+            self._stats['expired'] += expired
+            total = self._size()
+            while total > self.max_bytes:
+                oldest = self._db.execute('SELECT key, size FROM responses ORDER BY used_at LIMIT 1').fetchone()
+                if oldest is None:
+                    break
+                self._db.execute('DELETE FROM responses WHERE key = ?', (oldest[0],))
+                total -= oldest[1]
+                self._stats['evictions'] += 1
+
+    def _size(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            stats.update({'bytes': self._size(), 'max_bytes': self.max_bytes})
+        return stats
@@ -0,0 +1,98 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+from metrics import registry
+from shared_state import state_path
+
+load_dotenv()
+
+# dev: Flask development server, asgi: Quart app on Hypercorn with non-blocking OpenAI calls,
+# prefork: the Flask app on Gunicorn worker processes, reloaded gracefully on SIGHUP
+SERVER_MODE = os.getenv('SERVER_MODE', 'dev')
+PORT = int(os.getenv('PORT'))
+# Worker processes (prefork and asgi) and request threads per worker (prefork)
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+WEB_THREADS = int(os.getenv('WEB_THREADS', 8))
+# Seconds a request may run, suggestions wait for OpenAI, and a reload waits for running ones
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', 120))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+# Replace a worker after this many requests, 0 keeps it for good
+WEB_MAX_REQUESTS = int(os.getenv('WEB_MAX_REQUESTS', 0))
+# Where worker processes share their metrics, the same default as in app.py
+METRICS_DIR = os.getenv('METRICS_DIR') or state_path(os.getenv('STATE_DIR'), 'metrics')
+
+def worker_exit(server, worker):
+    # In the worker: write what it counted since the last periodic flush
+    if registry.directory:
+        registry.flush()
+
+def child_exit(server, worker):
+    # In the master: keep the exited worker's counts, under a name no later worker can reuse
+    if METRICS_DIR:
+        registry.retire(METRICS_DIR, worker.pid)
+
+def prefork():
+    from gunicorn.app.base import BaseApplication
+
+    class PreforkServer(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported in each worker after the fork, IMAP sessions, SQLite connections and
+            # background threads are never inherited from the master
+            from app import app
+            return app
+
+    options = {
+        'bind': f'0.0.0.0:{PORT}',
+        'workers': WEB_WORKERS,
+        'threads': WEB_THREADS,
+        'worker_class': 'gthread',
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+        'max_requests': WEB_MAX_REQUESTS,
+        'max_requests_jitter': WEB_MAX_REQUESTS // 10,
+        'keepalive': 5,
+        'worker_exit': worker_exit,
+        'child_exit': child_exit,
+    }
+    # Worker heartbeats on a disk-backed /tmp can stall inside containers
+    if os.path.isdir('/dev/shm'):
+        options['worker_tmp_dir'] = '/dev/shm'
+    PreforkServer(options).run()
+
+def main():
+    # Files of an earlier run would be added to this one's, or overwritten by a worker that gets the same PID
+    if METRICS_DIR:
+        registry.clear_shared(METRICS_DIR)
+    if SERVER_MODE == 'prefork':
+        prefork()
+    elif SERVER_MODE == 'asgi':
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f'0.0.0.0:{PORT}']
+        if WEB_WORKERS > 1:
+            # Hypercorn spawns the workers, each imports the app on its own
+            from hypercorn.run import run
+
+            config.workers = WEB_WORKERS
+            config.application_path = 'asgi_app:app'
+            run(config)
+        else:
+            from hypercorn.asyncio import serve
+            from asgi_app import app
+
+            asyncio.run(serve(app, config))
+    else:
+        from app import app
+        app.run(host='0.0.0.0', port=PORT)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import fcntl
+import os
+import sqlite3
+
+# Seconds a write waits for another process's transaction instead of failing with 'database is locked'
+BUSY_TIMEOUT = 30
+
+
+def connect(path=None):
+    """
+    SQLite connection that several worker processes can open on the same file.
+
+    Files use the WAL journal, so readers in one process never block the writer in another,
+    and wait up to BUSY_TIMEOUT seconds for a competing write. Without a path the database
+    lives in memory and is private to the process.
+
+    Returns:
+    sqlite3.Connection: Usable from any thread, callers serialize access with their own lock
+    """
+    db = sqlite3.connect(path or ':memory:', check_same_thread=False, timeout=BUSY_TIMEOUT)
+    if path:
+        db.execute('PRAGMA journal_mode=WAL')
+        # Durable at checkpoints, a crash can only lose the last cached entries
+        db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+def state_path(directory, name):
+    """Path of a shared file in the state directory, None when there is none."""
+    return os.path.join(directory, name) if directory else None
+
+
+class ProcessLock:
+    """
+    Non-blocking lock on a file, held by at most one process at a time.
+
+    Used to elect the worker that runs background work such as the mailbox mirror sync.
+    The kernel drops the lock when its process exits, so another worker takes over on its
+    next acquire().
+
+    Parameters:
+    path (str): Lock file, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        """
+        Returns:
+        bool: True if this process holds the lock (now or already)
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,177 @@
+import hashlib
+import random
+import re
+import threading
+import time
+import zlib
+from array import array
+from shared_state import connect
+
+WORD_RE = re.compile(r'\w+')
+# Mersenne prime for the permutations, above every 32-bit shingle hash
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+
+
+def words(text):
+    """Lowercased words of a text, punctuation and line breaks do not count."""
+    return WORD_RE.findall((text or '').lower())
+
+
+def shingles(text, size=3):
+    """Overlapping runs of size words of the text, hashed to 32 bits."""
+    tokens = words(text)
+    if len(tokens) <= size:
+        return {zlib.crc32(' '.join(tokens).encode())} if tokens else set()
+    return {zlib.crc32(' '.join(tokens[index:index + size]).encode()) for index in range(len(tokens) - size + 1)}
+
+
+def mentions_changes(reply, earlier_text, text):
+    """Whether a reply to earlier_text uses words text no longer has, like a name or an order number."""
+    return not set(words(reply)).isdisjoint(set(words(earlier_text)) - set(words(text)))
+
+
+class MinHasher:
+    """
+    MinHash signatures: the share of equal values in two signatures estimates the Jaccard
+    similarity of the shingle sets, so near-identical emails can be found without comparing texts.
+
+    Parameters:
+    num_perm (int): Values per signature, more are more precise and slower
+    seed (int): Seed of the permutations, signatures are only comparable with the same one
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        self.num_perm = num_perm
+        rng = random.Random(seed)
+        self._permutations = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def signature(self, text):
+        """Returns array('I') of num_perm values, None for a text without words."""
+        hashes = shingles(text)
+        if not hashes:
+            return None
+        return array('I', [min([(a * value + b) % _PRIME for value in hashes]) & _MASK for a, b in self._permutations])
+
+    @staticmethod
+    def similarity(first, second):
+        """Estimated Jaccard similarity of the texts behind two signatures."""
+        return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+class SimilarityIndex:
+    """
+    Earlier suggestions by MinHash signature of their email, for reusing them on near-identical emails.
+
+    A locality-sensitive hash splits each signature into bands, and emails sharing any band
+    are candidates. With the default 16 bands of 4 values, emails with a similarity of 0.7 are
+    found 99% of the time and 0.3 only 12%. Candidates are then ranked by their estimated
+    similarity. Entries are scoped, a suggestion is only offered for the same hint and prompt.
+
+    Entries live in SQLite like the response cache, expire after ttl seconds and the least
+    recently used go once there are more than max_entries.
+
+    Parameters:
+    path (str): Optional SQLite file
+    max_entries (int): Suggestions kept
+    ttl (float): Seconds a suggestion can be offered
+    bands (int): LSH bands, num_perm of the signatures is bands * rows
+    rows (int): Signature values per band
+    """
+
+    def __init__(self, path=None, max_entries=5000, ttl=7 * 24 * 3600, bands=16, rows=4):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = rows
+        self.hasher = MinHasher(bands * rows)
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS similar_replies (
+                id INTEGER PRIMARY KEY,
+                scope TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                email_text TEXT NOT NULL,
+                reply TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS similar_replies_used_at ON similar_replies (used_at);
+            CREATE TABLE IF NOT EXISTS similar_buckets (
+                bucket INTEGER NOT NULL,
+                reply_id INTEGER NOT NULL REFERENCES similar_replies (id) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS similar_buckets_bucket ON similar_buckets (bucket);
+            CREATE INDEX IF NOT EXISTS similar_buckets_reply_id ON similar_buckets (reply_id);
+        """)
+        self._db.execute('PRAGMA foreign_keys=ON')
+        self._stats = {'lookups': 0, 'candidates': 0, 'matches': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def _buckets(self, signature):
+        # One bucket per band, the band number is part of the hash so equal values in different bands differ
+        raw = signature.tobytes()
+        size = self.rows * signature.itemsize
+        return [int.from_bytes(hashlib.blake2b(bytes([band]) + raw[band * size:(band + 1) * size], digest_size=7).digest(), 'big')
+                for band in range(self.bands)]
+
+    def find(self, text, scope, threshold):
+        """
+        Most similar earlier suggestion in the scope, if any reaches threshold.
+
+        Returns:
+        dict: id, similarity, email_text and reply of the match, or None
+        """
+        signature = self.hasher.signature(text)
+        if signature is None:
+            return None
+        buckets = self._buckets(signature)
+        now = time.time()
+        with self._lock:
+            self._stats['lookups'] += 1
+            rows = self._db.execute(f"""
+                SELECT id, signature FROM similar_replies
+                WHERE scope = ? AND created_at >= ? AND id IN (
+                    SELECT reply_id FROM similar_buckets WHERE bucket IN ({', '.join('?' * len(buckets))})
+                )
+            """, [scope, now - self.ttl] + buckets).fetchall()
+            self._stats['candidates'] += len(rows)
+            best, best_similarity = None, 0.0
+            for reply_id, stored in rows:
+                similarity = MinHasher.similarity(signature, array('I', stored))
+                if similarity > best_similarity:
+                    best, best_similarity = reply_id, similarity
+            if best is None or best_similarity < threshold:
+                return None
+            with self._db:
+                self._db.execute('UPDATE similar_replies SET used_at = ? WHERE id = ?', (now, best))
+            email_text, reply = self._db.execute('SELECT email_text, reply FROM similar_replies WHERE id = ?', (best,)).fetchone()
+            self._stats['matches'] += 1
+        return {'id': best, 'similarity': best_similarity, 'email_text': email_text, 'reply': reply}
+
+    def put(self, text, scope, reply):
+        if not reply:
+            return
+        signature = self.hasher.signature(text)
+        if signature is None:
+            return
+        buckets = self._buckets(signature)
+        now = time.time()
+        with self._lock, self._db:
+            reply_id = self._db.execute('INSERT INTO similar_replies VALUES (NULL, ?, ?, ?, ?, ?, ?)',
+                                        (scope, signature.tobytes(), text, reply, now, now)).lastrowid
+            self._db.executemany('INSERT INTO similar_buckets VALUES (?, ?)', [(bucket, reply_id) for bucket in buckets])
+            self._stats['stores'] += 1
+
+            self._stats['expired'] += self._db.execute('DELETE FROM similar_replies WHERE created_at < ?', (now - self.ttl,)).rowcount
+            excess = self._db.execute('SELECT COUNT(*) FROM similar_replies').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute('DELETE FROM similar_replies WHERE id IN (SELECT id FROM similar_replies ORDER BY used_at LIMIT ?)', (excess,))
+                self._stats['evictions'] += excess
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._db.execute('SELECT COUNT(*) FROM similar_replies').fetchone()[0]
+            stats['max_entries'] = self.max_entries
+        return stats
@@ -0,0 +1,133 @@
+import logging
+import re
+import threading
+
+LIST_RE = re.compile(r'^\((?P<attributes>[^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) (?P<name>.+)$')
+
+# Used when the server does not flag its folders, matched against the last path segment.
+# Names are in modified UTF-7 as they appear on the wire, 'Entw&APw-rfe' is 'Entwürfe'
+FALLBACK_NAMES = {
+    '\\Drafts': ('drafts', 'draft', 'entw&apw-rfe'),
+    '\\Sent': ('sent', 'sent items', 'sent messages', 'gesendet', 'gesendete objekte'),
+    '\\Trash': ('trash', 'deleted items', 'deleted messages', 'papierkorb'),
+    '\\Junk': ('junk', 'spam'),
+    '\\Archive': ('archive', 'archiv'),
+}
+
+
+def quote_mailbox(name):
+    """Mailbox name as an IMAP quoted string, imaplib sends arguments verbatim."""
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _unquote(name):
+    if name.startswith('"') and name.endswith('"'):
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+def parse_list_response(data):
+    """
+    Parameters:
+    data (list): Untagged LIST responses as returned by imaplib
+
+    Returns:
+    list: (attributes as a set of str, mailbox name as sent by the server)
+    """
+    folders = []
+    for item in data or ():
+        if isinstance(item, tuple):
+            # The name came as a literal
+            line, name = item[0].decode(errors='replace'), item[1].decode(errors='replace')
+            match = LIST_RE.match(line.rsplit('{', 1)[0].rstrip() + ' x')
+        else:
+            if item is None:
+                continue
+            line = item.decode(errors='replace') if isinstance(item, bytes) else str(item)
+            match = LIST_RE.match(line)
+            name = _unquote(match.group('name')) if match else None
+        if match:
+            folders.append(({attribute.lower() for attribute in match.group('attributes').split()}, name))
+    return folders
+
+
+def find_special_use(folders):
+    """
+    Map special-use attributes to folder names, by the RFC 6154 attributes or else by well-known names.
+
+    Returns:
+    dict: attribute (e.g. '\\Drafts') -> mailbox name
+    """
+    found = {}
+    for attribute in FALLBACK_NAMES:
+        for attributes, name in folders:
+            if attribute.lower() in attributes:
+                found[attribute] = name
+                break
+    for attribute, names in FALLBACK_NAMES.items():
+        if attribute in found:
+            continue
+        for attributes, name in folders:
+            if '\\noselect' not in attributes and re.split(r'[./]', name)[-1].lower() in names:
+                found[attribute] = name
+                break
+    return found
+
+
+class SpecialUseFolders:
+    """
+    Finds Drafts, Sent, Trash and friends with one LIST and remembers them for the process.
+
+    Servers announcing SPECIAL-USE are asked for LIST ... RETURN (SPECIAL-USE), others get a
+    plain LIST that is matched against well-known folder names.
+    """
+
+    def __init__(self):
+        self._folders = None
+        self._lock = threading.Lock()
+        self._stats = {'lookups': 0, 'discoveries': 0}
+
+    def discover(self, mail):
+        """
+        One LIST round trip on a logged-in session.
+
+        Returns:
+        dict: attribute -> mailbox name
+        """
+        if 'SPECIAL-USE' in getattr(mail, 'capabilities', ()):
+            result, data = mail.list('""', '"*" RETURN (SPECIAL-USE)')
+        else:
+            result, data = mail.list('""', '"*"')
+        if result != 'OK':
+            raise mail.error('LIST failed')
+        folders = find_special_use(parse_list_response(data))
+        logging.info(f'Special-use folders: {folders}')
+        with self._lock:
+            self._folders = folders
+            self._stats['discoveries'] += 1
+        return folders
+
+    def get(self, mail, attribute):
+        """
+        Parameters:
+        mail: A logged-in IMAP session, only used while nothing is cached
+        attribute (str): e.g. '\\Drafts'
+
+        Returns:
+        str: The mailbox name or None if the server has no such folder
+        """
+        with self._lock:
+            self._stats['lookups'] += 1
+            folders = self._folders
+        if folders is None:
+            folders = self.discover(mail)
+        return folders.get(attribute)
+
+    def forget(self):
+        """Drop the cached names, e.g. after an APPEND to a folder that was renamed."""
+        with self._lock:
+            self._folders = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, folders=dict(self._folders) if self._folders is not None else None)
@@ -0,0 +1,68 @@
+import threading
+import time
+
+
+class TokenBudget:
+    """
+    Tokens-per-minute budget for OpenAI calls, shared by all threads of a process.
+
+    A call reserves its worst case (prompt plus max_tokens) before it starts and settles with
+    the usage OpenAI reports, handing back what it did not need. Reservations may run the
+    budget into debt, the caller then waits until the refill has paid it off, so calls start
+    in the order they asked. 0 tokens per minute turns the budget off.
+
+    Parameters:
+    tokens_per_minute (int): Refill rate, also the most that can be saved up
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self._rate = tokens_per_minute / 60.0
+        self._available = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'reserved': 0, 'returned': 0, 'waits': 0, 'waited_seconds': 0.0}
+
+    def _refill(self, now):
+        self._available = min(self.tokens_per_minute, self._available + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, tokens):
+        """
+        Take tokens from the budget.
+
+        Returns:
+        float: Seconds to wait before the call may start
+        """
+        if not self.tokens_per_minute:
+            return 0.0
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._available -= tokens
+            self._stats['reserved'] += tokens
+            if self._available >= 0:
+                return 0.0
+            wait = -self._available / self._rate
+            self._stats['waits'] += 1
+            self._stats['waited_seconds'] += wait
+            return wait
+
+    def settle(self, reserved, used):
+        """Hand back the part of a reservation the call did not use, used is None when unknown."""
+        if not self.tokens_per_minute or used is None:
+            return
+        unused = min(reserved, self.tokens_per_minute) - used
+        if unused <= 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._available = min(self.tokens_per_minute, self._available + unused)
+            self._stats['returned'] += unused
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            stats = dict(self._stats, tokens_per_minute=self.tokens_per_minute, available=int(self._available))
+        stats['waited_seconds'] = round(stats['waited_seconds'], 3)
+        return stats
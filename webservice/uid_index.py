@@ -0,0 +1,272 @@
+import email
+import logging
+import re
+import threading
+from shared_state import connect
+
+UID_RE = re.compile(rb'UID (\d+)')
+
+
+def normalize_message_id(message_id):
+    """Strip whitespace and angle brackets so '<a@b>' and 'a@b' hit the same entry."""
+    return message_id.strip().strip('<>').strip() if message_id else message_id
+
+
+def select_mailbox(mail, mailbox='INBOX', readonly=False):
+    """
+    SELECT a mailbox and read the status values the server sends along with it.
+
+    Returns:
+    tuple: (uidvalidity, uidnext) as ints, None where the server did not report them
+    """
+    result, _ = mail.select(mailbox, readonly=readonly)
+    if result != 'OK':
+        raise mail.error(f'SELECT {mailbox} failed')
+    values = []
+    for name in ('UIDVALIDITY', 'UIDNEXT'):
+        _, data = mail.response(name)
+        try:
+            values.append(int(data[-1]))
+        except (TypeError, ValueError, IndexError):
+            values.append(None)
+    return tuple(values)
+
+
+def search_uid_by_message_id(mail, message_id):
+    """
+    Ask the server for the UID of a Message-ID in the selected mailbox (one UID SEARCH round trip).
+
+    Returns:
+    tuple: (uid, error)
+    """
+    message_id = normalize_message_id(message_id)
+    result, data = mail.uid('SEARCH', None, f'HEADER Message-ID "{message_id}"')
+    if result != 'OK':
+        return None, 'Search for Message-ID failed'
+    uids = data[0].split() if data and data[0] else []
+    if not uids:
+        return None, 'No emails found with that Message-ID'
+    return uids[0].decode(), None
+
+
+class MessageIdIndex:
+    """
+    Local Message-ID -> UID map per mailbox.
+
+    New messages are picked up incrementally (only UIDs above the last synced one are fetched)
+    and the whole mailbox entry is thrown away when the server reports a new UIDVALIDITY, on a
+    sync or on any other SELECT passed to note_uidvalidity().
+    With a path the index is also kept in a SQLite file so it survives restarts. Worker processes
+    sharing the file read each other's entries on a local miss and pick up where the last sync
+    of any of them stopped.
+
+    Parameters:
+    path (str): Optional SQLite file
+    sync_batch (int): Number of UIDs fetched per FETCH while syncing
+    """
+
+    def __init__(self, path=None, sync_batch=1000):
+        self.sync_batch = sync_batch
+        self._lock = threading.RLock()
+        self._mailboxes = {}  # mailbox -> {'uidvalidity', 'last_uid', 'uids': {message_id: uid}}
+        self._stats = {'hits': 0, 'misses': 0, 'server_searches': 0, 'synced': 0, 'resets': 0}
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS mailboxes (
+                    mailbox TEXT PRIMARY KEY,
+                    uidvalidity INTEGER,
+                    last_uid INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS message_ids (
+                    mailbox TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    uid INTEGER NOT NULL,
+                    PRIMARY KEY (mailbox, message_id)
+                );
+            """)
+            self._load()
+
+    def _load(self):
+        for mailbox, uidvalidity, last_uid in self._db.execute('SELECT mailbox, uidvalidity, last_uid FROM mailboxes'):
+            self._mailboxes[mailbox] = {'uidvalidity': uidvalidity, 'last_uid': last_uid, 'uids': {}}
+        for mailbox, message_id, uid in self._db.execute('SELECT mailbox, message_id, uid FROM message_ids'):
+            if mailbox in self._mailboxes:
+                self._mailboxes[mailbox]['uids'][message_id] = uid
+
+    def _entry(self, mailbox):
+        return self._mailboxes.setdefault(mailbox, {'uidvalidity': None, 'last_uid': 0, 'uids': {}})
+
+    def _refresh(self, mailbox):
+        # Another worker process may have synced or reset the mailbox since we last looked
+        row = self._db.execute('SELECT uidvalidity, last_uid FROM mailboxes WHERE mailbox = ?', (mailbox,)).fetchone()
+        if row is None:
+            return
+        entry = self._entry(mailbox)
+        if entry['uidvalidity'] != row[0]:
+            entry.update(uidvalidity=row[0], last_uid=0, uids={})
+        entry['last_uid'] = max(entry['last_uid'], row[1])
+
+    def _shared_get(self, mailbox, message_id):
+        row = self._db.execute('SELECT uid FROM message_ids WHERE mailbox = ? AND message_id = ?',
+                               (mailbox, message_id)).fetchone()
+        if row is None:
+            return None
+        self._entry(mailbox)['uids'][message_id] = row[0]
+        return row[0]
+
+    def _reset(self, mailbox, uidvalidity):
+        logging.info(f'UIDVALIDITY of {mailbox} changed, dropping Message-ID index')
+        self._mailboxes[mailbox] = {'uidvalidity': uidvalidity, 'last_uid': 0, 'uids': {}}
+        self._stats['resets'] += 1
+        if self._db:
+            with self._db:
+                self._db.execute('DELETE FROM message_ids WHERE mailbox = ?', (mailbox,))
+                self._db.execute('REPLACE INTO mailboxes VALUES (?, ?, 0)', (mailbox, uidvalidity))
+
+    def _store(self, mailbox, found, last_uid):
+        entry = self._entry(mailbox)
+        for message_id, uid in found:
+            entry['uids'].setdefault(message_id, uid)
+        entry['last_uid'] = max(entry['last_uid'], last_uid)
+        if self._db:
+            with self._db:
+                self._db.executemany('INSERT OR IGNORE INTO message_ids VALUES (?, ?, ?)',
+                                     [(mailbox, message_id, uid) for message_id, uid in found])
+                self._db.execute('REPLACE INTO mailboxes VALUES (?, ?, ?)',
+                                 (mailbox, entry['uidvalidity'], entry['last_uid']))
+
+    def note_uidvalidity(self, mailbox, uidvalidity):
+        """Record the UIDVALIDITY a SELECT reported, a new one drops the mailbox's entries before a lookup can hit them."""
+        if uidvalidity is None:
+            return
+        with self._lock:
+            if self._db:
+                self._refresh(mailbox)
+            entry = self._mailboxes.get(mailbox)
+            if entry and entry['uidvalidity'] is not None and entry['uidvalidity'] != uidvalidity:
+                self._reset(mailbox, uidvalidity)
+
+    def get(self, message_id, mailbox='INBOX'):
+        """Local lookup only, no IMAP traffic. Returns the UID as string or None."""
+        message_id = normalize_message_id(message_id)
+        with self._lock:
+            if self._db:
+                # A reset by another worker process must not leave our copy answering with stale UIDs
+                self._refresh(mailbox)
+            uid = self._mailboxes.get(mailbox, {}).get('uids', {}).get(message_id)
+            if uid is None and self._db and message_id:
+                uid = self._shared_get(mailbox, message_id)
+            if uid is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            return str(uid)
+
+    def discard_uids(self, uids, mailbox='INBOX'):
+        """Forget UIDs that no longer exist in the mailbox, e.g. after a MOVE."""
+        uids = {int(uid) for uid in uids}
+        with self._lock:
+            entry = self._mailboxes.get(mailbox)
+            if not entry:
+                return
+            stale = [message_id for message_id, uid in entry['uids'].items() if uid in uids]
+            for message_id in stale:
+                del entry['uids'][message_id]
+            if self._db and stale:
+                with self._db:
+                    self._db.executemany('DELETE FROM message_ids WHERE mailbox = ? AND message_id = ?',
+                                         [(mailbox, message_id) for message_id in stale])
+
+    def sync(self, mail, mailbox='INBOX'):
+        """
+        SELECT the mailbox and index every UID added since the last sync.
+
+        The session is left with the mailbox selected.
+        """
+        uidvalidity, uidnext = select_mailbox(mail, mailbox)
+        with self._lock:
+            if self._db:
+                self._refresh(mailbox)
+            entry = self._entry(mailbox)
+            if entry['uidvalidity'] != uidvalidity:
+                self._reset(mailbox, uidvalidity)
+                entry = self._entry(mailbox)
+            last_uid = entry['last_uid']
+
+        # Nothing new since the last sync
+        if uidnext is not None and uidnext - 1 <= last_uid:
+            return
+
+        start = last_uid + 1
+        while True:
+            end = start + self.sync_batch - 1
+            # Last batch runs up to '*' so nothing added during the sync is missed
+            last_batch = uidnext is None or end >= uidnext - 1
+            result, data = mail.uid('FETCH', f"{start}:{'*' if last_batch else end}",
+                                    '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+            if result != 'OK':
+                raise mail.error('FETCH of Message-ID headers failed')
+
+            found = []
+            highest = last_uid
+            for item in data:
+                if not isinstance(item, tuple):
+                    continue
+                match = UID_RE.search(item[0])
+                if not match:
+                    continue
+                uid = int(match.group(1))
+                # 'n:*' always returns the newest message, even when it is below n
+                if uid <= last_uid:
+                    continue
+                highest = max(highest, uid)
+                message_id = normalize_message_id(email.message_from_bytes(item[1]).get('Message-ID'))
+                if message_id:
+                    found.append((message_id, uid))
+
+            if last_batch and uidnext is not None:
+                highest = max(highest, uidnext - 1)
+            with self._lock:
+                self._store(mailbox, found, highest)
+                self._stats['synced'] += len(found)
+
+            if last_batch:
+                return
+            start = end + 1
+
+    def lookup(self, mail, message_id, mailbox='INBOX'):
+        """
+        Resolve a Message-ID to a UID: local index first, then an incremental sync,
+        and a server-side UID SEARCH only if the index still misses.
+
+        Returns:
+        tuple: (uid, error)
+        """
+        uid = self.get(message_id, mailbox)
+        if uid:
+            return uid, None
+
+        self.sync(mail, mailbox)
+        uid = self.get(message_id, mailbox)
+        if uid:
+            return uid, None
+
+        # Messages whose header the local parser did not match, fall back to the server
+        with self._lock:
+            self._stats['server_searches'] += 1
+        uid, error = search_uid_by_message_id(mail, message_id)
+        if uid:
+            with self._lock:
+                self._store(mailbox, [(normalize_message_id(message_id), int(uid))], 0)
+        return uid, error
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['mailboxes'] = {
+                mailbox: {'uidvalidity': entry['uidvalidity'], 'last_uid': entry['last_uid'], 'entries': len(entry['uids'])}
+                for mailbox, entry in self._mailboxes.items()
+            }
+        return stats